@@ -0,0 +1,51 @@
+"""
+Микробенчмарки этапов поиска RAGPipeline
+
+Запуск:
+    python -m benchmarks.bench_retrieval               # сравнение с baseline.json
+    python -m benchmarks.bench_retrieval --update-baseline
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.common import load_queries, run_micro, rss_mb, report
+from src.rag_pipeline import RAGPipeline
+
+
+def run(repeat: int, top_k: int) -> dict:
+    queries = load_queries()
+    rag = RAGPipeline()
+
+    results = {
+        "classify_query": run_micro(rag._classify_query, queries, repeat),
+        "simple_text_search": run_micro(lambda q: rag._simple_text_search(q, top_k), queries, repeat),
+        "search_documents": run_micro(lambda q: rag._search_documents(q, top_k), queries, repeat),
+    }
+    if rag.embeddings_model is not None:
+        results["encode_query"] = run_micro(lambda q: rag.embeddings_model.encode([q]), queries, repeat)
+    else:
+        print("⚠️ Модель эмбеддингов не загружена - encode_query пропущен, search_documents = текстовый поиск")
+
+    rss = rss_mb()
+    for m in results.values():
+        m["rss_mb"] = rss
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки поиска")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Допустимое ухудшение (доля)")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.top_k)
+    sys.exit(report("retrieval", results, args.tolerance, args.update_baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Бенчмарк бюджета потоков: пропускная способность и p99 при одновременных запросах
+
+Этап, тяжёлый для CPU, - пакетный поиск FAISS IndexFlatL2 (без FAISS -
+NumpyIndex) по векторам data/faiss_index, дополненным до --size строк, и
+кодирование вопросов моделью, если sentence-transformers установлен.
+--clients потоков-клиентов одновременно выполняют этап; для каждой пары
+(потоков на операцию, клиентов) сравниваются:
+- free  - без ограничения одновременных операций (как до бюджета потоков);
+- slots - этапы ждут слота (thread_budget.compute_slot, ядра / потоки).
+
+Каждая настройка - отдельный процесс: переменные BLAS/OpenMP должны быть
+заданы до загрузки numpy и FAISS.
+
+Запуск:
+    python -m benchmarks.bench_threads
+    python -m benchmarks.bench_threads --threads 1 2 4 --clients 1 8 --size 200000
+    python -m benchmarks.bench_threads --update-baseline
+"""
+import argparse
+import contextlib
+import json
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.common import load_queries, summarize, rss_mb, report
+from src import thread_budget
+
+
+def child(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Прогон одной настройки (в отдельном процессе)"""
+    # Бюджет задаётся напрямую: потоков на операцию может быть больше ядер
+    cores = params["cores"] or thread_budget.available_cores()
+    threads = params["threads"]
+    budget = thread_budget.apply(thread_budget.ThreadBudget(
+        preset="serving", cores=cores, intra_op=threads, inter_op=1, slots=max(1, cores // threads)
+    ))
+    import numpy as np
+    from benchmarks.bench_vector_index import make_vectors, NOISE
+
+    vectors = make_vectors(params["size"])
+    try:
+        import faiss
+        index = faiss.IndexFlatL2(vectors.shape[1])
+        index.add(vectors)
+    except ImportError:
+        from src.vector_index import NumpyIndex
+        index = NumpyIndex(vectors)
+    model = None
+    try:
+        from src.index_manager import _load_model
+        from src.config import EMBEDDING_MODEL
+        model = _load_model(EMBEDDING_MODEL)
+    except ImportError:
+        pass
+    questions = load_queries()
+
+    rng = np.random.default_rng(0)
+    batch = params["batch"]
+
+    def stage(i: int):
+        if model is not None:
+            model.encode([questions[(i + j) % len(questions)] for j in range(batch)])
+        rows = rng.integers(0, len(vectors), batch)
+        queries = vectors[rows] + rng.normal(0, NOISE, (batch, vectors.shape[1])).astype(np.float32)
+        index.search(queries, 10)
+
+    gate = thread_budget.compute_slot if params["gated"] else (lambda _: contextlib.nullcontext())
+    stage(0)
+    latencies: List[float] = []
+    lock = threading.Lock()
+    counter = iter(range(params["requests"]))
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            t = time.perf_counter()
+            with gate("search"):
+                stage(i)
+            with lock:
+                latencies.append(time.perf_counter() - t)
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(params["clients"])]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    result = summarize(latencies, time.perf_counter() - started)
+    result.update(rss_mb=rss_mb(), intra_op=budget.intra_op, slots=budget.slots if params["gated"] else 0)
+    return result
+
+
+def run_setting(params: Dict[str, Any]) -> Dict[str, Any]:
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_threads", "--child", json.dumps(params)],
+        capture_output=True, text=True, check=True, cwd=Path(__file__).parent.parent,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    cores = thread_budget.available_cores()
+    parser = argparse.ArgumentParser(description="Пропускная способность при разных бюджетах потоков")
+    parser.add_argument("--threads", type=int, nargs="+", default=sorted({1, 2, cores}), help="потоков на операцию")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8], help="одновременных запросов")
+    parser.add_argument("--cores", type=int, default=0, help="ядер в бюджете (0 - доступные процессу)")
+    parser.add_argument("--size", type=int, default=100_000, help="строк в матрице")
+    parser.add_argument("--batch", type=int, default=32, help="вопросов в одном поиске")
+    parser.add_argument("--requests", type=int, default=48, help="операций на настройку")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Допустимое ухудшение (доля)")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(json.loads(args.child))))
+        return
+
+    print(f"🧵 Ядер доступно: {cores}")
+    results: Dict[str, Dict[str, Any]] = {}
+    for threads in args.threads:
+        for clients in args.clients:
+            for gated in (False, True):
+                name = f"t{threads}_c{clients}_{'slots' if gated else 'free'}"
+                params = {
+                    "cores": args.cores, "threads": threads, "clients": clients,
+                    "gated": gated, "size": args.size, "batch": args.batch, "requests": args.requests,
+                }
+                print(f"▶️ {name}...")
+                results[name] = run_setting(params)
+    sys.exit(report("threads", results, args.tolerance, args.update_baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Бенчмарк векторного поиска: FAISS IndexFlatL2 против NumpyIndex (float32/float16, mmap)
+
+Векторы - из data/faiss_index (реальные эмбеддинги чанков), до --size строк
+дополняются их зашумлёнными копиями; вопросы - зашумлённые векторы чанков
+(модель эмбеддингов не нужна). Полнота recall@k считается относительно
+точного поиска FAISS (без FAISS - NumPy float32).
+
+Запуск:
+    python -m benchmarks.bench_vector_index
+    python -m benchmarks.bench_vector_index --size 200000 --batch 1 32
+    python -m benchmarks.bench_vector_index --update-baseline
+"""
+import argparse
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.common import run_micro, rss_mb, report
+from src.config import FAISS_INDEX_DIR
+from src.vector_index import NumpyIndex, load_vector_index
+
+NOISE = 0.05
+
+
+def make_vectors(size: int, seed: int = 0) -> np.ndarray:
+    index, backend = load_vector_index(Path(FAISS_INDEX_DIR))
+    if index is None:
+        raise SystemExit(f"❌ Индекс не найден в {FAISS_INDEX_DIR}, запустите python build_index.py")
+    base = np.asarray(index.reconstruct_n(0, index.ntotal), dtype=np.float32)
+    print(f"✅ Векторы индекса: {len(base)}×{base.shape[1]} ({backend})")
+    if size <= len(base):
+        return base[:size]
+    rng = np.random.default_rng(seed)
+    extra = base[rng.integers(0, len(base), size - len(base))]
+    extra = extra + rng.normal(0, NOISE, extra.shape).astype(np.float32)
+    return np.vstack([base, extra])
+
+
+def recall(found: np.ndarray, exact: np.ndarray) -> float:
+    k = exact.shape[1]
+    return float(np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact)]))
+
+
+def run(size: int, n_queries: int, batches, k: int, repeat: int, tmp: Path) -> Dict[str, Dict[str, Any]]:
+    vectors = make_vectors(size)
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, len(vectors), n_queries)]
+    queries = queries + rng.normal(0, NOISE, queries.shape).astype(np.float32)
+
+    indexes: Dict[str, Any] = {}
+    sizes: Dict[str, float] = {}
+    try:
+        import faiss
+        flat = faiss.IndexFlatL2(vectors.shape[1])
+        flat.add(vectors)
+        indexes["faiss_flat"] = flat
+        sizes["faiss_flat"] = vectors.nbytes / 2**20
+    except ImportError:
+        print("⚠️ FAISS не установлен - сравнение только NumPy-вариантов")
+
+    indexes["numpy_f32"] = NumpyIndex(vectors)
+    sizes["numpy_f32"] = vectors.nbytes / 2**20
+    for name, dtype in (("numpy_f32_mmap", "float32"), ("numpy_f16_mmap", "float16")):
+        path = tmp / f"vectors_{dtype}.npy"
+        NumpyIndex(vectors).save(path, dtype)
+        indexes[name] = NumpyIndex.load(path)
+        sizes[name] = path.stat().st_size / 2**20
+
+    reference = indexes.get("faiss_flat", indexes["numpy_f32"])
+    _, exact = reference.search(queries, k)
+
+    results: Dict[str, Dict[str, Any]] = {}
+    recalls: Dict[str, float] = {}
+    for name, index in indexes.items():
+        recalls[name] = recall(index.search(queries, k)[1], exact)
+        for batch in batches:
+            chunks = [queries[i:i + batch] for i in range(0, len(queries), batch)]
+            m = run_micro(lambda q: index.search(q, k), chunks, repeat)
+            m["rss_mb"] = rss_mb()
+            m["recall_at_k"] = round(recalls[name], 4)
+            m["size_mb"] = round(sizes[name], 1)
+            results[f"{name}_b{batch}"] = m
+
+    print(f"\n📐 {size} векторов, k={k}, вопросов {n_queries}")
+    print(f"{'бэкенд':<20} {'recall@k':>9} {'МБ':>8}")
+    for name in indexes:
+        print(f"{name:<20} {recalls[name]:>9.4f} {sizes[name]:>8.1f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISS Flat против NumPy-поиска")
+    parser.add_argument("--size", type=int, default=100_000, help="строк в матрице")
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 32])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Допустимое ухудшение (доля)")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(args.size, args.queries, args.batch, args.k, args.repeat, Path(tmp))
+    sys.exit(report("vector_index", results, args.tolerance, args.update_baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Общие утилиты бенчмарков: статистика задержек, RSS, сравнение с базовой линией
+"""
+import json
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Any, Optional
+
+BENCH_DIR = Path(__file__).parent
+QUERIES_PATH = BENCH_DIR / "queries.json"
+BASELINE_PATH = BENCH_DIR / "baseline.json"
+
+# Метрики, для которых «больше» - это регрессия; для остальных (throughput) - «меньше»
+HIGHER_IS_WORSE = ("p50_ms", "p95_ms", "p99_ms", "mean_ms", "rss_mb")
+
+
+def load_queries() -> List[str]:
+    """Фиксированный набор запросов"""
+    with open(QUERIES_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)["queries"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль с линейной интерполяцией (q в диапазоне 0-100)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def summarize(latencies_s: List[float], wall_s: float) -> Dict[str, float]:
+    """p50/p95/p99, среднее и пропускная способность по списку задержек"""
+    ms = [x * 1000 for x in latencies_s]
+    return {
+        "n": len(ms),
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "throughput_rps": round(len(ms) / wall_s, 2) if wall_s > 0 else 0.0,
+    }
+
+
+def rss_mb(pid: Optional[int] = None) -> float:
+    """Текущий RSS процесса в МБ (по /proc, иначе пиковый через getrusage)"""
+    status = Path(f"/proc/{pid or os.getpid()}/status")
+    if status.exists():
+        for line in status.read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS - байты
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_micro(fn: Callable[[Any], Any], inputs: List[Any], repeat: int = 5, warmup: int = 1) -> Dict[str, float]:
+    """Прогон функции по всем входам `repeat` раз после прогрева"""
+    for _ in range(warmup):
+        for x in inputs:
+            fn(x)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for x in inputs:
+            t = time.perf_counter()
+            fn(x)
+            latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """
+    Сравнение с базовой линией
+
+    Returns:
+        Список регрессий (пустой, если всё в пределах допуска)
+    """
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key, value in metrics.items():
+            ref = base.get(key)
+            if not isinstance(ref, (int, float)) or not ref or key == "n":
+                continue
+            if key in HIGHER_IS_WORSE:
+                worse = value > ref * (1 + tolerance)
+            elif key == "throughput_rps":
+                worse = value < ref * (1 - tolerance)
+            else:
+                continue
+            if worse:
+                regressions.append(f"{name}.{key}: {value} (база {ref}, допуск {tolerance:.0%})")
+    return regressions
+
+
+def load_baseline(section: str) -> Dict[str, Dict[str, float]]:
+    if not BASELINE_PATH.exists():
+        return {}
+    with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f).get(section, {})
+
+
+def save_baseline(section: str, results: Dict[str, Dict[str, float]]):
+    data = {}
+    if BASELINE_PATH.exists():
+        with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    data[section] = results
+    with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def report(section: str, results: Dict[str, Dict[str, float]], tolerance: float, update: bool) -> int:
+    """Печать таблицы, сравнение с базой; код возврата 1 при регрессии"""
+    print(f"\n📊 {section}")
+    print(f"{'бенчмарк':<28} {'n':>6} {'p50 мс':>10} {'p95 мс':>10} {'p99 мс':>10} {'rps':>10} {'RSS МБ':>8}")
+    for name, m in results.items():
+        print(
+            f"{name:<28} {m.get('n', 0):>6} {m.get('p50_ms', 0):>10} {m.get('p95_ms', 0):>10} "
+            f"{m.get('p99_ms', 0):>10} {m.get('throughput_rps', 0):>10} {m.get('rss_mb', 0):>8}"
+        )
+
+    if update:
+        save_baseline(section, results)
+        print(f"💾 Базовая линия обновлена: {BASELINE_PATH}")
+        return 0
+
+    baseline = load_baseline(section)
+    if not baseline:
+        print("⚠️ Базовая линия не найдена, запустите с --update-baseline")
+        return 0
+
+    regressions = compare(results, baseline, tolerance)
+    if regressions:
+        print("\n❌ РЕГРЕССИИ:")
+        for r in regressions:
+            print(f"   - {r}")
+        return 1
+    print("\n✅ Регрессий нет")
+    return 0
@@ -0,0 +1,183 @@
+"""
+Оценка качества и скорости поиска: recall@k, MRR, nDCG@k рядом с задержкой и памятью
+
+Размеченный набор (вопрос -> релевантные URL) лежит в benchmarks/eval_set.json;
+начальная версия построена из заголовков статей data/raw/3dtoday_articles.json
+(--seed), дальше её можно дополнять вручную.
+
+Запуск:
+    python -m benchmarks.eval_retrieval --seed
+    python -m benchmarks.eval_retrieval --retriever pipeline faiss_store --k 1 3 5
+"""
+import argparse
+import json
+import math
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.common import BENCH_DIR, summarize, rss_mb
+
+EVAL_SET_PATH = BENCH_DIR / "eval_set.json"
+ARTICLES_PATH = Path(__file__).parent.parent / "data" / "raw" / "3dtoday_articles.json"
+RESULTS_DIR = BENCH_DIR / "results"
+
+# Поиск: (вопрос, k) -> список URL в порядке ранжирования (с повторами для чанков)
+Retriever = Callable[[str, int], List[str]]
+
+
+def seed_eval_set(path: Path = EVAL_SET_PATH):
+    """Построить набор из заголовков статей: заголовок как вопрос, URL статьи как ответ"""
+    with open(ARTICLES_PATH, 'r', encoding='utf-8') as f:
+        articles = json.load(f)
+
+    items = [
+        {"question": a['title'], "relevant": [a['url']]}
+        for a in articles if a.get('title') and a.get('url')
+    ]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"source": "titles", "items": items}, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+    print(f"✅ Набор для оценки: {len(items)} вопросов -> {path}")
+
+
+def _pipeline_retriever() -> Retriever:
+    from src.rag_pipeline import RAGPipeline
+    rag = RAGPipeline()
+    return lambda q, k: [d.get('source_url', '') for d in rag._search_documents(q, k)]
+
+
+def _faiss_store_retriever() -> Retriever:
+    from src.embeddings_store_faiss import EmbeddingsStoreFAISS
+    store = EmbeddingsStoreFAISS()
+    if not store.load():
+        raise RuntimeError("FAISS индекс не найден")
+    return lambda q, k: [r['metadata'].get('url', '') for r in store.search(q, k=k)]
+
+
+def _vectorstore_retriever() -> Retriever:
+    from app.vectorstore import FAISSVectorStore
+    store = FAISSVectorStore()
+    store.load("data/faiss_index")
+    return lambda q, k: [r['metadata'].get('url', '') for r in store.search(q, k)]
+
+
+RETRIEVERS: Dict[str, Callable[[], Retriever]] = {
+    "pipeline": _pipeline_retriever,
+    "faiss_store": _faiss_store_retriever,
+    "vectorstore": _vectorstore_retriever,
+}
+
+
+def _dedupe(urls: List[str]) -> List[str]:
+    seen = set()
+    return [u for u in urls if not (u in seen or seen.add(u))]
+
+
+def score_ranking(ranked: List[str], relevant: set, k: int) -> Dict[str, float]:
+    """recall@k, reciprocal rank и nDCG@k для одного вопроса (бинарная релевантность)"""
+    top = ranked[:k]
+    hits = [1 if u in relevant else 0 for u in top]
+    recall = sum(hits) / len(relevant) if relevant else 0.0
+    rr = next((1 / (i + 1) for i, h in enumerate(hits) if h), 0.0)
+    dcg = sum(h / math.log2(i + 2) for i, h in enumerate(hits))
+    idcg = sum(1 / math.log2(i + 2) for i in range(min(len(relevant), k)))
+    return {"recall": recall, "rr": rr, "ndcg": dcg / idcg if idcg else 0.0}
+
+
+def evaluate(name: str, items: List[dict], ks: List[int]) -> dict:
+    rss_before = rss_mb()
+    t = time.perf_counter()
+    retriever = RETRIEVERS[name]()
+    load_s = time.perf_counter() - t
+    rss_loaded = rss_mb()
+
+    max_k = max(ks)
+    sums = {k: {"recall": 0.0, "rr": 0.0, "ndcg": 0.0} for k in ks}
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        urls = retriever(item["question"], max_k)
+        latencies.append(time.perf_counter() - t)
+        ranked = _dedupe(urls)
+        relevant = set(item["relevant"])
+        for k in ks:
+            for key, value in score_ranking(ranked, relevant, k).items():
+                sums[k][key] += value
+    wall = time.perf_counter() - start
+
+    n = len(items) or 1
+    quality = {}
+    for k in ks:
+        quality[f"recall@{k}"] = round(sums[k]["recall"] / n, 4)
+        quality[f"ndcg@{k}"] = round(sums[k]["ndcg"] / n, 4)
+    quality["mrr"] = round(sums[max_k]["rr"] / n, 4)
+
+    return {
+        "retriever": name,
+        "quality": quality,
+        "latency": summarize(latencies, wall),
+        "memory": {
+            "load_s": round(load_s, 2),
+            "rss_delta_mb": round(rss_loaded - rss_before, 1),
+            "rss_mb": rss_mb(),
+        },
+    }
+
+
+def to_markdown(results: List[dict], ks: List[int]) -> str:
+    cols = [f"recall@{k}" for k in ks] + [f"ndcg@{k}" for k in ks] + ["mrr"]
+    header = ["retriever"] + cols + ["p50 мс", "p95 мс", "qps", "RSS Δ МБ"]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    for r in results:
+        row = [r["retriever"]] + [str(r["quality"][c]) for c in cols] + [
+            str(r["latency"]["p50_ms"]), str(r["latency"]["p95_ms"]),
+            str(r["latency"]["throughput_rps"]), str(r["memory"]["rss_delta_mb"]),
+        ]
+        lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Оценка поиска: качество и скорость")
+    parser.add_argument("--seed", action="store_true", help="Пересоздать eval_set.json из заголовков статей")
+    parser.add_argument("--retriever", nargs="+", default=["pipeline"], choices=sorted(RETRIEVERS))
+    parser.add_argument("--k", nargs="+", type=int, default=[1, 3, 5, 10])
+    parser.add_argument("--out", type=Path, default=RESULTS_DIR)
+    args = parser.parse_args()
+
+    if args.seed or not EVAL_SET_PATH.exists():
+        seed_eval_set()
+
+    with open(EVAL_SET_PATH, 'r', encoding='utf-8') as f:
+        items = json.load(f)["items"]
+
+    results = []
+    for name in args.retriever:
+        print(f"\n🔍 Оценка: {name}")
+        try:
+            results.append(evaluate(name, items, args.k))
+        except Exception as e:
+            print(f"❌ {name}: {e}")
+
+    if not results:
+        sys.exit(1)
+
+    markdown = to_markdown(results, args.k)
+    print("\n" + markdown)
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    with open(args.out / f"eval-{stamp}.json", 'w', encoding='utf-8') as f:
+        json.dump({"k": args.k, "n_questions": len(items), "results": results}, f, ensure_ascii=False, indent=2)
+    with open(args.out / f"eval-{stamp}.md", 'w', encoding='utf-8') as f:
+        f.write(markdown)
+    print(f"💾 Результаты: {args.out}/eval-{stamp}.{{json,md}}")
+
+
+if __name__ == "__main__":
+    main()
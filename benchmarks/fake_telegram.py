@@ -0,0 +1,142 @@
+"""
+Фейковый Telegram Bot API для проверки режима webhook без выхода в сеть
+
+Отвечает на getMe/setWebhook/deleteWebhook/sendChatAction/sendMessage и
+запоминает отправленные сообщения. post_update() шлёт апдейт в webhook API
+так же, как это делает Telegram.
+
+Запуск:
+    python -m benchmarks.fake_telegram --port 8081
+    TELEGRAM_MODE=webhook TELEGRAM_BOT_TOKEN=1:fake \\
+    TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot uvicorn src.api:app
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any
+from urllib.parse import parse_qsl
+
+import requests
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.sent_messages: List[Dict[str, Any]] = []
+        self.calls: List[str] = []
+        self.webhook_url = ""
+        self.lock = threading.Lock()
+
+    def wait_messages(self, count: int, timeout: float = 30.0) -> List[Dict[str, Any]]:
+        """Дождаться `count` отправленных ботом сообщений"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if len(self.sent_messages) >= count:
+                    return list(self.sent_messages)
+            time.sleep(0.05)
+        raise TimeoutError(f"Бот отправил {len(self.sent_messages)} из {count} сообщений")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeTelegram
+
+    def _params(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) if length else b""
+        if "application/json" in (self.headers.get("Content-Type") or ""):
+            return json.loads(raw or b"{}")
+        return dict(parse_qsl(raw.decode("utf-8")))
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        params = self._params()
+        with self.server.lock:
+            self.server.calls.append(method)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "setWebhook":
+            self.server.webhook_url = params.get("url", "")
+            result = True
+        elif method in ("deleteWebhook", "sendChatAction"):
+            result = True
+        elif method == "sendMessage":
+            with self.server.lock:
+                self.server.sent_messages.append(params)
+            result = {
+                "message_id": next(_message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+
+        body = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_telegram(port: int = 0) -> FakeTelegram:
+    """Запуск фейкового Bot API в фоновом потоке"""
+    server = FakeTelegram(port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_update(text: str, chat_id: int = 100, user_id: int = 100) -> Dict[str, Any]:
+    """Апдейт с текстовым сообщением в формате Bot API"""
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def post_update(webhook_url: str, text: str, chat_id: int = 100, secret: str = "") -> int:
+    """Отправить апдейт в webhook, как это делает Telegram"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    resp = requests.post(webhook_url, json=make_update(text, chat_id, chat_id), headers=headers, timeout=10)
+    return resp.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    server = start_fake_telegram(args.port)
+    print(f"🧪 Фейковый Bot API: http://127.0.0.1:{server.server_port}/bot")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Нагрузочный тест /query на локальной заглушке Perplexity
+
+По умолчанию поднимает заглушку LLM и API (uvicorn) в отдельном процессе,
+прогоняет фиксированный набор запросов с заданной конкурентностью и
+сравнивает p50/p95/p99, пропускную способность и RSS сервера с baseline.json.
+
+Запуск:
+    python -m benchmarks.load_test --requests 200 --concurrency 8 --llm-latency 0.5
+    python -m benchmarks.load_test --backend fake                 # без HTTP-заглушки (LLM_BACKEND=fake)
+    python -m benchmarks.load_test --url http://127.0.0.1:8000   # уже запущенный API
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle, islice
+from pathlib import Path
+from typing import Tuple
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.common import load_queries, summarize, rss_mb, report
+from benchmarks.pplx_stub import start_stub
+
+ROOT_DIR = Path(__file__).parent.parent
+
+
+def start_api(port: int, llm_url: str = "", llm_env: dict = None) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        PPLX_API_URL=llm_url,
+        PERPLEXITY_API_KEY=os.getenv("PERPLEXITY_API_KEY") or "stub",
+        TRACE_LOG="0",
+        # У заглушки нет квоты: лимит запросов исказил бы замер
+        LLM_RATE_LIMIT_RPM="0",
+        **(llm_env or {}),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.api:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=ROOT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_ready(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/health", timeout=1).json().get("rag_initialized"):
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"API не поднялся за {timeout} с")
+
+
+def run_load(url: str, n_requests: int, concurrency: int, top_k: int) -> dict:
+    queries = list(islice(cycle(load_queries()), n_requests))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+
+    def one(question: str) -> Tuple[float, bool]:
+        """Длительность запроса и успех; ошибка соединения не прерывает прогон"""
+        t = time.perf_counter()
+        try:
+            resp = session.post(f"{url}/query", json={"question": question, "top_k": top_k}, timeout=120)
+            ok = resp.status_code == 200
+        except requests.exceptions.RequestException as e:
+            print(f"⚠️ {type(e).__name__}: {e}")
+            ok = False
+        return time.perf_counter() - t, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one, queries))
+    # Задержки - только успешных запросов, ошибки считаются отдельно
+    result = summarize([latency for latency, ok in outcomes if ok], time.perf_counter() - start)
+    result["errors"] = sum(1 for _, ok in outcomes if not ok)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /query")
+    parser.add_argument("--url", help="Адрес уже запущенного API (иначе поднимается локально)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--requests", type=int, default=120)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument(
+        "--backend", choices=["stub", "fake"], default="stub",
+        help="stub - Perplexity-бэкенд на HTTP-заглушке, fake - FakeBackend в процессе API",
+    )
+    parser.add_argument("--llm-tokens-per-s", type=float, default=0, help="Скорость генерации fake-бэкенда")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    server = None
+    stub = None
+    url = args.url
+    if not url and args.backend == "fake":
+        print(f"🧪 LLM_BACKEND=fake (задержка {args.llm_latency} с, {args.llm_tokens_per_s} ток/с)")
+        server = start_api(args.port, llm_env={
+            "LLM_BACKEND": "fake",
+            "FAKE_LLM_LATENCY_MS": str(args.llm_latency * 1000),
+            "FAKE_LLM_TOKENS_PER_S": str(args.llm_tokens_per_s),
+        })
+        url = f"http://127.0.0.1:{args.port}"
+    elif not url:
+        stub = start_stub(0, args.llm_latency, args.llm_jitter)
+        llm_url = f"http://127.0.0.1:{stub.server_port}/chat/completions"
+        print(f"🧪 Заглушка LLM: {llm_url} (задержка {args.llm_latency}±{args.llm_jitter} с)")
+        server = start_api(args.port, llm_url)
+        url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        wait_ready(url, args.startup_timeout)
+        print(f"🚀 Нагрузка: {args.requests} запросов, конкурентность {args.concurrency}")
+        result = run_load(url, args.requests, args.concurrency, args.top_k)
+        if server is not None:
+            result["rss_mb"] = rss_mb(server.pid)
+        name = f"query_c{args.concurrency}_llm{int(args.llm_latency * 1000)}ms"
+        if args.backend == "fake" and not args.url:
+            name += "_fake"
+        code = report("api", {name: result}, args.tolerance, args.update_baseline)
+        if result["errors"]:
+            print(f"❌ Ошибок: {result['errors']}")
+            code = 1
+        sys.exit(code)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=10)
+        if stub is not None:
+            stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
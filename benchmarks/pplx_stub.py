@@ -0,0 +1,140 @@
+"""
+Локальная заглушка Perplexity API (/chat/completions) с настраиваемой задержкой
+и внедрением сбоев (503, 429 с Retry-After, медленные ответы)
+
+Запуск:
+    python -m benchmarks.pplx_stub --port 8900 --latency 0.5 --jitter 0.1
+    python -m benchmarks.pplx_stub --error-rate 0.2 --rate-limit-rate 0.1 --slow-rate 0.05
+    PPLX_API_URL=http://127.0.0.1:8900/chat/completions uvicorn src.api:app
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_ANSWER = (
+    "1. Проверьте температуру сопла и стола.\n"
+    "2. Откалибруйте первый слой.\n"
+    "3. Уменьшите скорость печати."
+)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, handler):
+        super().__init__(("127.0.0.1", port), handler)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def count(self) -> int:
+        with self.lock:
+            self.requests += 1
+            return self.requests
+
+
+def make_handler(
+    latency: float,
+    jitter: float,
+    error_rate: float,
+    fail_first: int = 0,
+    rate_limit_rate: float = 0.0,
+    slow_rate: float = 0.0,
+    slow_latency: float = 5.0,
+):
+    class StubHandler(BaseHTTPRequestHandler):
+        server: StubServer
+
+        def _fail(self, status: int, headers: dict = None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_POST(self):
+            n = self.server.count()
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+
+            slow = slow_rate and random.random() < slow_rate
+            time.sleep(slow_latency if slow else max(0.0, latency + random.uniform(-jitter, jitter)))
+
+            if n <= fail_first or (error_rate and random.random() < error_rate):
+                self._fail(503)
+                return
+            if rate_limit_rate and random.random() < rate_limit_rate:
+                self._fail(429, {"Retry-After": "1"})
+                return
+
+            prompt_chars = sum(len(m.get("content", "")) for m in payload.get("messages", []))
+            body = json.dumps({
+                "model": payload.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": STUB_ANSWER}}],
+                "usage": {
+                    "prompt_tokens": prompt_chars // 4,
+                    "completion_tokens": len(STUB_ANSWER) // 4,
+                },
+            }, ensure_ascii=False).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def start_stub(
+    port: int = 0,
+    latency: float = 0.5,
+    jitter: float = 0.0,
+    error_rate: float = 0.0,
+    **faults,
+) -> StubServer:
+    """
+    Запуск заглушки в фоновом потоке; порт 0 - выбрать свободный
+
+    faults: fail_first (первые N запросов - 503), rate_limit_rate (доля 429),
+    slow_rate/slow_latency (доля медленных ответов и их задержка).
+    Число полученных запросов - server.requests.
+    """
+    server = StubServer(port, make_handler(latency, jitter, error_rate, **faults))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Perplexity API")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.5, help="Задержка ответа, с")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Разброс задержки, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 503")
+    parser.add_argument("--fail-first", type=int, default=0, help="Первые N запросов - 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Доля медленных ответов")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="Задержка медленного ответа, с")
+    args = parser.parse_args()
+
+    server = start_stub(
+        args.port, args.latency, args.jitter, args.error_rate,
+        fail_first=args.fail_first,
+        rate_limit_rate=args.rate_limit_rate,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+    )
+    print(f"🧪 Заглушка Perplexity: http://127.0.0.1:{server.server_port}/chat/completions")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
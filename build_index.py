@@ -1,6 +1,18 @@
+import argparse
+import json
+import os
+import shutil
 import sys
+import zlib
+from pathlib import Path
+
 sys.path.insert(0, '.')
 
+from src import thread_budget
+
+# Построение - одна большая операция на все ядра (до импорта numpy/torch)
+thread_budget.apply(thread_budget.make_budget("build"))
+
 # Пробуем разные варианты импорта
 try:
     from src.embeddings_store_faiss import EmbeddingsStoreFAISS
@@ -16,28 +28,83 @@ except ImportError:
         spec.loader.exec_module(embeddings_module)
         EmbeddingsStoreFAISS = embeddings_module.EmbeddingsStoreFAISS
 
+INDEX_ROOT = "data/faiss_index"
+KB_ROOT = "data/kbs"
+
+
+def _article_shard(article: dict, count: int) -> int:
+    """Номер шарда статьи: стабильный хеш URL (тот же при каждой пересборке)"""
+    key = article.get('url') or article.get('title') or ""
+    return zlib.crc32(key.encode('utf-8')) % count
+
+
+def build_shards(store, articles: list, name: str, count: int, only=None, shards_root: str = f"{INDEX_ROOT}/shards"):
+    """
+    Шарды <name>-0..<name>-{count-1} по хешу URL статьи
+
+    `only` - пересобрать только эти номера, остальные шарды не трогаются.
+    Без `only` удаляются шарды <name>-N и дальше от прежнего разбиения.
+    """
+    for i in range(count):
+        if only is not None and i not in only:
+            continue
+        part = [a for a in articles if _article_shard(a, count) == i]
+        print(f"\n📦 Шард {name}-{i}: {len(part)} статей")
+        store.build_from_list(part, db_path=os.path.join(shards_root, f"{name}-{i}"))
+    if only is None:
+        for path in Path(shards_root).glob(f"{name}-*"):
+            suffix = path.name[len(name) + 1:]
+            if suffix.isdigit() and int(suffix) >= count:
+                shutil.rmtree(path)
+                print(f"🗑️ Удалён шард прежнего разбиения: {path.name}")
+
+
 if __name__ == "__main__":
-    print("🚀 Создание FAISS индекса...")
+    parser = argparse.ArgumentParser(description="Построение векторного индекса (целиком или по шардам)")
+    parser.add_argument("--articles", default="data/raw/3dtoday_articles.json")
+    parser.add_argument("--kb", help="отдельная база знаний data/kbs/<имя> (vendor_prusa, runbooks...)")
+    parser.add_argument("--shard", help="шард <индекс>/shards/<имя> из --articles (wiki, forum...)")
+    parser.add_argument("--shards", type=int, default=0, help="разбить --articles на N шардов по хешу URL")
+    parser.add_argument("--only", type=int, nargs="+", help="с --shards: пересобрать только эти номера")
+    args = parser.parse_args()
+
+    articles_path = args.articles
+    if not os.path.exists(articles_path):
+        print(f"❌ Файл {articles_path} не найден!")
+        sys.exit(1)
+    print(f"✅ Файл найден: {articles_path}")
+    index_root = os.path.join(KB_ROOT, args.kb) if args.kb else INDEX_ROOT
+    shards_root = os.path.join(index_root, "shards")
+
+    if args.shard or args.shards:
+        print("🚀 Создание шардов индекса (FAISS или NumPy, VECTOR_BACKEND)...")
+        with open(articles_path, 'r', encoding='utf-8') as f:
+            articles = json.load(f)
+        print(f"📄 Загружено {len(articles)} статей")
+        store = EmbeddingsStoreFAISS(db_path=shards_root)
+        if args.shards:
+            build_shards(
+                store, articles, args.shard or "wiki", args.shards, set(args.only) if args.only else None, shards_root
+            )
+        else:
+            store.build_from_list(articles, db_path=os.path.join(shards_root, args.shard))
+        print(f"\n✅ Готово! Шарды в {shards_root}/ (при наличии шардов API не читает общий индекс)")
+        print("🔄 Запущенный API подхватит новую версию: POST /admin/index/reload или INDEX_WATCH_INTERVAL")
+        sys.exit(0)
+
+    print("🚀 Создание векторного индекса (FAISS или NumPy, VECTOR_BACKEND)...")
     
-    store = EmbeddingsStoreFAISS(db_path="data/faiss_index")
+    store = EmbeddingsStoreFAISS(db_path=index_root)
     
-    # Проверка файла
-    import os
-    articles_path = "data/raw/3dtoday_articles.json"
+    # Строим индекс
+    store.build_from_articles(articles_path)
     
-    if not os.path.exists(articles_path):
-        print(f"❌ Файл {articles_path} не найден!")
-    else:
-        print(f"✅ Файл найден: {articles_path}")
-        
-        # Строим индекс
-        store.build_from_articles(articles_path)
-        
-        # Тест
-        print("\n🔍 Тестовый поиск:")
-        results = store.search("Как печатать PLA пластиком?", k=2)
-        for i, r in enumerate(results, 1):
-            print(f"\n{i}. {r['metadata']['title']}")
-            print(f"   {r['text'][:200]}...")
-        
-        print("\n✅ Готово! Индекс сохранён в data/faiss_index/")
+    # Тест
+    print("\n🔍 Тестовый поиск:")
+    results = store.search("Как печатать PLA пластиком?", k=2)
+    for i, r in enumerate(results, 1):
+        print(f"\n{i}. {r['metadata']['title']}")
+        print(f"   {r['text'][:200]}...")
+    
+    print(f"\n✅ Готово! Индекс ({type(store.index).__name__}) сохранён в {index_root}/")
+    print("🔄 Запущенный API подхватит новую версию: POST /admin/index/reload или INDEX_WATCH_INTERVAL")
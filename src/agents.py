@@ -1,6 +1,24 @@
-from typing import Literal
-from .models import pplx_chat
-from .embeddings_store_faiss import get_vector_store
+"""
+Агенты ответа на вопрос, собранные в граф этапов (см. stage_graph.py)
+
+    embedding -> category (необязательный, с бюджетом) -> answer -> safe_answer
+              -> documents --------------------------->
+
+Классификация и поиск независимы и выполняются параллельно; если
+классификация (возможно, через LLM) не уложилась в AGENT_CLASSIFY_BUDGET_MS,
+ответ строится по маршруту «другое».
+"""
+import threading
+from typing import Literal, Optional
+
+from .config import AGENT_CLASSIFY_BUDGET_MS
+from .models import chat as llm_chat
+from .context_packer import pack_context
+from .keywords import get_engine
+from .intent_classifier import get_classifier
+from .routing import RoutingTable
+from .stage_graph import Stage, StageGraph, RunResult
+from .thread_budget import compute_slot
 
 Category = Literal[
     "основы",
@@ -11,63 +29,92 @@ Category = Literal[
     "другое",
 ]
 
-def classify_query(user_query: str) -> Category:
-    system_prompt = (
-        "Ты классификатор запросов по 3D-печати. "
-        "Верни ОДНО слово из списка: основы, подбор_материала, настройка_принтера, "
-        "диагностика_дефектов, слайсер, другое."
-    )
-    content = pplx_chat(
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_query},
-        ],
-        temperature=0,
-        max_tokens=10,
-    )
-    text = content.lower()
-    for cat in ["основы", "подбор_материала", "настройка_принтера", "диагностика_дефектов", "слайсер"]:
-        if cat in text:
-            return cat  # type: ignore[return-value]
-    return "другое"  # type: ignore[return-value]
+_store = None
+_store_lock = threading.Lock()
+_routing: Optional[RoutingTable] = None
+
+
+def _get_store():
+    """Хранилище FAISS с моделью эмбеддингов (загружается один раз на процесс)"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            from .embeddings_store_faiss import EmbeddingsStoreFAISS
 
-def retrieve_knowledge(user_query: str, k: int = 6):
+            store = EmbeddingsStoreFAISS()
+            if not store.load():
+                print("⚠️ FAISS индекс не найден")
+                return None
+            _store = store
+        return _store
+
+
+def embed_query(user_query: str):
+    """Эмбеддинг вопроса моделью индекса (None - индекс или модель недоступны)"""
+    try:
+        store = _get_store()
+        if store is None:
+            return None
+        with compute_slot("embed"):
+            return store.model.encode([user_query])[0]
+    except Exception as e:
+        print(f"⚠️ Ошибка кодирования вопроса: {e}")
+        return None
+
+
+def classify_query(user_query: str, embedding=None, model_name: str = "") -> Category:
+    """
+    Категория вопроса: центроиды по эмбеддингу, ключевые слова, LLM - только
+    если оба не дали уверенного ответа (см. intent_classifier.py)
+    """
+    return get_classifier().classify(user_query, embedding, model_name).category  # type: ignore[return-value]
+
+def retrieve_knowledge(user_query: str, k: int = 6, embedding=None):
     """Получение релевантных документов из FAISS"""
     try:
-        # Импортируем класс
-        from .embeddings_store_faiss import EmbeddingsStoreFAISS
-        
-        # Создаём экземпляр и загружаем индекс
-        store = EmbeddingsStoreFAISS()
-        if not store.load():
-            print("⚠️ FAISS индекс не найден")
+        store = _get_store()
+        if store is None:
             return []
-        
-        # Выполняем поиск
-        results = store.search(user_query, k=k)
+
+        # Выполняем поиск (по готовому эмбеддингу, если он есть)
+        with compute_slot("search"):
+            if embedding is not None:
+                results = store.search_by_vector(embedding, k=k)
+            else:
+                results = store.search(user_query, k=k)
         print(f"✅ Найдено {len(results)} релевантных документов")
-        
+
         # Преобразуем результаты в формат, ожидаемый consultant_answer
         # Создаём объекты с атрибутами page_content и metadata
         class Document:
-            def __init__(self, text, metadata):
+            def __init__(self, text, metadata, score=0.0):
                 self.page_content = text
                 self.metadata = metadata
-        
-        documents = [Document(r['text'], r['metadata']) for r in results]
+                self.score = score
+
+        documents = [Document(r['text'], r['metadata'], r.get('score', 0.0)) for r in results]
         return documents
-        
+
     except Exception as e:
         print(f"⚠️ Ошибка FAISS поиска: {e}")
         import traceback
         traceback.print_exc()
         return []
 
-def consultant_answer(user_query: str, docs, dialog_context: str = "") -> str:
-    context_text = "\n\n".join(
-        f"Заголовок: {d.metadata.get('title')}\nИсточник: {d.metadata.get('source_url')}\nТекст: {d.page_content}"
-        for d in docs
+def consultant_answer(user_query: str, docs, dialog_context: str = "", category: Optional[str] = None) -> str:
+    """Ответ LLM по найденным документам; с `category` - параметры маршрута категории"""
+    global _routing
+    route = None
+    if category is not None:
+        _routing = _routing or RoutingTable()
+        route = _routing.select(category, user_query)
+    packed = pack_context(
+        user_query,
+        [{"text": d.page_content, "metadata": d.metadata, "score": getattr(d, "score", 0.0)} for d in docs],
+        route.context_budget if route else None,
     )
+    print(f"📦 Контекст: {packed.used_tokens}/{packed.budget} токенов ({len(packed.documents)} из {len(docs)} док.)")
+    context_text = packed.text
     system_prompt = (
         "Ты эксперт по 3D-печати. Используй ТОЛЬКО факты из предоставленного контекста. "
         "Если информации недостаточно, честно скажи об этом и предложи общие рекомендации. "
@@ -79,26 +126,72 @@ def consultant_answer(user_query: str, docs, dialog_context: str = "") -> str:
         f"Вопрос пользователя: {user_query}\n\n"
         "Сформируй структурированный ответ: причины, параметры, шаги, ссылки."
     )
-    return pplx_chat(
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0.4,
-        max_tokens=900,
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    if route is None:
+        return llm_chat(messages, temperature=0.4, max_tokens=900)
+    return llm_chat(
+        messages,
+        model=route.model,
+        temperature=route.temperature,
+        max_tokens=route.max_tokens,
+        backend=route.backend,
     )
 def safety_check(answer: str) -> str:
     """Простая проверка опасных ключевых слов"""
-    dangerous_keywords = [
-        "токсичн", "ядовит", "взрывоопасн", "взрыв",
-        "горюч", "легковоспламеня", "пожар", "отравлен"
-    ]
-    
-    answer_lower = answer.lower()
-    has_danger = any(keyword in answer_lower for keyword in dangerous_keywords)
-    
+    has_danger = bool(get_engine().scan(answer, "safety").group("safety"))
+
     if has_danger:
         return "⚠️ БЕЗОПАСНОСТЬ: Соблюдайте технику безопасности при работе с материалами.\n\n" + answer
-    
+
     return answer
 
+
+def build_agent_graph(classify_budget_ms: float = AGENT_CLASSIFY_BUDGET_MS, k: int = 6) -> StageGraph:
+    """Граф этапов агентов; входы прогона - query и dialog_context"""
+    def model_name() -> str:
+        store = _store
+        return store.model_name if store is not None else ""
+
+    return StageGraph([
+        Stage("embedding", lambda query: embed_query(query), ("query",)),
+        Stage(
+            "category",
+            lambda query, embedding: classify_query(query, embedding, model_name()),
+            ("query", "embedding"),
+            optional=True,
+            default="другое",
+            budget_s=classify_budget_ms / 1000,
+        ),
+        Stage("documents", lambda query, embedding: retrieve_knowledge(query, k, embedding), ("query", "embedding")),
+        Stage(
+            "answer",
+            lambda query, documents, dialog_context, category: consultant_answer(
+                query, documents, dialog_context, category
+            ),
+            ("query", "documents", "dialog_context", "category"),
+        ),
+        Stage("safe_answer", lambda answer: safety_check(answer), ("answer",)),
+    ])
+
+
+def run_agents(user_query: str, dialog_context: str = "", deadline_ms: Optional[float] = None) -> RunResult:
+    """
+    Прогон графа агентов с разбивкой времени по критическому пути
+
+    `deadline_ms` ограничивает необязательные этапы (классификацию) сверх
+    их собственного бюджета.
+    """
+    result = build_agent_graph().run(
+        {"query": user_query, "dialog_context": dialog_context},
+        deadline_s=deadline_ms / 1000 if deadline_ms is not None else None,
+    )
+    print(f"⏱️ Критический путь: {result.format_breakdown()}")
+    return result
+
+
+def answer_query(user_query: str, dialog_context: str = "", deadline_ms: Optional[float] = None) -> str:
+    """Ответ агентов на вопрос"""
+    return run_agents(user_query, dialog_context, deadline_ms).outputs["safe_answer"]
@@ -1,10 +1,35 @@
 # src/api.py
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional
+from fastapi import FastAPI, HTTPException, Response, Request, Header
+from pydantic import BaseModel, Field
+from typing import Optional, Dict, List, Literal, Tuple
+import asyncio
+import base64
+import binascii
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from src import thread_budget
+
+# До импорта numpy/torch: переменные BLAS/OpenMP читаются при загрузке библиотек.
+# Бюджет, уже заданный точкой входа (src.serve делит ядра между воркерами), сохраняется
+thread_budget.apply(thread_budget.current())
+
 from src.rag_pipeline import RAGPipeline
+from src.config import (
+    RAG_WORKER_THREADS,
+    TELEGRAM_MODE,
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_SECRET,
+    INDEX_WATCH_INTERVAL,
+    ADMIN_TOKEN,
+    SEARCH_MAX_LIMIT,
+    SEARCH_MAX_DEPTH,
+    SEARCH_MAX_BATCH,
+)
+from src.singleflight import make_key
+from src import tracing
+from src import metrics
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -18,25 +43,157 @@ app = FastAPI(
 
 # Инициализация RAG при старте приложения
 rag_pipeline = None
+# Блокирующие RAG-запросы выполняются в пуле, а не в event loop
+rag_executor = ThreadPoolExecutor(max_workers=RAG_WORKER_THREADS, thread_name_prefix="rag")
+# Telegram-бот в режиме webhook (делит пайплайн и пул с API)
+telegram_app = None
+
+WEBHOOK_PATH = "/telegram/webhook"
 
 @app.on_event("startup")
 async def startup_event():
     """Инициализация RAG-системы при запуске"""
     global rag_pipeline
     print("🚀 Запуск 3D Print Assistant API...")
-    print("🔧 Инициализация RAG-системы...")
-    rag_pipeline = RAGPipeline()
+    # В режиме src.serve пайплайн уже загружен мастер-процессом до fork
+    if rag_pipeline is None:
+        print("🔧 Инициализация RAG-системы...")
+        rag_pipeline = RAGPipeline()
     print("✅ RAG-система готова к работе!")
+    
+    if rag_pipeline.kbs is not None:
+        rag_pipeline.kbs.watch(INDEX_WATCH_INTERVAL)
+    
+    if TELEGRAM_MODE == "webhook":
+        await _start_telegram_webhook()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка бота и пула потоков"""
+    if telegram_app is not None:
+        await telegram_app.stop()
+        await telegram_app.shutdown()
+    if rag_pipeline is not None and rag_pipeline.kbs is not None:
+        rag_pipeline.kbs.stop()
+    rag_executor.shutdown(wait=False)
+
+async def _start_telegram_webhook():
+    """Запуск бота в режиме webhook на общем пайплайне"""
+    global telegram_app
+    from src import telegram_bot
+    
+    # Без секрета апдейт от имени Telegram может прислать любой, кто видит API
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise ValueError("TELEGRAM_WEBHOOK_SECRET не задан (обязателен при TELEGRAM_MODE=webhook)")
+    
+    telegram_app = telegram_bot.build_application(rag_pipeline, executor=rag_executor, webhook=True)
+    await telegram_app.initialize()
+    await telegram_app.start()
+    
+    if TELEGRAM_WEBHOOK_URL:
+        await telegram_app.bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            drop_pending_updates=True,
+        )
+        print(f"✅ Telegram webhook: {TELEGRAM_WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    else:
+        print("⚠️ TELEGRAM_WEBHOOK_URL не задан - webhook нужно зарегистрировать вручную")
+
+def _run_query(
+    trace: "tracing.Trace",
+    question: str,
+    top_k: Optional[int],
+    session_id: Optional[str],
+    mode: Optional[str] = None,
+    kbs: Optional[List[str]] = None,
+) -> str:
+    """Запрос к пайплайну в рабочем потоке (трасса активируется в этом потоке)"""
+    with tracing.activate(trace):
+        return rag_pipeline.query(question=question, top_k=top_k, session_id=session_id, mode=mode, kbs=kbs)
+
+def _check_kbs(kbs: Optional[List[str]]):
+    """400 - неизвестная база знаний или выбор базы недоступен"""
+    if not kbs or rag_pipeline is None:
+        return
+    if rag_pipeline.kbs is None:
+        raise HTTPException(status_code=400, detail="Выбор базы знаний недоступен в режиме RETRIEVAL_MODE=remote")
+    try:
+        rag_pipeline.kbs.resolve(kbs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # Модели данных
 class QueryRequest(BaseModel):
     question: str
-    top_k: Optional[int] = 3
+    # По умолчанию - из маршрута категории вопроса
+    top_k: Optional[int] = None
+    # Идентификатор диалога: с ним учитывается история предыдущих вопросов
+    session_id: Optional[str] = None
+    # llm - ответ модели, extractive - выдержки из источников без LLM (быстро);
+    # по умолчанию ANSWER_MODE
+    mode: Optional[Literal["llm", "extractive"]] = None
+    # Базы знаний для поиска (wiki, vendor_prusa, runbooks...); по умолчанию -
+    # из маршрута категории вопроса, а без него - основная
+    kbs: Optional[List[str]] = None
 
 class QueryResponse(BaseModel):
     question: str
     answer: str
     sources_count: int
+    timings: Dict[str, float] = {}
+    # Как получен ответ: llm, extractive или fallback
+    answer_mode: Optional[str] = None
+    # Шарды индекса, не ответившие вовремя (источники найдены без них)
+    missing_shards: List[str] = []
+    # Базы знаний, которые не удалось загрузить (источники найдены без них)
+    missing_kbs: List[str] = []
+
+class SearchRequest(BaseModel):
+    query: str
+    limit: int = Field(10, ge=1, le=SEARCH_MAX_LIMIT)
+    # Разделы базы знаний (поле category чанка, например Fdm_Materials); пусто - все
+    categories: Optional[List[str]] = None
+    # Базы знаний (результаты объединяются по score); пусто - основная
+    kbs: Optional[List[str]] = None
+    # next_cursor предыдущей страницы
+    cursor: Optional[str] = None
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=SEARCH_MAX_BATCH)
+    limit: int = Field(10, ge=1, le=SEARCH_MAX_LIMIT)
+    categories: Optional[List[str]] = None
+    kbs: Optional[List[str]] = None
+
+class SearchHit(BaseModel):
+    id: str
+    chunk_id: Optional[int] = None
+    rank: int
+    score: float
+    title: str
+    text: str
+    source_url: str
+    category: str = ""
+    # База знаний чанка (при поиске по выбранным базам)
+    kb: Optional[str] = None
+
+class SearchResponse(BaseModel):
+    query: str
+    hits: List[SearchHit]
+    # Курсор следующей страницы (None - страниц больше нет)
+    next_cursor: Optional[str] = None
+    index_version: str
+    timings: Dict[str, float] = {}
+    # Шарды индекса, не ответившие вовремя (результаты без них)
+    missing_shards: List[str] = []
+    missing_kbs: List[str] = []
+
+class BatchSearchResponse(BaseModel):
+    results: List[SearchResponse]
+    index_version: str
+    timings: Dict[str, float] = {}
+    missing_shards: List[str] = []
+    missing_kbs: List[str] = []
 
 # Эндпоинты
 @app.get("/")
@@ -47,7 +204,11 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "/query": "POST - Задать вопрос системе",
+            "/search": "POST - Поиск фрагментов без генерации ответа (и /search/batch)",
             "/health": "GET - Проверка состояния",
+            "/metrics": "GET - Метрики Prometheus",
+            WEBHOOK_PATH: "POST - Апдейты Telegram (TELEGRAM_MODE=webhook)",
+            "/admin/index": "GET - Версии индекса (X-Admin-Token)",
             "/docs": "GET - Документация API"
         }
     }
@@ -60,41 +221,245 @@ async def health_check():
         "rag_initialized": rag_pipeline is not None
     }
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Метрики в формате Prometheus"""
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
 @app.post("/query", response_model=QueryResponse)
-async def query_rag(request: QueryRequest):
+async def query_rag(request: QueryRequest, response: Response):
     """
     Задать вопрос RAG-системе
     
     Args:
         request: Объект запроса с вопросом и параметрами
+        response: Ответ FastAPI (для заголовка Server-Timing)
     
     Returns:
-        Ответ системы с источниками
+        Ответ системы с источниками и временем этапов (мс)
     """
     if rag_pipeline is None:
         raise HTTPException(
             status_code=503,
             detail="RAG-система не инициализирована"
         )
+    _check_kbs(request.kbs)
     
+    trace = tracing.Trace("api.query")
+    in_flight = metrics.REQUESTS_IN_FLIGHT.labels(source="api")
+    in_flight.inc()
     try:
         # Получение ответа
-        answer = rag_pipeline.query(
-            question=request.question,
-            top_k=request.top_k
+        loop = asyncio.get_running_loop()
+        answer = await loop.run_in_executor(
+            rag_executor, _run_query, trace, request.question, request.top_k, request.session_id, request.mode,
+            request.kbs
         )
+        trace.finish()
+        response.headers["Server-Timing"] = trace.server_timing()
         
         return QueryResponse(
             question=request.question,
             answer=answer,
-            sources_count=request.top_k
+            sources_count=trace.attrs.get("sources", 0),
+            timings=trace.timings(),
+            answer_mode=trace.attrs.get("answer_mode"),
+            missing_shards=trace.attrs.get("missing_shards", []),
+            missing_kbs=trace.attrs.get("missing_kbs", [])
         )
     
     except Exception as e:
+        trace.attrs["error"] = type(e).__name__
+        trace.finish()
+        metrics.ERRORS.labels(stage="api", type=type(e).__name__).inc()
         raise HTTPException(
             status_code=500,
             detail=f"Ошибка при обработке запроса: {str(e)}"
         )
+    
+    finally:
+        in_flight.dec()
+
+def _search_fingerprint(query: str, categories: Optional[List[str]], kbs: Optional[List[str]] = None) -> str:
+    kb_parts = ["|", *sorted(kbs)] if kbs else []
+    return make_key(query, *sorted(c.lower() for c in categories or []), *kb_parts)[:16]
+
+def _encode_cursor(version: str, offset: int, fingerprint: str) -> str:
+    raw = json.dumps({"v": version, "o": offset, "f": fingerprint}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def _decode_cursor(cursor: str, fingerprint: str) -> Tuple[str, int]:
+    """Версия индекса и смещение из курсора; 400 - курсор от другого поиска"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        version, offset = str(data["v"]), int(data["o"])
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    if data.get("f") != fingerprint or offset < 0:
+        raise HTTPException(status_code=400, detail="Курсор относится к другому запросу")
+    return version, offset
+
+def _search_hit(doc: Dict) -> SearchHit:
+    return SearchHit(
+        id=str(doc.get("id") or f"{doc.get('source_url') or doc.get('url', '')}#{doc.get('chunk_id', '')}"),
+        chunk_id=doc.get("chunk_id"),
+        rank=doc["rank"],
+        score=round(float(doc.get("score", 0.0)), 6),
+        title=doc.get("title", "Без заголовка"),
+        text=doc.get("content") or doc.get("text", ""),
+        source_url=doc.get("source_url") or doc.get("url", ""),
+        category=str(doc.get("category", "")),
+        kb=doc.get("kb"),
+    )
+
+def _run_search(
+    trace: "tracing.Trace", queries: List[str], offset: int, limit: int,
+    categories: Optional[List[str]], kbs: Optional[List[str]]
+):
+    """Поиск в рабочем потоке (трасса активируется в этом потоке)"""
+    with tracing.activate(trace):
+        return rag_pipeline.search_page(queries, offset, limit, categories, kbs)
+
+async def _search(
+    trace: "tracing.Trace", queries: List[str], offset: int, limit: int,
+    categories: Optional[List[str]], kbs: Optional[List[str]] = None
+):
+    if rag_pipeline is None:
+        raise HTTPException(status_code=503, detail="RAG-система не инициализирована")
+    _check_kbs(kbs)
+    in_flight = metrics.REQUESTS_IN_FLIGHT.labels(source="search")
+    in_flight.inc()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(rag_executor, _run_search, trace, queries, offset, limit, categories, kbs)
+    except Exception as e:
+        trace.attrs["error"] = type(e).__name__
+        metrics.ERRORS.labels(stage="api.search", type=type(e).__name__).inc()
+        raise HTTPException(status_code=500, detail=f"Ошибка поиска: {str(e)}")
+    finally:
+        trace.finish()
+        in_flight.dec()
+
+@app.post("/search", response_model=SearchResponse)
+async def search(request: SearchRequest, response: Response):
+    """
+    Поиск фрагментов базы знаний без генерации ответа
+    
+    Возвращает чанки с оценками по убыванию релевантности; следующая
+    страница - тот же запрос с `cursor` = `next_cursor`. Если индекс
+    обновился между страницами, курсор устаревает (409).
+    """
+    fingerprint = _search_fingerprint(request.query, request.categories, request.kbs)
+    version, offset = None, 0
+    if request.cursor:
+        version, offset = _decode_cursor(request.cursor, fingerprint)
+    if offset + request.limit > SEARCH_MAX_DEPTH:
+        raise HTTPException(status_code=400, detail=f"Глубже {SEARCH_MAX_DEPTH} результатов поиск не листается")
+    
+    trace = tracing.Trace("api.search")
+    pages, has_more, index_version = await _search(
+        trace, [request.query], offset, request.limit, request.categories, request.kbs
+    )
+    if version is not None and version != index_version:
+        raise HTTPException(status_code=409, detail="Индекс обновился - начните поиск с первой страницы")
+    response.headers["Server-Timing"] = trace.server_timing()
+    
+    next_offset = offset + request.limit
+    return SearchResponse(
+        query=request.query,
+        hits=[_search_hit(doc) for doc in pages[0]],
+        next_cursor=(
+            _encode_cursor(index_version, next_offset, fingerprint)
+            if has_more[0] and next_offset < SEARCH_MAX_DEPTH else None
+        ),
+        index_version=index_version,
+        timings=trace.timings(),
+        missing_shards=trace.attrs.get("missing_shards", []),
+        missing_kbs=trace.attrs.get("missing_kbs", []),
+    )
+
+@app.post("/search/batch", response_model=BatchSearchResponse)
+async def search_batch(request: BatchSearchRequest, response: Response):
+    """Первые страницы поиска по нескольким вопросам: одно кодирование и один проход индекса"""
+    trace = tracing.Trace("api.search_batch")
+    pages, has_more, index_version = await _search(
+        trace, request.queries, 0, request.limit, request.categories, request.kbs
+    )
+    response.headers["Server-Timing"] = trace.server_timing()
+    return BatchSearchResponse(
+        results=[
+            SearchResponse(
+                query=query,
+                hits=[_search_hit(doc) for doc in page],
+                next_cursor=(
+                    _encode_cursor(
+                        index_version, request.limit, _search_fingerprint(query, request.categories, request.kbs)
+                    )
+                    if more and request.limit < SEARCH_MAX_DEPTH else None
+                ),
+                index_version=index_version,
+            )
+            for query, page, more in zip(request.queries, pages, has_more)
+        ],
+        index_version=index_version,
+        timings=trace.timings(),
+        missing_shards=trace.attrs.get("missing_shards", []),
+        missing_kbs=trace.attrs.get("missing_kbs", []),
+    )
+
+def _check_admin(token: Optional[str]):
+    """Доступ к /admin/* только с ADMIN_TOKEN"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Админ-эндпоинты отключены (ADMIN_TOKEN не задан)")
+    if token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Неверный токен администратора")
+    if rag_pipeline is None or rag_pipeline.index_manager is None:
+        raise HTTPException(status_code=503, detail="Индекс не загружен в этом процессе")
+
+@app.get("/admin/index")
+async def index_status(x_admin_token: Optional[str] = Header(default=None)):
+    """Текущая и предыдущая версии индекса"""
+    _check_admin(x_admin_token)
+    return rag_pipeline.index_manager.status()
+
+@app.post("/admin/index/reload")
+async def index_reload(force: bool = False, x_admin_token: Optional[str] = Header(default=None)):
+    """Загрузить новую версию индекса в фоне и подменить после проверки"""
+    _check_admin(x_admin_token)
+    started = rag_pipeline.index_manager.reload_async(force=force)
+    return {"started": started, **rag_pipeline.index_manager.status()}
+
+@app.post("/admin/index/rollback")
+async def index_rollback(x_admin_token: Optional[str] = Header(default=None)):
+    """Вернуть предыдущую версию индекса"""
+    _check_admin(x_admin_token)
+    if not rag_pipeline.index_manager.rollback():
+        raise HTTPException(status_code=409, detail="Нет предыдущей версии для отката")
+    return rag_pipeline.index_manager.status()
+
+@app.get("/admin/kbs")
+async def kbs_status(x_admin_token: Optional[str] = Header(default=None)):
+    """Базы знаний: загружены ли, версии, оценка памяти и бюджет"""
+    _check_admin(x_admin_token)
+    return rag_pipeline.kbs.status()
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(
+    request: Request,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(default=None),
+):
+    """Приём апдейтов Telegram (режим webhook)"""
+    if telegram_app is None:
+        raise HTTPException(status_code=404, detail="Telegram webhook не включён")
+    if x_telegram_bot_api_secret_token != TELEGRAM_WEBHOOK_SECRET:
+        raise HTTPException(status_code=403, detail="Неверный секрет webhook")
+    
+    from telegram import Update
+    update = Update.de_json(await request.json(), telegram_app.bot)
+    # Обработка идёт в фоне, Telegram сразу получает 200
+    await telegram_app.update_queue.put(update)
+    return {"ok": True}
 
 # Запуск: uvicorn api:app --reload --host 0.0.0.0 --port 8000
 if __name__ == "__main__":
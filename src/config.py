@@ -23,14 +23,168 @@ PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
 # Обновлённые названия моделей Perplexity (декабрь 2024)
 PPLX_MODEL_GENERAL = os.getenv("PPLX_MODEL_GENERAL", "sonar")
 PPLX_MODEL_STRICT = os.getenv("PPLX_MODEL_STRICT", "sonar")
+# Адрес API (можно направить на локальную заглушку для нагрузочных тестов)
+PPLX_API_URL = os.getenv("PPLX_API_URL", "https://api.perplexity.ai/chat/completions")
+
+# Бэкенд LLM: perplexity, openai (любой OpenAI-совместимый сервер -
+# llama.cpp, vLLM) или fake (детерминированная заглушка без сети)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "perplexity")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "http://127.0.0.1:8080/v1")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "local")
+OPENAI_MODEL_STRICT = os.getenv("OPENAI_MODEL_STRICT", "")
+OPENAI_RATE_LIMIT_RPM = float(os.getenv("OPENAI_RATE_LIMIT_RPM", "0"))
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "300"))
+FAKE_LLM_TOKENS_PER_S = float(os.getenv("FAKE_LLM_TOKENS_PER_S", "50"))
+
+# Политики вызова LLM (src/llm_policy.py): таймаут запроса, повторы 429/5xx
+# с экспоненциальной задержкой (бюджет повторов - доля от числа запросов),
+# лимит запросов в минуту по квоте Perplexity (0 - без лимита), автомат
+# отключения после N ошибок подряд, хеджирование медленных запросов
+# (задержка 0 - p95 последних запросов)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_MS = float(os.getenv("LLM_RETRY_BASE_MS", "250"))
+LLM_RETRY_MAX_MS = float(os.getenv("LLM_RETRY_MAX_MS", "4000"))
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.2"))
+LLM_RATE_LIMIT_RPM = float(os.getenv("LLM_RATE_LIMIT_RPM", "50"))
+LLM_RATE_LIMIT_BURST = int(os.getenv("LLM_RATE_LIMIT_BURST", "10"))
+LLM_RATE_LIMIT_WAIT_S = float(os.getenv("LLM_RATE_LIMIT_WAIT_S", "10"))
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+LLM_CIRCUIT_RESET_S = float(os.getenv("LLM_CIRCUIT_RESET_S", "30"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_DELAY_MS = float(os.getenv("LLM_HEDGE_DELAY_MS", "0"))
+
+# Одинаковые одновременные запросы к LLM (тот же вопрос и контекст)
+# объединяются в один вызов
+LLM_COALESCE = os.getenv("LLM_COALESCE", "1") == "1"
 
 # Параметры RAG
 CHUNK_SIZE = 800
 CHUNK_OVERLAP = 200
 TOP_K_DOCUMENTS = 6
 
-# Embedding модель
-EMBEDDING_MODEL = "intfloat/multilingual-e5-large"
+# Маршруты генерации по категориям (src/routing.py): JSON с переопределениями
+# таблицы и порог длины (в словах), после которого вопрос считается сложным
+ROUTING_TABLE_PATH = os.getenv("ROUTING_TABLE_PATH", str(DATA_DIR / "routing.json"))
+ROUTE_COMPLEX_WORDS = int(os.getenv("ROUTE_COMPLEX_WORDS", "25"))
+
+# Кандидатов для MMR (src/diversify.py): top_k маршрута × фактор
+MMR_FETCH_FACTOR = int(os.getenv("MMR_FETCH_FACTOR", "3"))
+
+# Таблицы ключевых слов (категории, тема, безопасность; src/keywords.py) -
+# JSON с переопределениями групп
+KEYWORDS_PATH = os.getenv("KEYWORDS_PATH", str(DATA_DIR / "keywords.json"))
+
+# Классификатор категорий по эмбеддингу вопроса (src/intent_classifier.py):
+# центроиды из train_classifier.py, порог уверенности, ниже которого решают
+# ключевые слова и LLM, температура softmax и разрешение вызывать LLM
+CLASSIFIER_PATH = os.getenv("CLASSIFIER_PATH", str(DATA_DIR / "category_centroids.npz"))
+CLASSIFIER_MIN_CONFIDENCE = float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", "0.6"))
+CLASSIFIER_TEMPERATURE = float(os.getenv("CLASSIFIER_TEMPERATURE", "0.05"))
+CLASSIFIER_LLM_FALLBACK = os.getenv("CLASSIFIER_LLM_FALLBACK", "1") == "1"
+
+# Режим ответа по умолчанию: llm или extractive (src/extractive.py - предложения
+# из найденных чанков без LLM); при ошибке LLM или если она не ответила за
+# LLM_ANSWER_DEADLINE_S (0 - не ограничивать) отдаётся извлекающий ответ
+ANSWER_MODE = os.getenv("ANSWER_MODE", "llm")
+EXTRACTIVE_FALLBACK = os.getenv("EXTRACTIVE_FALLBACK", "1") == "1"
+EXTRACTIVE_MAX_SENTENCES = int(os.getenv("EXTRACTIVE_MAX_SENTENCES", "5"))
+LLM_ANSWER_DEADLINE_S = float(os.getenv("LLM_ANSWER_DEADLINE_S", "0"))
+
+# /search: максимум результатов на страницу, глубина пагинации (offset + limit),
+# вопросов в пакетном запросе и во сколько раз больше кандидатов брать при фильтре
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "50"))
+SEARCH_MAX_DEPTH = int(os.getenv("SEARCH_MAX_DEPTH", "200"))
+SEARCH_MAX_BATCH = int(os.getenv("SEARCH_MAX_BATCH", "32"))
+SEARCH_FILTER_OVERFETCH = int(os.getenv("SEARCH_FILTER_OVERFETCH", "4"))
+
+# Бюджет контекста для LLM (в токенах) и грубая оценка символов на токен
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv("CONTEXT_CHARS_PER_TOKEN", "3.5"))
+
+# Трассировка: JSON-лог трасс в stdout и (опционально) OTLP-коллектор
+TRACE_LOG = os.getenv("TRACE_LOG", "1") == "1"
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+
+# Память диалога: сессий в памяти, последних ходов на сессию, лимит памяти,
+# бюджет сводки старых ходов; DIALOG_DB_PATH - файл SQLite (пусто - только память)
+DIALOG_MAX_SESSIONS = int(os.getenv("DIALOG_MAX_SESSIONS", "10000"))
+DIALOG_MAX_TURNS = int(os.getenv("DIALOG_MAX_TURNS", "4"))
+DIALOG_MEMORY_MB = float(os.getenv("DIALOG_MEMORY_MB", "64"))
+DIALOG_SUMMARY_TOKENS = int(os.getenv("DIALOG_SUMMARY_TOKENS", "300"))
+DIALOG_DB_PATH = os.getenv("DIALOG_DB_PATH", "")
+
+# Пул потоков для блокирующих RAG-запросов (общий для API и бота в режиме webhook)
+RAG_WORKER_THREADS = int(os.getenv("RAG_WORKER_THREADS", "8"))
+
+# Граф этапов агентов (src/stage_graph.py, src/agents.py): потоки для
+# параллельных этапов (у необязательных - свой пул) и сколько ждать
+# необязательную классификацию (мс); не успела - ответ строится по маршруту «другое»
+STAGE_GRAPH_THREADS = int(os.getenv("STAGE_GRAPH_THREADS", "8"))
+STAGE_GRAPH_OPTIONAL_THREADS = int(os.getenv("STAGE_GRAPH_OPTIONAL_THREADS", "4"))
+AGENT_CLASSIFY_BUDGET_MS = float(os.getenv("AGENT_CLASSIFY_BUDGET_MS", "1500"))
+
+# Поиск: inprocess (по умолчанию) или remote - отдельный процесс
+# python -m src.retrieval_service, доступный по Unix-сокету
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "inprocess")
+RETRIEVAL_SOCKET = os.getenv("RETRIEVAL_SOCKET", "/tmp/3dpa-retrieval.sock")
+# Пакетирование в сервисе поиска: максимум вопросов в пакете и ожидание пакета
+RETRIEVAL_BATCH_SIZE = int(os.getenv("RETRIEVAL_BATCH_SIZE", "32"))
+RETRIEVAL_BATCH_WAIT_MS = float(os.getenv("RETRIEVAL_BATCH_WAIT_MS", "2"))
+
+# Число процессов-воркеров в режиме python -m src.serve (0 - по числу ядер)
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "0"))
+
+# Telegram: polling (отдельный процесс бота) или webhook (апдейты приходят в API)
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "polling")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+
+# Embedding модель (по умолчанию; индекс хранит свою модель в manifest.json)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
+
+# Бэкенд векторного поиска: auto (FAISS, если установлен, иначе NumPy), faiss
+# или numpy (src/vector_index.py). NumPy читает vectors.npy через memory-map,
+# а без него - сам index.faiss (IndexFlat). VECTOR_DTYPE - тип матрицы при
+# сохранении vectors.npy: float16 вдвое меньше на диске и в памяти, но каждый
+# поиск приводит блоки к float32 (на 100k векторов ~80 мс против ~16 мс, см.
+# benchmarks/bench_vector_index.py); NUMPY_SEARCH_BLOCK - строк на одно умножение
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "auto")
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float32")
+NUMPY_SEARCH_BLOCK = int(os.getenv("NUMPY_SEARCH_BLOCK", "4096"))
+
+# Бюджет потоков CPU (src/thread_budget.py): пресет serving (API, бот, сервис
+# поиска - по потоку на эмбеддинг/поиск, одновременных операций по числу ядер)
+# или build (одна операция на все ядра); build_index.py всегда использует build.
+# CPU_THREADS - ядер на всё приложение (0 - доступные процессу, делятся между
+# воркерами), INTRA_OP_THREADS - потоков на операцию вместо пресета (0 - по
+# пресету), COMPUTE_SLOTS - одновременных эмбеддингов/поисков в процессе (0 -
+# ядра / потоки на операцию); сравнение настроек - benchmarks/bench_threads.py
+THREAD_PRESET = os.getenv("THREAD_PRESET", "serving")
+CPU_THREADS = int(os.getenv("CPU_THREADS", "0"))
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", "0"))
+COMPUTE_SLOTS = int(os.getenv("COMPUTE_SLOTS", "0"))
+
+# Шарды индекса (src/sharding.py, каталоги data/faiss_index/shards/<имя>):
+# сколько ждать ответа процесса шарда (не ответил - результат без него) и
+# сколько ждать загрузки процесса шарда при старте
+SHARD_TIMEOUT_MS = float(os.getenv("SHARD_TIMEOUT_MS", "500"))
+SHARD_START_TIMEOUT_S = float(os.getenv("SHARD_START_TIMEOUT_S", "60"))
+
+# Базы знаний (src/kb_registry.py): основная (wiki) - data/faiss_index, прочие -
+# каталоги KB_DIR/<имя> того же формата (руководства производителей, runbooks).
+# Базы загружаются при первом обращении; когда оценка занятой памяти (векторы,
+# чанки, предыдущая версия) превышает KB_MEMORY_BUDGET_MB, выгружаются давно
+# не использованные (основная - никогда; 0 - без ограничения)
+KB_DIR = Path(os.getenv("KB_DIR", str(DATA_DIR / "kbs")))
+DEFAULT_KB = os.getenv("DEFAULT_KB", "wiki")
+KB_MEMORY_BUDGET_MB = float(os.getenv("KB_MEMORY_BUDGET_MB", "2048"))
+
+# Горячая замена индекса: период проверки data/faiss_index (0 - только вручную)
+# и токен для /admin/* эндпоинтов (пусто - эндпоинты отключены)
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "0"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
 # Проверка ключа API
 if not PERPLEXITY_API_KEY:
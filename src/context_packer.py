@@ -0,0 +1,162 @@
+"""
+Упаковка контекста для LLM с бюджетом токенов
+"""
+import re
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional
+
+try:
+    from .config import CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN
+except ImportError:
+    from src.config import CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?…])\s+|\n+")
+_WORD = re.compile(r"[\w-]+", re.UNICODE)
+
+# Длина «основы» слова для грубого сравнения словоформ (PLA / пластика / пластиком)
+_STEM_LEN = 5
+
+# Обрывок предложения короче этого числа слов не сверяется с уже взятыми
+# предложениями по вхождению - иначе пропадали бы короткие самостоятельные фразы
+_MIN_FRAGMENT_WORDS = 3
+
+
+@dataclass
+class PackedContext:
+    """Результат упаковки: текст контекста и документы, попавшие в него"""
+    text: str
+    documents: List[Dict[str, Any]] = field(default_factory=list)
+    used_tokens: int = 0
+    budget: int = 0
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка числа токенов без токенизатора (по числу символов)"""
+    if not text:
+        return 0
+    return max(1, round(len(text) / CONTEXT_CHARS_PER_TOKEN))
+
+
+def _stems(text: str) -> set:
+    return {w[:_STEM_LEN] for w in _WORD.findall(text.lower()) if len(w) > 2}
+
+
+def _split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_SPLIT.split(text) if s and s.strip()]
+
+
+def _normalize(sentence: str) -> str:
+    return " ".join(_WORD.findall(sentence.lower()))
+
+
+def _is_covered(key: str, seen: set) -> bool:
+    """
+    Предложение уже есть в контексте
+
+    Перекрывающиеся чанки режутся посреди предложения: начало следующего чанка -
+    обрывок предложения из предыдущего. Такой обрывок отбрасывается, если его
+    слова подряд входят в уже взятое предложение.
+    """
+    if key in seen:
+        return True
+    if key.count(" ") + 1 < _MIN_FRAGMENT_WORDS:
+        return False
+    padded = f" {key} "
+    return any(padded in f" {other} " for other in seen)
+
+
+def _doc_text(doc: Dict[str, Any]) -> str:
+    return doc.get('content') or doc.get('text') or ""
+
+
+def _doc_meta(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return doc.get('metadata') or doc
+
+
+def pack_context(
+    query: str,
+    documents: List[Dict[str, Any]],
+    token_budget: Optional[int] = None,
+) -> PackedContext:
+    """
+    Жадная упаковка чанков в бюджет токенов
+
+    Чанки обрабатываются по убыванию `score`. Из каждого чанка берутся
+    предложения, пересекающиеся с запросом (самые релевантные первыми, но в
+    исходном порядке в тексте), предложения, уже попавшие в контекст из
+    перекрывающихся чанков (целиком или обрывком), отбрасываются. Один чанк
+    занимает не больше трети бюджета.
+
+    Args:
+        query: Вопрос пользователя
+        documents: Чанки с полями content/text, title, source_url/url и score
+        token_budget: Бюджет токенов (по умолчанию CONTEXT_TOKEN_BUDGET)
+
+    Returns:
+        PackedContext с текстом контекста и использованными документами
+    """
+    budget = token_budget or CONTEXT_TOKEN_BUDGET
+    query_stems = _stems(query)
+    # Один длинный документ не должен съедать весь бюджет
+    per_doc_budget = budget // max(1, min(len(documents), 3))
+
+    ranked = sorted(
+        enumerate(documents),
+        key=lambda item: (-float(item[1].get('score', 0.0)), item[0])
+    )
+
+    seen = set()
+    parts = []
+    used_docs = []
+    used = 0
+
+    for _, doc in ranked:
+        if used >= budget:
+            break
+
+        meta = _doc_meta(doc)
+        header = f"[{len(parts) + 1}] {meta.get('title', 'Без заголовка')} ({meta.get('source_url') or meta.get('url') or 'N/A'})"
+        header_tokens = estimate_tokens(header)
+        if used + header_tokens >= budget:
+            break
+
+        sentences = []
+        for sentence in _split_sentences(_doc_text(doc)):
+            key = _normalize(sentence)
+            if not key or _is_covered(key, seen):
+                continue
+            overlap = len(query_stems & _stems(sentence))
+            sentences.append((overlap, sentence, key))
+
+        if not sentences:
+            continue
+
+        # Если ни одно предложение не пересекается с запросом - берём начало чанка
+        relevant = [s for s in sentences if s[0] > 0] or sentences
+        # Сначала самые релевантные предложения, в тексте - исходный порядок
+        order = sorted(range(len(relevant)), key=lambda i: (-relevant[i][0], i))
+
+        picked = []
+        chunk_tokens = header_tokens
+        for i in order:
+            _, sentence, key = relevant[i]
+            cost = estimate_tokens(sentence)
+            if used + chunk_tokens + cost > budget or chunk_tokens + cost > per_doc_budget:
+                continue
+            picked.append(i)
+            seen.add(key)
+            chunk_tokens += cost
+
+        if not picked:
+            continue
+
+        parts.append(header + "\n" + " ".join(relevant[i][1] for i in sorted(picked)))
+        used_docs.append(doc)
+        used += chunk_tokens
+
+    return PackedContext(
+        text="\n\n".join(parts),
+        documents=used_docs,
+        used_tokens=used,
+        budget=budget,
+    )
@@ -0,0 +1,371 @@
+"""
+Память диалога: компактная история по сессиям с LRU-вытеснением
+"""
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, asdict
+from typing import Optional, List, Dict, Any, Tuple, Deque
+
+try:
+    from .config import (
+        DIALOG_MAX_SESSIONS,
+        DIALOG_MAX_TURNS,
+        DIALOG_MEMORY_MB,
+        DIALOG_SUMMARY_TOKENS,
+        DIALOG_DB_PATH,
+    )
+    from .context_packer import estimate_tokens
+except ImportError:
+    from src.config import (
+        DIALOG_MAX_SESSIONS,
+        DIALOG_MAX_TURNS,
+        DIALOG_MEMORY_MB,
+        DIALOG_SUMMARY_TOKENS,
+        DIALOG_DB_PATH,
+    )
+    from src.context_packer import estimate_tokens
+
+_WORD = re.compile(r"[\w-]+", re.UNICODE)
+_STEM_LEN = 5
+
+# Служебные слова, не несущие темы вопроса
+_STOP_WORDS = {
+    "а", "и", "но", "или", "для", "как", "что", "это", "его", "её", "ее", "их", "там",
+    "тут", "так", "ли", "же", "ещё", "еще", "если", "почему", "зачем", "какой", "какая",
+    "какие", "какую", "где", "когда", "можно", "нужно", "надо", "лучше", "тогда",
+    "подробнее", "поподробнее", "расскажи", "объясни", "то", "же", "с", "со", "на", "в", "по",
+}
+# Начала реплик, которые почти всегда продолжают предыдущую тему
+_FOLLOWUP_PREFIXES = ("а ", "и ", "а если", "а для", "а как", "а что", "а почему", "тогда ", "ещё ", "еще ")
+# Местоимения и слова-отсылки к предыдущему ходу
+_FOLLOWUP_MARKERS = {
+    "это", "этот", "эта", "эти", "этого", "этой", "этом", "этим", "этому",
+    "он", "она", "оно", "они", "его", "её", "ее", "их", "него", "неё", "нее", "них", "ним", "ней", "нём", "нем",
+    "там", "тогда", "тоже", "также", "подробнее", "поподробнее", "ещё", "еще",
+}
+# Короткий вопрос без собственной темы («почему?», «какая температура?»)
+_FOLLOWUP_MAX_WORDS = 5
+_FOLLOWUP_MAX_TERMS = 1
+
+# Сколько символов вопроса и ответа хранится в компактном виде
+_QUESTION_CHARS = 200
+_GIST_CHARS = 240
+
+
+def _content_stems(text: str) -> set:
+    return {
+        w[:_STEM_LEN] for w in _WORD.findall(text.lower())
+        if len(w) > 1 and w not in _STOP_WORDS
+    }
+
+
+def is_followup(question: str, previous_stems: set) -> bool:
+    """
+    Продолжает ли вопрос тему предыдущего хода
+
+    Продолжение - реплика с «а …», «и …», «тогда …», с местоимением или
+    отсылкой («почему это происходит?», «подробнее»), либо короткий вопрос,
+    в котором не больше одного значимого слова, и оно не из прошлого хода
+    («а PETG?», «какая температура?»). Короткий, но самостоятельный вопрос
+    («Как откалибровать стол принтера?») начинает новую тему.
+    """
+    q = question.lower().strip()
+    if q.startswith(_FOLLOWUP_PREFIXES):
+        return True
+    words = _WORD.findall(q)
+    if any(w in _FOLLOWUP_MARKERS for w in words):
+        return True
+    terms = _content_stems(q)
+    return len(words) <= _FOLLOWUP_MAX_WORDS and len(terms - previous_stems) <= _FOLLOWUP_MAX_TERMS
+
+
+def _gist(answer: str) -> str:
+    """Первые предложения ответа без блока источников"""
+    text = answer.split("📚 Источники:")[0].strip()
+    text = " ".join(text.split())
+    return text[:_GIST_CHARS]
+
+
+@dataclass
+class Turn:
+    """
+    Компактная запись одного хода диалога
+
+    `topic` - вопрос, с которого началась тема (у продолжения - вопрос
+    первого хода темы): им дополняются следующие уточнения, без вложенных
+    скобок. `stems` - основы слов всей темы.
+    """
+    question: str
+    gist: str
+    category: str
+    stems: List[str]
+    topic: str = ""
+    at: float = field(default_factory=time.time)
+
+
+@dataclass
+class DialogSession:
+    turns: Deque[Turn] = field(default_factory=deque)
+    summary: List[str] = field(default_factory=list)
+    # Результаты поиска последнего хода (для повторного использования)
+    last_documents: List[Dict[str, Any]] = field(default_factory=list)
+    size: int = 0
+    # updated_at строки SQLite, с которой совпадает эта копия (0 - не сохранялась)
+    synced_at: float = 0.0
+
+    def estimate_size(self) -> int:
+        """Грубая оценка памяти сессии в байтах"""
+        size = sys.getsizeof(self)
+        for t in self.turns:
+            size += (len(t.question) + len(t.gist) + len(t.topic)) * 2 + 16 * len(t.stems) + 200
+        size += sum(len(s) * 2 for s in self.summary)
+        # Документы - поверхностные копии записей базы знаний: тексты общие,
+        # считаем только сами словари
+        size += sum(sys.getsizeof(d) for d in self.last_documents)
+        self.size = size
+        return size
+
+    def to_json(self) -> str:
+        # Документы сохраняются вместе с ходами: уточнение может прийти после
+        # перезапуска или в другой воркер, и повторное использование поиска
+        # не должно от этого пропадать
+        return json.dumps({
+            "turns": [asdict(t) for t in self.turns],
+            "summary": self.summary,
+            "last_documents": self.last_documents,
+        }, ensure_ascii=False, default=_json_default)
+
+    @classmethod
+    def from_json(cls, data: str) -> "DialogSession":
+        raw = json.loads(data)
+        return cls(
+            turns=deque(Turn(**t) for t in raw.get("turns", [])),
+            summary=raw.get("summary", []),
+            last_documents=raw.get("last_documents", []),
+        )
+
+
+def _json_default(value: Any) -> Any:
+    """Скаляры numpy (score из FAISS) -> числа Python"""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class DialogMemory:
+    """
+    История диалогов с ограничением памяти
+
+    - у сессии хранится не больше `max_turns` последних ходов в компактном
+      виде (обрезанный вопрос, суть ответа, категория, основы слов);
+    - более старые ходы сворачиваются в краткую сводку, ограниченную
+      `summary_tokens` токенами;
+    - сессии вытесняются по LRU при превышении `max_sessions` или `memory_mb`;
+    - при заданном `db_path` история дублируется в SQLite и переживает
+      перезапуск (кэш в памяти остаётся ограниченным).
+
+    Один файл SQLite могут делить несколько процессов (воркеры src.serve):
+    перед использованием сессия из кэша сверяется с updated_at в базе и
+    перечитывается, если её изменил другой процесс. Соединение открывается
+    в каждом процессе заново (после fork - своё).
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = DIALOG_MAX_SESSIONS,
+        max_turns: int = DIALOG_MAX_TURNS,
+        memory_mb: float = DIALOG_MEMORY_MB,
+        summary_tokens: int = DIALOG_SUMMARY_TOKENS,
+        db_path: str = DIALOG_DB_PATH,
+    ):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_bytes = int(memory_mb * 1024 * 1024)
+        self.summary_tokens = summary_tokens
+        self._sessions: "OrderedDict[str, DialogSession]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.db_path = db_path
+        self._conn = None
+        self._conn_pid = 0
+
+    @property
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """Соединение SQLite текущего процесса (открывается при первом обращении)"""
+        if not self.db_path:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            # WAL: читатели из других процессов не ждут писателя
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS dialog_sessions "
+                "(session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _get(self, session_id: str, create: bool = False) -> Optional[DialogSession]:
+        session = self._sessions.get(session_id)
+        db = self._db
+        if session is not None:
+            if db is None or self._is_fresh(db, session_id, session):
+                self._sessions.move_to_end(session_id)
+                return session
+            # Сессию изменил другой процесс - перечитываем
+            del self._sessions[session_id]
+            self._total_bytes -= session.size
+            session = None
+        if db is not None:
+            row = db.execute(
+                "SELECT data, updated_at FROM dialog_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row:
+                session = DialogSession.from_json(row[0])
+                session.synced_at = row[1]
+        if session is None and create:
+            session = DialogSession()
+        if session is not None:
+            self._sessions[session_id] = session
+            self._total_bytes += session.estimate_size()
+            self._evict()
+        return session
+
+    @staticmethod
+    def _is_fresh(db: sqlite3.Connection, session_id: str, session: DialogSession) -> bool:
+        row = db.execute(
+            "SELECT updated_at FROM dialog_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return (row[0] if row else 0.0) == session.synced_at
+
+    def _evict(self):
+        while self._sessions and (
+            len(self._sessions) > self.max_sessions or self._total_bytes > self.max_bytes
+        ):
+            _, session = self._sessions.popitem(last=False)
+            self._total_bytes -= session.size
+
+    def _followup_session(self, session_id: str, question: str) -> Optional[DialogSession]:
+        """Сессия, если сообщение похоже на продолжение её последнего вопроса (под блокировкой)"""
+        session = self._get(session_id)
+        if not session or not session.turns:
+            return None
+        if is_followup(question, set(session.turns[-1].stems)):
+            return session
+        return None
+
+    def rewrite_query(self, session_id: str, question: str) -> Tuple[str, bool]:
+        """
+        Переписать уточняющий вопрос для поиска
+
+        «а для PETG?» после «какая температура стола для PLA?» превращается в
+        «а для PETG? (какая температура стола для PLA?)»; следующее уточнение
+        дополняется тем же вопросом, с которого началась тема.
+
+        Returns:
+            (запрос для поиска, является ли вопрос продолжением)
+        """
+        with self._lock:
+            session = self._followup_session(session_id, question)
+            if session is None:
+                return question, False
+            previous = session.turns[-1]
+        return f"{question} ({previous.topic or previous.question})", True
+
+    def reusable_documents(self, session_id: str, question: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Результаты поиска прошлого хода, если тема не поменялась
+
+        Тема считается прежней, если вопрос - продолжение и не добавляет
+        новых значимых слов («а почему?», «подробнее про температуру»).
+        """
+        with self._lock:
+            session = self._followup_session(session_id, question)
+            if session is None or not session.last_documents:
+                return None
+            if _content_stems(question) - set(session.turns[-1].stems):
+                return None
+            return [d.copy() for d in session.last_documents]
+
+    def context(self, session_id: str) -> str:
+        """Контекст диалога для промпта: сводка старых ходов и последние ходы"""
+        with self._lock:
+            session = self._get(session_id)
+            if not session:
+                return ""
+            lines = list(session.summary)
+            lines += [f"Вопрос: {t.question}\nОтвет: {t.gist}" for t in session.turns]
+        return "\n".join(lines)
+
+    def add_turn(
+        self,
+        session_id: str,
+        question: str,
+        answer: str,
+        category: str,
+        documents: Optional[List[Dict[str, Any]]] = None,
+    ):
+        """
+        Сохранить ход диалога
+
+        `question` - вопрос пользователя как есть (не переписанный
+        rewrite_query): продолжение наследует тему и слова прошлого хода.
+        """
+        question = " ".join(question.split())[:_QUESTION_CHARS]
+        stems = _content_stems(question)
+        turn = Turn(question=question, gist=_gist(answer), category=category, stems=[], topic=question)
+        with self._lock:
+            session = self._get(session_id, create=True)
+            if session.turns and is_followup(question, set(session.turns[-1].stems)):
+                previous = session.turns[-1]
+                turn.topic = previous.topic or previous.question
+                stems |= set(previous.stems)
+            turn.stems = sorted(stems)
+            old_size = session.size
+            session.turns.append(turn)
+            while len(session.turns) > self.max_turns:
+                self._fold(session, session.turns.popleft())
+            session.last_documents = [
+                {k: v for k, v in d.items() if k != 'embedding'} for d in (documents or [])
+            ]
+            self._total_bytes += session.estimate_size() - old_size
+            self._evict()
+            db = self._db
+            if db is not None:
+                session.synced_at = time.time()
+                db.execute(
+                    "INSERT OR REPLACE INTO dialog_sessions (session_id, data, updated_at) VALUES (?, ?, ?)",
+                    (session_id, session.to_json(), session.synced_at),
+                )
+                db.commit()
+
+    def _fold(self, session: DialogSession, turn: Turn):
+        """Свернуть старый ход в сводку, удерживая её в бюджете токенов"""
+        session.summary.append(f"Ранее: {turn.question} → {turn.gist[:_GIST_CHARS // 2]}")
+        while session.summary and sum(estimate_tokens(s) for s in session.summary) > self.summary_tokens:
+            session.summary.pop(0)
+
+    def reset(self, session_id: str):
+        """Забыть историю сессии"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._total_bytes -= session.size
+            db = self._db
+            if db is not None:
+                db.execute("DELETE FROM dialog_sessions WHERE session_id = ?", (session_id,))
+                db.commit()
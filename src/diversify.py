@@ -0,0 +1,115 @@
+"""
+Разнообразие найденных чанков: MMR и склейка соседних чанков статьи
+
+Чанки нарезаются с перекрытием, поэтому top-k FAISS часто состоит из
+соседних кусков одной статьи - токены контекста уходят на повторы.
+
+MMR (Maximal Marginal Relevance) выбирает из кандидатов по одному чанку,
+максимизируя λ·сходство с вопросом - (1-λ)·сходство с уже выбранными;
+λ=1 - обычный top-k, меньше - разнообразнее. Склейка объединяет выбранные
+соседние чанки одной статьи в один фрагмент без повтора перекрытия.
+Оба шага включаются в маршруте категории (mmr_lambda, merge_adjacent).
+"""
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+# Перекрытие чанков при нарезке (build_from_articles) не длиннее этого
+_MAX_OVERLAP = 400
+_MIN_OVERLAP = 10
+
+
+def _normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def mmr(query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """
+    Индексы k кандидатов в порядке выбора MMR (косинусное сходство)
+
+    Матрица сходства кандидатов считается одним умножением; на каждом шаге
+    обновляется только вектор максимального сходства с выбранными.
+    """
+    n = len(candidates)
+    if n == 0 or k <= 0:
+        return []
+    cand = _normalize_rows(np.asarray(candidates, dtype=np.float32))
+    relevance = cand @ _normalize_rows(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+    similarity = cand @ cand.T
+
+    selected = [int(np.argmax(relevance))]
+    max_sim = similarity[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_sim
+        scores[~available] = -np.inf
+        j = int(np.argmax(scores))
+        selected.append(j)
+        available[j] = False
+        np.maximum(max_sim, similarity[j], out=max_sim)
+    return selected
+
+
+def reconstruct(index: Any, ids: Sequence[int]) -> np.ndarray:
+    """Векторы чанков из FAISS по их номерам"""
+    ids = np.asarray(ids, dtype=np.int64)
+    if hasattr(index, "reconstruct_batch"):
+        return np.asarray(index.reconstruct_batch(ids), dtype=np.float32)
+    return np.vstack([index.reconstruct(int(i)) for i in ids]).astype(np.float32)
+
+
+def _join_overlapping(a: str, b: str) -> str:
+    """a + b без повтора перекрытия (конец a совпадает с началом b)"""
+    for n in range(min(len(a), len(b), _MAX_OVERLAP), _MIN_OVERLAP - 1, -1):
+        if a.endswith(b[:n]):
+            return a + b[n:]
+    return a + "\n" + b
+
+
+def merge_adjacent(documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Склейка соседних чанков одной статьи (chunk_id подряд) в один фрагмент
+
+    Фрагмент стоит на месте лучшего из своих чанков, его score - максимум,
+    номера чанков - в `chunk_ids`.
+    """
+    runs: Dict[int, List[int]] = {}
+    by_url: Dict[str, List[int]] = {}
+    for pos, doc in enumerate(documents):
+        if isinstance(doc.get("chunk_id"), int):
+            by_url.setdefault(doc.get("source_url", ""), []).append(pos)
+
+    for positions in by_url.values():
+        positions.sort(key=lambda p: documents[p]["chunk_id"])
+        run = [positions[0]]
+        for p in positions[1:]:
+            if documents[p]["chunk_id"] == documents[run[-1]]["chunk_id"] + 1:
+                run.append(p)
+            else:
+                if len(run) > 1:
+                    runs[min(run)] = run
+                run = [p]
+        if len(run) > 1:
+            runs[min(run)] = run
+
+    if not runs:
+        return documents
+
+    merged_away = {p for run in runs.values() for p in run}
+    result = []
+    for pos, doc in enumerate(documents):
+        if pos in runs:
+            run = runs[pos]
+            text = documents[run[0]].get("content", "")
+            for p in run[1:]:
+                text = _join_overlapping(text, documents[p].get("content", ""))
+            merged = dict(documents[run[0]])
+            merged["content"] = text
+            merged["score"] = max(float(documents[p].get("score", 0.0)) for p in run)
+            merged["chunk_ids"] = [documents[p]["chunk_id"] for p in run]
+            result.append(merged)
+        elif pos not in merged_away:
+            result.append(doc)
+    return result
@@ -1,27 +1,43 @@
 """
 Упрощённая версия с FAISS вместо ChromaDB
+
+FAISS необязателен: без него индекс строится и читается через NumPy
+(src/vector_index.py). Рядом с index.faiss всегда пишется vectors.npy
+(VECTOR_DTYPE), чтобы ту же версию могли обслуживать образы без FAISS.
 """
 import json
 import os
 import pickle
+import time
+import uuid
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 import numpy as np
-import faiss
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sentence_transformers import SentenceTransformer
 
+try:
+    from .config import EMBEDDING_MODEL, VECTOR_DTYPE
+    from .vector_index import FAISS_FILE, VECTORS_FILE, NumpyIndex, load_vector_index, new_index
+    from .thread_budget import configure_torch
+except ImportError:
+    from src.config import EMBEDDING_MODEL, VECTOR_DTYPE
+    from src.vector_index import FAISS_FILE, VECTORS_FILE, NumpyIndex, load_vector_index, new_index
+    from src.thread_budget import configure_torch
+
 
 class EmbeddingsStoreFAISS:
-    """Векторное хранилище на базе FAISS"""
+    """Векторное хранилище на базе FAISS (или NumPy, если FAISS не установлен)"""
     
     def __init__(self, db_path: str = "data/faiss_index"):
         self.db_path = db_path
         Path(db_path).mkdir(parents=True, exist_ok=True)
         
         print("📦 Загружаем модель эмбеддингов...")
-        self.model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-        self.dimension = 384
+        self.model_name = EMBEDDING_MODEL
+        configure_torch()
+        self.model = SentenceTransformer(self.model_name)
+        self.dimension = self.model.get_sentence_embedding_dimension()
         
         self.index = None
         self.documents = []
@@ -32,6 +48,18 @@ class EmbeddingsStoreFAISS:
         with open(articles_path, 'r', encoding='utf-8') as f:
             articles = json.load(f)
         print(f"📄 Загружено {len(articles)} статей")
+        self.build_from_list(articles)
+    
+    def build_from_list(self, articles: List[Dict], db_path: Optional[str] = None):
+        """
+        Строит индекс из списка статей
+        
+        `db_path` - другой каталог (например, шард): модель загружается один
+        раз на все шарды.
+        """
+        if db_path is not None:
+            self.db_path = db_path
+            Path(db_path).mkdir(parents=True, exist_ok=True)
         
         if articles:
             print(f"🔍 Ключи первой статьи: {list(articles[0].keys())}")
@@ -72,7 +100,7 @@ class EmbeddingsStoreFAISS:
         texts = [c['text'] for c in chunks]
         embeddings = self.model.encode(texts, show_progress_bar=True)
         
-        self.index = faiss.IndexFlatL2(self.dimension)
+        self.index = new_index(self.dimension)
         self.index.add(np.array(embeddings).astype('float32'))
         
         self.documents = texts
@@ -85,18 +113,52 @@ class EmbeddingsStoreFAISS:
         print(f"✅ Индекс создан: {len(texts)} чанков")
     
     def save(self):
-        """Сохраняет индекс на диск"""
-        faiss.write_index(self.index, os.path.join(self.db_path, "index.faiss"))
-        with open(os.path.join(self.db_path, "documents.pkl"), 'wb') as f:
+        """
+        Сохраняет индекс на диск
+        
+        Файлы пишутся во временные и подменяются через os.replace, манифест -
+        последним: запущенный API (INDEX_WATCH_INTERVAL) видит новую версию
+        только после того, как все файлы на месте. index.faiss пишется, если
+        индекс построен FAISS, vectors.npy - всегда.
+        """
+        index_path = os.path.join(self.db_path, FAISS_FILE)
+        docs_path = os.path.join(self.db_path, "documents.pkl")
+        manifest_path = os.path.join(self.db_path, "manifest.json")
+        
+        if isinstance(self.index, NumpyIndex):
+            numpy_index = self.index
+        else:
+            import faiss
+            faiss.write_index(self.index, index_path + ".tmp")
+            numpy_index = NumpyIndex.from_faiss(self.index)
+        numpy_index.save(Path(self.db_path) / VECTORS_FILE, VECTOR_DTYPE)
+        with open(docs_path + ".tmp", 'wb') as f:
             pickle.dump((self.documents, self.metadatas), f)
+        with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({
+                "version": time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6],
+                "model": self.model_name,
+                "dimension": self.dimension,
+                "count": len(self.documents),
+                "vectors_dtype": VECTOR_DTYPE,
+                "built_at": time.time(),
+            }, f, ensure_ascii=False, indent=2)
+        
+        if os.path.exists(index_path + ".tmp"):
+            os.replace(index_path + ".tmp", index_path)
+        elif os.path.exists(index_path):
+            # index.faiss прошлой сборки устарел: иначе FAISS-сервер прочитал бы его
+            os.remove(index_path)
+        os.replace(docs_path + ".tmp", docs_path)
+        os.replace(manifest_path + ".tmp", manifest_path)
     
     def load(self):
-        """Загружает индекс с диска"""
-        index_path = os.path.join(self.db_path, "index.faiss")
+        """Загружает индекс с диска (FAISS или NumPy, см. VECTOR_BACKEND)"""
         docs_path = os.path.join(self.db_path, "documents.pkl")
         
-        if os.path.exists(index_path):
-            self.index = faiss.read_index(index_path)
+        index, _ = load_vector_index(Path(self.db_path))
+        if index is not None:
+            self.index = index
             with open(docs_path, 'rb') as f:
                 self.documents, self.metadatas = pickle.load(f)
             return True
@@ -104,16 +166,20 @@ class EmbeddingsStoreFAISS:
     
     def search(self, query: str, k: int = 3):
         """Поиск релевантных чанков"""
-        query_embedding = self.model.encode([query])[0]
+        return self.search_by_vector(self.model.encode([query])[0], k)
+    
+    def search_by_vector(self, query_embedding: np.ndarray, k: int = 3):
+        """Поиск по готовому эмбеддингу вопроса (той же моделью)"""
         distances, indices = self.index.search(
             np.array([query_embedding]).astype('float32'), k
         )
         
         results = []
-        for idx in indices[0]:
+        for idx, distance in zip(indices[0], distances[0]):
             results.append({
                 "text": self.documents[idx],
-                "metadata": self.metadatas[idx]
+                "metadata": self.metadatas[idx],
+                "score": 1.0 / (1.0 + float(distance))
             })
         return results
 
@@ -0,0 +1,195 @@
+"""
+Извлекающий ответ без LLM: предложения из найденных чанков и параметры печати
+
+Используется, когда LLM недоступна (ошибка, автомат отключения, лимит,
+превышение LLM_ANSWER_DEADLINE_S), и по запросу клиента (mode=extractive),
+которому важнее задержка, чем связный текст.
+
+Предложения чанков ранжируются по пересечению с вопросом (редкие слова
+весят больше), из них же извлекаются численные параметры: температуры,
+скорости, ретракт, высота слоя, обдув. Ответ собирается за миллисекунды.
+"""
+import math
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from .config import EXTRACTIVE_MAX_SENTENCES
+    from .context_packer import _split_sentences, _stems, _normalize, _doc_text, _doc_meta
+except ImportError:
+    from src.config import EXTRACTIVE_MAX_SENTENCES
+    from src.context_packer import _split_sentences, _stems, _normalize, _doc_text, _doc_meta
+
+_NUM = r"\d+(?:[.,]\d+)?"
+_RANGE = rf"{_NUM}(?:\s*(?:-|–|—|до)\s*{_NUM})?"
+
+# вид параметра -> (шаблон значения, единица, слова контекста в предложении)
+_PARAMETERS: Dict[str, Tuple["re.Pattern", str, Tuple[str, ...]]] = {
+    "температура": (
+        re.compile(rf"({_RANGE})\s*(?:[°˚]\s*[CcСс]?|℃|градус\w*)"),
+        "°C",
+        ("температур", "нагрев", "сопл", "стол", "экструдер", "°c", "°с", "˚c", "˚с", "℃", "градус"),
+    ),
+    "скорость": (re.compile(rf"({_RANGE})\s*(?:мм/с(?:ек)?|mm/s)", re.IGNORECASE), "мм/с", ()),
+    "ретракт": (re.compile(rf"({_RANGE})\s*(?:мм|mm)(?![/\w])", re.IGNORECASE), "мм", ("ретракт", "откат")),
+    "высота слоя": (re.compile(rf"({_RANGE})\s*(?:мм|mm)(?![/\w])", re.IGNORECASE), "мм", ("слой", "слоя", "слоев", "слоёв")),
+    "обдув": (re.compile(rf"({_RANGE})\s*%"), "%", ("обдув", "вентилятор", "кулер")),
+}
+
+# Основы слов вопроса -> какие параметры ему интересны
+_QUERY_PARAMETERS = {
+    "температур": ("температура",),
+    "нагрев": ("температура",),
+    "скорост": ("скорость",),
+    "ретракт": ("ретракт",),
+    "паутин": ("ретракт", "температура"),
+    "слой": ("высота слоя",),
+    "слоя": ("высота слоя",),
+    "обдув": ("обдув",),
+}
+
+# Вопросительные слова не говорят о содержании (основы по 5 букв, как в context_packer)
+_STOP_STEMS = {
+    "как", "какая", "какой", "какие", "каких", "какую", "для", "что", "чем", "это", "при",
+    "где", "почем", "зачем", "нужна", "нужен", "нужно", "можно", "или", "лучш", "лучше",
+}
+
+_MIN_SENTENCE, _MAX_SENTENCE = 25, 400
+MAX_PARAMETERS = 6
+
+
+@dataclass
+class Parameter:
+    """Численный параметр печати из предложения источника"""
+    kind: str
+    value: str
+    unit: str
+    source: int
+    detail: str = ""
+
+    @property
+    def label(self) -> str:
+        name = f"{self.kind} {self.detail}" if self.detail else self.kind
+        return f"{name.capitalize()}: {self.value} {self.unit} [{self.source}]"
+
+
+def extract_parameters(sentence: str, source: int = 0) -> List[Parameter]:
+    """Параметры печати, упомянутые в предложении"""
+    lower = sentence.lower()
+    found = []
+    for kind, (pattern, unit, context) in _PARAMETERS.items():
+        if context and not any(word in lower for word in context):
+            continue
+        for m in pattern.finditer(sentence):
+            value = re.sub(r"\s*(?:-|–|—|до)\s*", "–", m.group(1)).replace(",", ".")
+            detail = "стола" if kind == "температура" and "стол" in lower else ""
+            found.append(Parameter(kind, value, unit, source, detail))
+    return found
+
+
+def _doc_url(doc: Dict[str, Any]) -> str:
+    meta = _doc_meta(doc)
+    return meta.get('source_url') or meta.get('url') or 'N/A'
+
+
+def _wanted_parameters(query: str) -> set:
+    lower = query.lower()
+    return {kind for stem, kinds in _QUERY_PARAMETERS.items() if stem in lower for kind in kinds}
+
+
+def _rank_sentences(query: str, documents: List[Dict[str, Any]]) -> List[Tuple[float, int, str]]:
+    """(оценка, номер документа, предложение) по убыванию оценки"""
+    query_stems = _stems(query) - _STOP_STEMS
+    wanted = _wanted_parameters(query)
+    candidates = []
+    seen = set()
+    for doc_idx, doc in enumerate(documents):
+        for sentence in _split_sentences(_doc_text(doc)):
+            key = _normalize(sentence)
+            if not (_MIN_SENTENCE <= len(sentence) <= _MAX_SENTENCE) or key in seen:
+                continue
+            seen.add(key)
+            candidates.append((doc_idx, sentence, _stems(sentence)))
+
+    # Редкие среди кандидатов слова вопроса важнее частых («печать», «принтер»)
+    n = len(candidates)
+    df = {stem: sum(1 for _, _, stems in candidates if stem in stems) for stem in query_stems}
+    idf = {stem: math.log(1 + n / (1 + count)) for stem, count in df.items()}
+
+    ranked = []
+    for doc_idx, sentence, stems in candidates:
+        matched = query_stems & stems
+        if not matched:
+            continue
+        # Предложение, покрывающее больше слов вопроса, важнее одного редкого совпадения
+        score = sum(idf[s] for s in matched) * len(matched) / len(query_stems)
+        # Вопросы (FAQ) и заголовки без точки - не ответ
+        if sentence.endswith("?"):
+            score *= 0.3
+        elif not sentence.endswith((".", "!", ";", "…")):
+            score *= 0.6
+        if wanted and any(p.kind in wanted for p in extract_parameters(sentence)):
+            score *= 1.5
+        score += 0.1 * float(documents[doc_idx].get('score', 0.0))
+        ranked.append((score, doc_idx, sentence))
+    ranked.sort(key=lambda item: -item[0])
+    return ranked
+
+
+def extractive_answer(
+    query: str,
+    documents: List[Dict[str, Any]],
+    max_sentences: Optional[int] = None,
+    reason: str = "",
+) -> Optional[str]:
+    """
+    Ответ из предложений найденных чанков; None - ничего релевантного нет
+
+    `reason` - пояснение в заголовке (например, «LLM недоступна»).
+    """
+    max_sentences = max_sentences or EXTRACTIVE_MAX_SENTENCES
+    ranked = _rank_sentences(query, documents)
+    if not ranked:
+        return None
+
+    top = ranked[:max_sentences]
+    # Номера источников - в порядке первого использования; чанки одной статьи - один источник
+    sources: List[int] = []
+    number: Dict[int, int] = {}
+    by_url: Dict[str, int] = {}
+    for _, doc_idx, _ in top:
+        if doc_idx in number:
+            continue
+        url = _doc_url(documents[doc_idx])
+        if url not in by_url:
+            sources.append(doc_idx)
+            by_url[url] = len(sources)
+        number[doc_idx] = by_url[url]
+
+    found: List[Parameter] = []
+    seen_values = set()
+    for _, doc_idx, sentence in ranked:
+        if doc_idx not in number:
+            continue
+        for p in extract_parameters(sentence, number[doc_idx]):
+            if (p.kind, p.detail, p.value) not in seen_values:
+                seen_values.add((p.kind, p.detail, p.value))
+                found.append(p)
+    # Сначала параметры, о которых спрашивают; если их нет - все найденные
+    wanted = _wanted_parameters(query)
+    parameters = [p for p in found if p.kind in wanted] or found
+
+    header = "📋 Краткий ответ по базе знаний (без LLM"
+    header += f": {reason})" if reason else ")"
+    lines = [header + ":", ""]
+    lines += [f"• {sentence} [{number[doc_idx]}]" for _, doc_idx, sentence in top]
+    if parameters:
+        lines += ["", "🔧 Параметры из источников:"]
+        lines += [f"- {p.label}" for p in parameters[:MAX_PARAMETERS]]
+
+    lines += ["", "📚 Источники:"]
+    for doc_idx in sources:
+        title = _doc_meta(documents[doc_idx]).get('title', 'Без заголовка')
+        lines.append(f"{number[doc_idx]}. {title} - {_doc_url(documents[doc_idx])}")
+    return "\n".join(lines) + "\n"
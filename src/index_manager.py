@@ -0,0 +1,354 @@
+"""
+Версии индекса: загрузка, проверка и атомарная подмена без перезапуска
+"""
+import json
+import pickle
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional, List, Dict, Any
+
+import numpy as np
+
+try:
+    from .config import EMBEDDING_MODEL
+    from .vector_index import FAISS_FILE, VECTORS_FILE, load_vector_index
+    from .sharding import shard_dirs, shards_version, read_shard_manifest, open_shards
+    from .thread_budget import configure_torch
+    from . import metrics
+except ImportError:
+    from src.config import EMBEDDING_MODEL
+    from src.vector_index import FAISS_FILE, VECTORS_FILE, load_vector_index
+    from src.sharding import shard_dirs, shards_version, read_shard_manifest, open_shards
+    from src.thread_budget import configure_torch
+    from src import metrics
+
+MANIFEST_FILE = "manifest.json"
+
+# Модели эмбеддингов переиспользуются между версиями индекса
+_models: Dict[str, Any] = {}
+_models_lock = threading.Lock()
+
+
+@dataclass
+class IndexSnapshot:
+    """
+    Неизменяемая версия индекса: векторы, чанки и модель эмбеддингов
+
+    `faiss_index` - faiss.Index, NumpyIndex или ShardedIndex с тем же
+    интерфейсом (`backend` - "faiss", "numpy" или "sharded", см.
+    vector_index.py и sharding.py).
+    """
+    version: str
+    knowledge_base: List[Dict[str, Any]]
+    faiss_index: Any = None
+    embeddings_model: Any = None
+    model_name: str = ""
+    backend: str = ""
+    manifest: Dict[str, Any] = field(default_factory=dict)
+    loaded_at: float = field(default_factory=time.time)
+
+
+def _load_model(name: str):
+    with _models_lock:
+        if name not in _models:
+            from sentence_transformers import SentenceTransformer
+            # torch загружен только что: его потоки - по бюджету процесса
+            configure_torch()
+            _models[name] = SentenceTransformer(name)
+            print(f"✅ Модель эмбеддингов загружена: {name}")
+        return _models[name]
+
+
+def read_manifest(index_dir: Path) -> Dict[str, Any]:
+    path = index_dir / MANIFEST_FILE
+    if not path.exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def index_version(index_dir: Path) -> str:
+    """Идентификатор версии: по шардам, из манифеста или по времени изменения файла векторов"""
+    shards = shard_dirs(index_dir)
+    if shards:
+        return shards_version(shards)
+    manifest = read_manifest(index_dir)
+    if manifest.get("version"):
+        return str(manifest["version"])
+    for name in (FAISS_FILE, VECTORS_FILE):
+        index_file = index_dir / name
+        if index_file.exists():
+            stat = index_file.stat()
+            return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    return "none"
+
+
+def _chunks_from_store(docs_path: Path) -> List[Dict[str, Any]]:
+    """Чанки из documents.pkl (формат EmbeddingsStoreFAISS) в формате базы знаний"""
+    with open(docs_path, 'rb') as f:
+        texts, metadatas = pickle.load(f)
+    chunks = []
+    for i, (text, meta) in enumerate(zip(texts, metadatas)):
+        url = meta.get('url', '')
+        chunks.append({
+            "id": f"{url}#{i}",
+            "chunk_id": i,
+            "title": meta.get('title', 'Без заголовка'),
+            "content": text,
+            "source_url": url,
+            "category": meta.get('category', ''),
+        })
+    return chunks
+
+
+def _articles_from_jsonl(kb_path: Path) -> List[Dict[str, Any]]:
+    articles = []
+    with open(kb_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                articles.append(json.loads(line))
+    return articles
+
+
+def load_snapshot(index_dir: Path, kb_path: Path) -> IndexSnapshot:
+    """
+    Загрузка версии индекса с диска
+
+    Чанки берутся из documents.pkl рядом с индексом (именно по ним строится
+    FAISS); без него - статьи из processed.jsonl и текстовый поиск. Векторы -
+    через FAISS или NumPy (VECTOR_BACKEND, см. vector_index.py). Если есть
+    шарды (shards/<имя>), версия собирается из них, а ищут процессы шардов.
+    """
+    version = index_version(index_dir)
+    shards = shard_dirs(index_dir)
+    if shards:
+        manifest = {"shards": {path.name: read_shard_manifest(path) for path in shards}}
+    else:
+        manifest = read_manifest(index_dir)
+    docs_file = index_dir / "documents.pkl"
+
+    if shards:
+        knowledge_base = [chunk for path in shards for chunk in _chunks_from_store(path / "documents.pkl")]
+    elif docs_file.exists():
+        knowledge_base = _chunks_from_store(docs_file)
+    elif kb_path.exists():
+        knowledge_base = _articles_from_jsonl(kb_path)
+    else:
+        print(f"⚠️ База знаний не найдена: {kb_path}")
+        knowledge_base = []
+    print(f"✅ Загружено {len(knowledge_base)} документов")
+
+    snapshot = IndexSnapshot(version=version, knowledge_base=knowledge_base, manifest=manifest)
+
+    try:
+        if shards:
+            index, backend = open_shards(shards), "sharded"
+        else:
+            index, backend = load_vector_index(index_dir)
+        if index is None:
+            print(f"⚠️ Векторный индекс не найден: {index_dir / FAISS_FILE}")
+            print("Запустите: python build_index.py")
+            return snapshot
+        snapshot.faiss_index, snapshot.backend = index, backend
+        print(f"✅ Индекс загружен: {backend}, {index.ntotal} векторов, версия {version}")
+
+        models = {m.get("model") for m in manifest["shards"].values()} if shards else {manifest.get("model")}
+        if len(models) > 1:
+            raise ValueError(f"шарды построены разными моделями: {', '.join(sorted(map(str, models)))}")
+        snapshot.model_name = models.pop() or EMBEDDING_MODEL
+        snapshot.embeddings_model = _load_model(snapshot.model_name)
+    except ImportError as e:
+        print(f"❌ Установите: pip install sentence-transformers (faiss-cpu - по желанию): {e}")
+    except Exception as e:
+        print(f"❌ Ошибка загрузки индекса: {e}")
+
+    return snapshot
+
+
+def validate_snapshot(snapshot: IndexSnapshot) -> List[str]:
+    """Проверка согласованности версии; возвращает список проблем"""
+    problems = []
+    if not snapshot.knowledge_base:
+        problems.append("база знаний пуста")
+
+    index = snapshot.faiss_index
+    if index is None:
+        problems.append("индекс не загружен")
+        return problems
+
+    if index.ntotal != len(snapshot.knowledge_base):
+        problems.append(f"векторов {index.ntotal}, а чанков {len(snapshot.knowledge_base)}")
+
+    model = snapshot.embeddings_model
+    if model is None:
+        problems.append("модель эмбеддингов не загружена")
+        return problems
+
+    try:
+        dim = model.get_sentence_embedding_dimension()
+        if dim != index.d:
+            problems.append(f"размерность модели {dim} != размерности индекса {index.d}")
+            return problems
+        probe = np.asarray(model.encode(["3D-печать PLA"]), dtype=np.float32)
+        _, indices = index.search(probe, 1)
+        if not 0 <= int(indices[0][0]) < len(snapshot.knowledge_base):
+            problems.append("пробный поиск вернул некорректный индекс")
+    except Exception as e:
+        problems.append(f"пробный поиск: {e}")
+    return problems
+
+
+class IndexManager:
+    """
+    Текущая и предыдущая версии индекса
+
+    Читатели берут `manager.current` один раз на запрос и работают с этой
+    версией; новая версия загружается и проверяется в фоне и подменяется
+    одним присваиванием ссылки. Предыдущая версия хранится для отката.
+
+    `primary` - основная база знаний: её размер попадает в общие метрики
+    rag_index_vectors / rag_knowledge_base_documents (см. kb_registry.py).
+
+    Версия на диске, которая была отклонена или от которой откатились,
+    запоминается в `skipped_version` и не загружается повторно (ни watch,
+    ни reload без force), пока на диске не появится другая версия.
+    """
+
+    def __init__(self, index_dir: Path, kb_path: Path, primary: bool = True):
+        self.index_dir = Path(index_dir)
+        self.kb_path = Path(kb_path)
+        self.primary = primary
+        self.current: IndexSnapshot = IndexSnapshot(version="none", knowledge_base=[])
+        self.previous: Optional[IndexSnapshot] = None
+        self.last_error: str = ""
+        self.skipped_version: str = ""
+        self._reload_lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def load_initial(self):
+        """Первая загрузка: версия принимается даже с проблемами (с предупреждением)"""
+        snapshot = load_snapshot(self.index_dir, self.kb_path)
+        problems = validate_snapshot(snapshot)
+        if problems and snapshot.faiss_index is not None:
+            print(f"⚠️ Проблемы индекса {snapshot.version}: {'; '.join(problems)}")
+        self._activate(snapshot, keep_previous=False)
+
+    def _activate(self, snapshot: IndexSnapshot, keep_previous: bool = True):
+        self.previous = self.current if keep_previous else None
+        self.current = snapshot
+        if not self.primary:
+            return
+        metrics.KNOWLEDGE_BASE_DOCUMENTS.set(len(snapshot.knowledge_base))
+        metrics.INDEX_VECTORS.set(snapshot.faiss_index.ntotal if snapshot.faiss_index is not None else 0)
+
+    @property
+    def reloading(self) -> bool:
+        return self._reload_lock.locked()
+
+    def _should_load(self, version: str) -> bool:
+        """Версия на диске новая: не текущая, не отклонённая и не откаченная"""
+        return version not in (self.current.version, self.skipped_version)
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Загрузить, проверить и подменить версию (блокирующий вызов)
+
+        Returns:
+            True, если новая версия активирована
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        version = ""
+        try:
+            version = index_version(self.index_dir)
+            if not force and not self._should_load(version):
+                return False
+            print(f"🔄 Загрузка новой версии индекса {version}...")
+            snapshot = load_snapshot(self.index_dir, self.kb_path)
+            problems = validate_snapshot(snapshot)
+            if problems:
+                self.skipped_version = snapshot.version
+                self.last_error = f"{snapshot.version}: {'; '.join(problems)}"
+                metrics.INDEX_RELOADS.labels(result="rejected").inc()
+                print(f"❌ Версия индекса отклонена: {self.last_error}")
+                return False
+            self._activate(snapshot)
+            self.skipped_version = ""
+            self.last_error = ""
+            metrics.INDEX_RELOADS.labels(result="ok").inc()
+            print(f"✅ Индекс обновлён: {self.previous.version} -> {snapshot.version}")
+            return True
+        except Exception as e:
+            self.skipped_version = version
+            self.last_error = f"{type(e).__name__}: {e}"
+            metrics.INDEX_RELOADS.labels(result="error").inc()
+            print(f"❌ Ошибка обновления индекса: {e}")
+            return False
+        finally:
+            self._reload_lock.release()
+
+    def reload_async(self, force: bool = False) -> bool:
+        """Запустить reload в фоновом потоке; False - обновление уже идёт"""
+        if self.reloading:
+            return False
+        threading.Thread(target=self.reload, kwargs={"force": force}, daemon=True).start()
+        return True
+
+    def rollback(self) -> bool:
+        """Вернуть предыдущую версию; версия на диске не загружается, пока не сменится"""
+        with self._reload_lock:
+            if self.previous is None:
+                return False
+            try:
+                self.skipped_version = index_version(self.index_dir)
+            except Exception as e:
+                self.skipped_version = self.current.version
+                print(f"⚠️ Ошибка проверки версии индекса: {e}")
+            self._activate(self.previous)
+            metrics.INDEX_RELOADS.labels(result="rollback").inc()
+            print(f"↩️ Откат индекса: {self.previous.version} -> {self.current.version}")
+            return True
+
+    def watch(self, interval: float):
+        """Следить за версией на диске и обновляться автоматически"""
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def _loop():
+            while not self._stop.wait(interval):
+                try:
+                    if self._should_load(index_version(self.index_dir)):
+                        self.reload()
+                except Exception as e:
+                    print(f"⚠️ Ошибка проверки версии индекса: {e}")
+
+        self._watcher = threading.Thread(target=_loop, daemon=True, name="index-watcher")
+        self._watcher.start()
+        print(f"👀 Слежение за индексом {self.index_dir} каждые {interval:.0f}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self) -> Dict[str, Any]:
+        def _describe(s: Optional[IndexSnapshot]):
+            if s is None:
+                return None
+            return {
+                "version": s.version,
+                "documents": len(s.knowledge_base),
+                "vectors": s.faiss_index.ntotal if s.faiss_index is not None else 0,
+                "backend": s.backend,
+                **({"shards": s.faiss_index.status()} if s.backend == "sharded" else {}),
+                "model": s.model_name,
+                "loaded_at": s.loaded_at,
+            }
+        return {
+            "current": _describe(self.current),
+            "previous": _describe(self.previous),
+            "reloading": self.reloading,
+            "last_error": self.last_error,
+            "skipped_version": self.skipped_version,
+        }
@@ -0,0 +1,238 @@
+"""
+Классификатор категории вопроса по эмбеддингу запроса
+
+Эмбеддинг вопроса всё равно вычисляется для поиска в FAISS; классификатор
+сравнивает его с центроидами категорий (косинусная близость) и переводит
+близости в вероятности через softmax. Если уверенность ниже порога,
+используются ключевые слова, а если и они ничего не нашли - LLM.
+
+Центроиды обучаются офлайн скриптом train_classifier.py и хранятся в
+CLASSIFIER_PATH (npz: категории, центроиды, модель эмбеддингов).
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from .config import (
+        CLASSIFIER_PATH,
+        CLASSIFIER_MIN_CONFIDENCE,
+        CLASSIFIER_TEMPERATURE,
+        CLASSIFIER_LLM_FALLBACK,
+    )
+    from .keywords import get_engine, KeywordMatches
+    from . import metrics
+except ImportError:
+    from src.config import (
+        CLASSIFIER_PATH,
+        CLASSIFIER_MIN_CONFIDENCE,
+        CLASSIFIER_TEMPERATURE,
+        CLASSIFIER_LLM_FALLBACK,
+    )
+    from src.keywords import get_engine, KeywordMatches
+    from src import metrics
+
+CATEGORIES = [
+    "основы",
+    "подбор_материала",
+    "настройка_принтера",
+    "диагностика_дефектов",
+    "слайсер",
+    "другое",
+]
+DEFAULT_CATEGORY = "другое"
+
+
+@dataclass
+class Classification:
+    """Категория, уверенность (0..1) и источник решения: centroid / keywords / llm"""
+    category: str
+    confidence: float
+    source: str
+
+
+def _normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+class CentroidClassifier:
+    """Ближайший центроид категории по косинусной близости"""
+
+    def __init__(
+        self,
+        categories: Sequence[str],
+        centroids: np.ndarray,
+        model_name: str = "",
+        temperature: float = CLASSIFIER_TEMPERATURE,
+    ):
+        self.categories = list(categories)
+        self.centroids = _normalize_rows(np.asarray(centroids, dtype=np.float32))
+        self.model_name = model_name
+        self.temperature = temperature
+
+    @property
+    def dimension(self) -> int:
+        return self.centroids.shape[1]
+
+    @classmethod
+    def fit(
+        cls,
+        embeddings: np.ndarray,
+        labels: Sequence[str],
+        model_name: str = "",
+        temperature: float = CLASSIFIER_TEMPERATURE,
+    ) -> "CentroidClassifier":
+        """Центроид категории - среднее нормированных эмбеддингов её примеров"""
+        embeddings = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        labels = np.asarray(labels)
+        categories = [c for c in CATEGORIES if (labels == c).any()]
+        centroids = np.stack([embeddings[labels == c].mean(axis=0) for c in categories])
+        return cls(categories, centroids, model_name, temperature)
+
+    def predict_proba(self, embeddings: np.ndarray) -> np.ndarray:
+        """Вероятности категорий для пакета эмбеддингов (softmax по близостям)"""
+        sims = _normalize_rows(np.atleast_2d(np.asarray(embeddings, dtype=np.float32))) @ self.centroids.T
+        logits = sims / self.temperature
+        logits -= logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict(self, embedding: np.ndarray) -> Tuple[str, float]:
+        proba = self.predict_proba(embedding)[0]
+        best = int(proba.argmax())
+        return self.categories[best], float(proba[best])
+
+    def save(self, path: Path):
+        np.savez(
+            path,
+            categories=np.asarray(self.categories),
+            centroids=self.centroids,
+            model_name=np.asarray(self.model_name),
+            temperature=np.asarray(self.temperature),
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["CentroidClassifier"]:
+        path = Path(path)
+        if not path.exists():
+            return None
+        data = np.load(path, allow_pickle=False)
+        return cls(
+            [str(c) for c in data["categories"]],
+            data["centroids"],
+            str(data["model_name"]),
+            float(data["temperature"]),
+        )
+
+
+def llm_classify(user_query: str) -> str:
+    """Категория от LLM (один короткий запрос)"""
+    try:
+        from .models import chat as llm_chat
+    except ImportError:
+        from src.models import chat as llm_chat
+
+    system_prompt = (
+        "Ты классификатор запросов по 3D-печати. "
+        "Верни ОДНО слово из списка: основы, подбор_материала, настройка_принтера, "
+        "диагностика_дефектов, слайсер, другое."
+    )
+    content = llm_chat(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_query},
+        ],
+        temperature=0,
+        max_tokens=10,
+    )
+    text = content.lower()
+    for cat in CATEGORIES[:-1]:
+        if cat in text:
+            return cat
+    return DEFAULT_CATEGORY
+
+
+class QueryClassifier:
+    """
+    Центроиды -> ключевые слова -> LLM
+
+    LLM вызывается только если центроиды не уверены (или не обучены) и в
+    вопросе нет ключевых слов категорий.
+    """
+
+    def __init__(
+        self,
+        centroids_path: str = CLASSIFIER_PATH,
+        min_confidence: float = CLASSIFIER_MIN_CONFIDENCE,
+        llm_fallback: bool = CLASSIFIER_LLM_FALLBACK,
+        centroid: Optional[CentroidClassifier] = None,
+    ):
+        self.centroid = centroid or CentroidClassifier.load(Path(centroids_path))
+        self.min_confidence = min_confidence
+        self.llm_fallback = llm_fallback
+        self.keywords = get_engine()
+        if self.centroid is not None:
+            print(f"✅ Классификатор: {len(self.centroid.categories)} центроидов ({self.centroid.model_name})")
+
+    def accepts(self, embedding_dim: int, model_name: str = "") -> bool:
+        """Подходят ли эмбеддинги этой модели к центроидам"""
+        if self.centroid is None or embedding_dim != self.centroid.dimension:
+            return False
+        return not (model_name and self.centroid.model_name and model_name != self.centroid.model_name)
+
+    def _decide(self, result: Classification) -> Classification:
+        metrics.CLASSIFIER_DECISIONS.labels(source=result.source).inc()
+        return result
+
+    def classify(
+        self,
+        query: str,
+        embedding: Optional[np.ndarray] = None,
+        model_name: str = "",
+        matches: Optional[KeywordMatches] = None,
+        use_llm: Optional[bool] = None,
+    ) -> Classification:
+        """
+        Категория вопроса
+
+        `embedding` - эмбеддинг вопроса той же моделью, что и центроиды
+        (`model_name` проверяется, если известна); `matches` - готовый проход
+        ключевых слов; `use_llm=False` запрещает вызов LLM для этого вопроса.
+        """
+        use_llm = self.llm_fallback if use_llm is None else (use_llm and self.llm_fallback)
+        guess: Optional[Classification] = None
+        if embedding is not None and self.accepts(np.shape(embedding)[-1], model_name):
+            category, confidence = self.centroid.predict(embedding)
+            guess = Classification(category, confidence, "centroid")
+            if confidence >= self.min_confidence:
+                return self._decide(guess)
+
+        matches = matches or self.keywords.scan(query)
+        weights = matches.group("category")
+        if weights:
+            category = self.keywords.best(matches, "category", DEFAULT_CATEGORY)
+            return self._decide(Classification(category, weights[category] / sum(weights.values()), "keywords"))
+
+        if use_llm:
+            try:
+                category = llm_classify(query)
+                return self._decide(Classification(category, 1.0 if category != DEFAULT_CATEGORY else 0.0, "llm"))
+            except Exception as e:
+                print(f"⚠️ Ошибка LLM-классификации: {e}")
+                metrics.ERRORS.labels(stage="classify.llm", type=type(e).__name__).inc()
+
+        return self._decide(guess or Classification(DEFAULT_CATEGORY, 0.0, "default"))
+
+
+_classifier: Optional[QueryClassifier] = None
+
+
+def get_classifier() -> QueryClassifier:
+    """Общий классификатор процесса"""
+    global _classifier
+    if _classifier is None:
+        _classifier = QueryClassifier()
+    return _classifier
@@ -0,0 +1,246 @@
+"""
+Реестр баз знаний: отдельные корпуса с ленивой загрузкой и бюджетом памяти
+
+Основная база (DEFAULT_KB, wiki 3DToday) - data/faiss_index и processed.jsonl,
+остальные - каталоги KB_DIR/<имя> того же формата, что строит build_index.py
+(`--kb vendor_prusa`): manifest.json, documents.pkl, index.faiss или
+vectors.npy, при необходимости shards/ и processed.jsonl для текстового поиска.
+
+Каждая база - свой IndexManager (горячая замена и откат работают как у
+основной). База загружается при первом запросе к ней; после загрузки, если
+сумма оценок памяти загруженных баз больше KB_MEMORY_BUDGET_MB, выгружаются
+давно не использованные. Основная база и только что запрошенная не
+выгружаются. Запросы, уже взявшие версию выгруженной базы, дорабатывают с
+ней - память освобождается, когда ссылок на версию не остаётся.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from .config import FAISS_INDEX_DIR, PROCESSED_DATA_PATH, KB_DIR, DEFAULT_KB, KB_MEMORY_BUDGET_MB
+    from .index_manager import IndexManager, IndexSnapshot
+    from . import tracing
+    from . import metrics
+except ImportError:
+    from src.config import FAISS_INDEX_DIR, PROCESSED_DATA_PATH, KB_DIR, DEFAULT_KB, KB_MEMORY_BUDGET_MB
+    from src.index_manager import IndexManager, IndexSnapshot
+    from src import tracing
+    from src import metrics
+
+KB_ARTICLES_FILE = "processed.jsonl"
+
+
+def snapshot_memory(snapshot: Optional[IndexSnapshot]) -> int:
+    """
+    Оценка памяти версии в байтах: матрица векторов и чанки
+
+    Матрица NumpyIndex считается целиком и при memory-map (точный поиск
+    читает все страницы), у FAISS и шардов - ntotal × d × float32. Модель
+    эмбеддингов общая для баз с одной моделью и не учитывается.
+    """
+    if snapshot is None:
+        return 0
+    size = 0
+    index = snapshot.faiss_index
+    if index is not None:
+        vectors = getattr(index, "vectors", None)
+        size = int(vectors.nbytes) if vectors is not None else int(index.ntotal) * int(index.d) * 4
+    for doc in snapshot.knowledge_base:
+        size += sys.getsizeof(doc) + sum(sys.getsizeof(v) for v in doc.values())
+    return size
+
+
+class KBRegistry:
+    """
+    Базы знаний по имени: загрузка при первом обращении и вытеснение LRU
+
+    `manager(name)` / `snapshot(name)` отмечают использование базы; порядок
+    использования - порядок вытеснения.
+    """
+
+    def __init__(
+        self,
+        root: Path = KB_DIR,
+        default_dir: Path = FAISS_INDEX_DIR,
+        default_kb_path: Path = PROCESSED_DATA_PATH,
+        budget_mb: float = KB_MEMORY_BUDGET_MB,
+        default: str = DEFAULT_KB
+    ):
+        self.root = Path(root)
+        self.default_dir = Path(default_dir)
+        self.default_kb_path = Path(default_kb_path)
+        self.budget = int(budget_mb * 2**20)
+        self.default = default
+        self._loaded: "OrderedDict[str, IndexManager]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        # Оценки памяти по версиям: имя -> {(версия, время загрузки): байты}
+        self._sizes: Dict[str, Dict[Tuple[str, float], int]] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._watch_interval = 0.0
+
+    def names(self) -> List[str]:
+        """Основная база и каталоги KB_DIR/<имя> (читаются при каждом вызове)"""
+        names = [self.default]
+        if self.root.is_dir():
+            names += sorted(p.name for p in self.root.iterdir() if p.is_dir() and p.name != self.default)
+        return names
+
+    def resolve(self, names: Iterable[str], strict: bool = True) -> List[str]:
+        """
+        Имена баз без повторов в исходном порядке
+
+        strict - неизвестное имя даёт ValueError (параметр запроса), иначе
+        пропускается с предупреждением (таблица маршрутов).
+        """
+        available = set(self.names())
+        result, unknown = [], []
+        for name in names:
+            if name not in available:
+                unknown.append(name)
+            elif name not in result:
+                result.append(name)
+        if unknown:
+            message = f"неизвестные базы знаний: {', '.join(unknown)} (доступны: {', '.join(sorted(available))})"
+            if strict:
+                raise ValueError(message)
+            print(f"⚠️ {message}")
+        return result
+
+    def _paths(self, name: str) -> Tuple[Path, Path]:
+        if name == self.default:
+            return self.default_dir, self.default_kb_path
+        index_dir = self.root / name
+        return index_dir, index_dir / KB_ARTICLES_FILE
+
+    def manager(self, name: str) -> IndexManager:
+        """IndexManager базы; при первом обращении база загружается (блокирующий вызов)"""
+        with self._lock:
+            manager = self._touch(name)
+            if manager is not None:
+                return manager
+        self.resolve([name])
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Одновременные первые запросы к базе ждут одну загрузку
+        with load_lock:
+            with self._lock:
+                manager = self._touch(name)
+                if manager is not None:
+                    return manager
+            index_dir, kb_path = self._paths(name)
+            print(f"📚 Загрузка базы знаний {name} из {index_dir}...")
+            manager = IndexManager(index_dir, kb_path, primary=name == self.default)
+            try:
+                with tracing.span("kb.load", kb=name):
+                    manager.load_initial()
+            except Exception:
+                metrics.KB_LOADS.labels(kb=name, result="error").inc()
+                raise
+            if self._watch_interval > 0:
+                manager.watch(self._watch_interval)
+            with self._lock:
+                self._loaded[name] = manager
+                self._touch(name)
+            metrics.KB_LOADS.labels(kb=name, result="loaded").inc()
+
+        self._evict(keep=name)
+        return manager
+
+    def _touch(self, name: str) -> Optional[IndexManager]:
+        """Отметить использование загруженной базы (под self._lock)"""
+        manager = self._loaded.get(name)
+        if manager is not None:
+            self._loaded.move_to_end(name)
+            self._last_used[name] = time.time()
+        return manager
+
+    def snapshot(self, name: str) -> IndexSnapshot:
+        """Текущая версия базы (берётся один раз на операцию)"""
+        return self.manager(name).current
+
+    def memory(self, name: str, manager: IndexManager) -> int:
+        """Оценка памяти базы: текущая и предыдущая (для отката) версии"""
+        cached = self._sizes.get(name, {})
+        sizes = {}
+        for snapshot in (manager.current, manager.previous):
+            if snapshot is None:
+                continue
+            key = (snapshot.version, snapshot.loaded_at)
+            sizes[key] = cached[key] if key in cached else snapshot_memory(snapshot)
+        self._sizes[name] = sizes
+        total = sum(sizes.values())
+        metrics.KB_MEMORY.labels(kb=name).set(total)
+        return total
+
+    def _evict(self, keep: str):
+        """Выгрузить давно не использованные базы, пока память больше бюджета"""
+        if self.budget <= 0:
+            return
+        with self._lock:
+            loaded = list(self._loaded.items())
+        # Оценка новой версии проходит по всем чанкам - вне блокировки
+        sizes = {name: self.memory(name, manager) for name, manager in loaded}
+        total = sum(sizes.values())
+        evicted = []
+        with self._lock:
+            for name in list(self._loaded):
+                if total <= self.budget:
+                    break
+                if name in (keep, self.default) or name not in sizes:
+                    continue
+                evicted.append((name, self._loaded.pop(name)))
+                total -= sizes[name]
+        for name, manager in evicted:
+            manager.stop()
+            self._sizes.pop(name, None)
+            metrics.KB_MEMORY.labels(kb=name).set(0)
+            metrics.KB_LOADS.labels(kb=name, result="evicted").inc()
+            print(f"🗑️ База знаний {name} выгружена ({sizes[name] / 2**20:.1f} МБ, бюджет {self.budget / 2**20:.0f} МБ)")
+        if total > self.budget:
+            print(f"⚠️ Базы знаний занимают {total / 2**20:.1f} МБ при бюджете {self.budget / 2**20:.0f} МБ")
+
+    def watch(self, interval: float):
+        """Слежение за версиями на диске для загруженных и будущих баз"""
+        self._watch_interval = interval
+        with self._lock:
+            managers = list(self._loaded.values())
+        for manager in managers:
+            manager.watch(interval)
+
+    def stop(self):
+        with self._lock:
+            managers = list(self._loaded.values())
+        for manager in managers:
+            manager.stop()
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            loaded = dict(self._loaded)
+            last_used = dict(self._last_used)
+        kbs = []
+        for name in self.names():
+            manager = loaded.get(name)
+            entry: Dict[str, Any] = {"name": name, "loaded": manager is not None}
+            if manager is not None:
+                current = manager.current
+                entry.update(
+                    version=current.version,
+                    documents=len(current.knowledge_base),
+                    vectors=current.faiss_index.ntotal if current.faiss_index is not None else 0,
+                    backend=current.backend,
+                    memory_bytes=self.memory(name, manager),
+                    last_used=last_used.get(name),
+                )
+            kbs.append(entry)
+        return {
+            "default": self.default,
+            "budget_mb": round(self.budget / 2**20, 2),
+            "used_mb": round(sum(k.get("memory_bytes", 0) for k in kbs) / 2**20, 2),
+            "kbs": kbs,
+        }
@@ -0,0 +1,283 @@
+"""
+Поиск ключевых слов: классификация вопроса, проверка темы и безопасности за один проход
+
+Все таблицы (категории, тема 3D-печати, опасные слова) собираются в одно
+регулярное выражение - альтернативу основ слов в виде префиксного дерева.
+Основа совпадает с началом слова и любым окончанием («печат» - печать,
+печати, печатаю), поэтому в таблицах хранятся основы, а не все словоформы.
+Текст нормализуется: нижний регистр, ё -> е.
+
+Таблицы можно переопределить JSON-файлом KEYWORDS_PATH той же структуры,
+что и DEFAULT_TABLES (группы заменяются целиком).
+"""
+import json
+import re
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Tuple, Optional, Any
+
+try:
+    from .config import KEYWORDS_PATH
+except ImportError:
+    from src.config import KEYWORDS_PATH
+
+# группа -> метка -> {keywords, weight, priority}
+DEFAULT_TABLES: Dict[str, Dict[str, Dict[str, Any]]] = {
+    "category": {
+        "диагностика_дефектов": {
+            "priority": 1,
+            "keywords": [
+                "забил", "засор", "сопл", "экструдер", "дефект", "слои",
+                "полос", "трещин", "расслаива", "не прилипа", "отклеива", "недоэкструз",
+                "переэкструз", "паутин",
+            ],
+        },
+        "подбор_материала": {
+            "priority": 2,
+            "keywords": [
+                "материал", "pla", "abs", "petg", "filament", "пластик", "филамент", "tpu",
+                "nylon", "нейлон",
+            ],
+        },
+        "настройка_принтера": {
+            "priority": 3,
+            "keywords": ["настро", "калибр", "откалибр", "температур", "скорост", "ретракт"],
+        },
+        "слайсер": {
+            "priority": 4,
+            "keywords": ["слайсер", "cura", "prusaslicer", "slicer", "нарезк"],
+        },
+        "основы": {
+            "priority": 5,
+            "keywords": ["начина", "новичк", "новичок", "перв", "основ", "выбра", "выбира", "принтер"],
+        },
+    },
+    "topic": {
+        "3d_печать": {
+            "keywords": [
+                "принтер", "печат", "3d", "3д", "pla", "abs", "petg", "сопл", "экструдер",
+                "слайсер", "филамент", "модел", "слой", "слои", "слоя", "слоев",
+            ],
+        },
+    },
+    "safety": {
+        "токсичность": {"keywords": ["токсичн", "ядовит", "отравлен"]},
+        "пожар": {"keywords": ["горюч", "легковоспламен", "пожар", "возгоран"]},
+        "взрыв": {"keywords": ["взрыв"]},
+    },
+}
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def _trie_regex(stems: List[str]) -> str:
+    """
+    Альтернатива основ в виде префиксного дерева: «печат|перв» -> «пе(?:чат|рв)»
+
+    Движок re перебирает ветви альтернативы по очереди; общий префикс
+    проверяется один раз, а несовпадающая первая буква отсекает ветвь сразу.
+    Более длинная основа имеет приоритет над своим префиксом.
+    """
+    trie: Dict[str, Any] = {}
+    for stem in stems:
+        node = trie
+        for ch in stem:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node: Dict[str, Any]) -> str:
+        terminal = "" in node
+        branches = [
+            (r"\s+" if ch == " " else re.escape(ch)) + build(child)
+            for ch, child in sorted(node.items()) if ch
+        ]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if terminal:
+            return f"(?:{body})?"
+        return body
+
+    return build(trie)
+
+
+def _compile(stems: List[str]) -> "re.Pattern":
+    # Без просмотра назад в начале шаблона re быстрее отбрасывает позиции;
+    # начало слова проверяется отдельно (KeywordEngine._word_start)
+    return re.compile(rf"({_trie_regex(stems)})\w*", re.UNICODE)
+
+
+@dataclass
+class KeywordMatches:
+    """Результат одного прохода: веса меток по группам и найденные основы"""
+    weights: Dict[str, Dict[str, float]] = field(default_factory=lambda: defaultdict(dict))
+    hits: List[Tuple[str, str, str]] = field(default_factory=list)
+
+    def group(self, name: str) -> Dict[str, float]:
+        return self.weights.get(name, {})
+
+    def _add(self, group: str, label: str, weight: float, stem: str):
+        self.weights[group][label] = self.weights[group].get(label, 0.0) + weight
+        self.hits.append((group, label, stem))
+
+
+class KeywordEngine:
+    """Скомпилированный поиск всех таблиц ключевых слов за один проход"""
+
+    def __init__(self, tables: Optional[Dict[str, Dict[str, Dict[str, Any]]]] = None):
+        self.tables = tables or DEFAULT_TABLES
+        # основа -> [(группа, метка, вес)]
+        self._targets: Dict[str, List[Tuple[str, str, float]]] = defaultdict(list)
+        self.priority: Dict[str, int] = {}
+        for group, labels in self.tables.items():
+            for label, spec in labels.items():
+                self.priority[label] = spec.get("priority", 100)
+                for keyword in spec["keywords"]:
+                    self._targets[normalize(keyword)].append((group, label, float(spec.get("weight", 1.0))))
+
+        stems = list(self._targets)
+        # Шаблон находит самую длинную основу; основы-префиксы (из других
+        # групп) учитываются вместе с ней
+        own = {stem: list(targets) for stem, targets in self._targets.items()}
+        for stem in stems:
+            for other in stems:
+                if other != stem and stem.startswith(other):
+                    self._targets[stem].extend(own[other])
+        self.pattern = _compile(stems)
+        self._by_text = {s: s for s in stems}
+        self.max_keyword_len = max((len(s) for s in stems), default=0)
+
+        # Шаблоны отдельных групп с литеральным префильтром: проверка
+        # безопасности длинного ответа обычно заканчивается на префильтре
+        self._group_patterns: Dict[str, Tuple[List[str], "re.Pattern"]] = {}
+        for group in self.tables:
+            group_stems = [s for s, targets in self._targets.items() if any(t[0] == group for t in targets)]
+            literals = sorted({s.split()[0] for s in group_stems}, key=len)
+            # Основа, содержащая более короткую, префильтру не нужна
+            literals = [l for i, l in enumerate(literals) if not any(p in l for p in literals[:i])]
+            self._group_patterns[group] = (literals, _compile(group_stems))
+
+    def _stem(self, matched: str) -> str:
+        # Многословные основы могут совпасть с другими пробелами
+        return self._by_text.get(matched) or " ".join(matched.split())
+
+    @staticmethod
+    def _word_start(text: str, pos: int) -> bool:
+        return pos == 0 or not (text[pos - 1].isalnum() or text[pos - 1] == "_")
+
+    def scan(self, text: str, group: Optional[str] = None) -> KeywordMatches:
+        """
+        Все совпадения по всем группам за один проход
+
+        С `group` ищутся только основы этой группы; если ни одна не
+        встречается в тексте как подстрока, регулярное выражение не запускается.
+        """
+        matches = KeywordMatches()
+        text = normalize(text)
+        pattern = self.pattern
+        if group is not None:
+            literals, pattern = self._group_patterns[group]
+            if not any(literal in text for literal in literals):
+                return matches
+        for m in pattern.finditer(text):
+            if not self._word_start(text, m.start()):
+                continue
+            stem = self._stem(m.group(1))
+            for target_group, label, weight in self._targets.get(stem, ()):
+                if group is None or target_group == group:
+                    matches._add(target_group, label, weight, stem)
+        return matches
+
+    def best(self, matches: KeywordMatches, group: str, default: str) -> str:
+        """Метка с наибольшим весом; при равенстве - с меньшим priority"""
+        weights = matches.group(group)
+        if not weights:
+            return default
+        return min(weights, key=lambda label: (-weights[label], self.priority.get(label, 100)))
+
+    def scanner(self, group: Optional[str] = None) -> "StreamScanner":
+        return StreamScanner(self, group)
+
+
+class StreamScanner:
+    """
+    Инкрементальная проверка текста, приходящего частями (потоковый ответ)
+
+    Сканируются только завершённые слова; незаконченное слово и хвост
+    длиной в самую длинную основу переносятся в следующий вызов, чтобы
+    находить ключевые слова на границе частей. Каждое совпадение
+    сообщается один раз.
+    """
+
+    def __init__(self, engine: KeywordEngine, group: Optional[str] = None):
+        self.engine = engine
+        self.group = group
+        self.pattern = engine._group_patterns[group][1] if group else engine.pattern
+        self.matches = KeywordMatches()
+        self._buf = ""
+        self._offset = 0
+        self._seen = set()
+
+    def _scan(self, end: int) -> List[str]:
+        new_labels = []
+        for m in self.pattern.finditer(self._buf, 0, end):
+            if not self.engine._word_start(self._buf, m.start()):
+                continue
+            start = self._offset + m.start()
+            if start in self._seen:
+                continue
+            self._seen.add(start)
+            stem = self.engine._stem(m.group(1))
+            for group, label, weight in self.engine._targets.get(stem, ()):
+                if self.group and group != self.group:
+                    continue
+                if label not in self.matches.group(group):
+                    new_labels.append(label)
+                self.matches._add(group, label, weight, stem)
+        return new_labels
+
+    def feed(self, chunk: str) -> List[str]:
+        """Добавить часть текста; возвращает впервые найденные метки"""
+        self._buf += normalize(chunk)
+        cut = len(self._buf)
+        while cut > 0 and (self._buf[cut - 1].isalnum() or self._buf[cut - 1] == "_"):
+            cut -= 1
+        new_labels = self._scan(cut)
+
+        # Хвост для совпадений на границе: начинаем с начала слова
+        keep = max(0, cut - self.engine.max_keyword_len)
+        while keep > 0 and (self._buf[keep - 1].isalnum() or self._buf[keep - 1] == "_"):
+            keep -= 1
+        self._seen = {s for s in self._seen if s >= self._offset + keep}
+        self._offset += keep
+        self._buf = self._buf[keep:]
+        return new_labels
+
+    def finish(self) -> List[str]:
+        """Досканировать остаток после последней части"""
+        new_labels = self._scan(len(self._buf))
+        self._buf = ""
+        return new_labels
+
+
+def _load_tables(path: str) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    tables = dict(DEFAULT_TABLES)
+    if path and Path(path).exists():
+        with open(path, "r", encoding="utf-8") as f:
+            tables.update(json.load(f))
+        print(f"✅ Таблицы ключевых слов: {path}")
+    return tables
+
+
+_engine: Optional[KeywordEngine] = None
+
+
+def get_engine() -> KeywordEngine:
+    """Общий движок процесса (собирается при первом обращении)"""
+    global _engine
+    if _engine is None:
+        _engine = KeywordEngine(_load_tables(KEYWORDS_PATH))
+    return _engine
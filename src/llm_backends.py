@@ -0,0 +1,256 @@
+"""
+Бэкенды LLM: Perplexity, любой OpenAI-совместимый сервер и детерминированная заглушка
+
+Все бэкенды реализуют chat(messages, model, temperature, max_tokens) -> str.
+Бэкенд по умолчанию выбирается LLM_BACKEND, конкретный - по имени через
+get_backend(name).
+
+    perplexity - https://api.perplexity.ai (PERPLEXITY_API_KEY, PPLX_API_URL)
+    openai     - OpenAI-совместимый /chat/completions: llama.cpp, vLLM и т.п.
+                 (OPENAI_BASE_URL, OPENAI_API_KEY, OPENAI_MODEL)
+    fake       - без сети: ответ по тексту запроса с задержкой
+                 FAKE_LLM_LATENCY_MS и скоростью FAKE_LLM_TOKENS_PER_S
+"""
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+import time
+from typing import List, Dict, Any, Optional
+
+import requests
+
+try:
+    from .config import (
+        LLM_BACKEND,
+        LLM_TIMEOUT,
+        PERPLEXITY_API_KEY,
+        PPLX_API_URL,
+        PPLX_MODEL_GENERAL,
+        PPLX_MODEL_STRICT,
+        OPENAI_BASE_URL,
+        OPENAI_API_KEY,
+        OPENAI_MODEL,
+        OPENAI_MODEL_STRICT,
+        OPENAI_RATE_LIMIT_RPM,
+        FAKE_LLM_LATENCY_MS,
+        FAKE_LLM_TOKENS_PER_S,
+    )
+    from .llm_policy import LLMPolicy, LLMError
+    from . import tracing
+    from . import metrics
+except ImportError:
+    from src.config import (
+        LLM_BACKEND,
+        LLM_TIMEOUT,
+        PERPLEXITY_API_KEY,
+        PPLX_API_URL,
+        PPLX_MODEL_GENERAL,
+        PPLX_MODEL_STRICT,
+        OPENAI_BASE_URL,
+        OPENAI_API_KEY,
+        OPENAI_MODEL,
+        OPENAI_MODEL_STRICT,
+        OPENAI_RATE_LIMIT_RPM,
+        FAKE_LLM_LATENCY_MS,
+        FAKE_LLM_TOKENS_PER_S,
+    )
+    from src.llm_policy import LLMPolicy, LLMError
+    from src import tracing
+    from src import metrics
+
+Messages = List[Dict[str, str]]
+
+
+class LLMBackend(ABC):
+    """Интерфейс бэкенда LLM"""
+
+    name = "base"
+    default_model = ""
+    # Уровни моделей из таблицы маршрутов (routing.py) -> модель бэкенда
+    model_tiers: Dict[str, str] = {}
+
+    def resolve_model(self, model: Optional[str]) -> str:
+        """Модель по имени или уровню (general/strict); по умолчанию - default_model"""
+        if not model:
+            return self.default_model
+        return self.model_tiers.get(model, model)
+
+    @abstractmethod
+    def chat(
+        self,
+        messages: Messages,
+        model: Optional[str] = None,
+        temperature: float = 0.3,
+        max_tokens: int = 800,
+    ) -> str:
+        """Ответ модели на сообщения в формате OpenAI chat"""
+
+
+def _retry_after(resp: requests.Response) -> Optional[float]:
+    try:
+        return float(resp.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """POST {url} в формате OpenAI chat/completions с политиками из llm_policy"""
+
+    name = "openai"
+
+    def __init__(
+        self,
+        url: str,
+        api_key: str = "",
+        default_model: str = OPENAI_MODEL,
+        policy: Optional[LLMPolicy] = None,
+        timeout: float = LLM_TIMEOUT,
+        strict_model: str = OPENAI_MODEL_STRICT,
+    ):
+        self.url = url
+        self.api_key = api_key
+        self.default_model = default_model
+        self.model_tiers = {"general": default_model, "strict": strict_model or default_model}
+        self.policy = policy or LLMPolicy(rate_limit_rpm=OPENAI_RATE_LIMIT_RPM)
+        self.timeout = timeout
+        # Соединения переиспользуются между запросами из пула потоков RAG
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def chat(
+        self,
+        messages: Messages,
+        model: Optional[str] = None,
+        temperature: float = 0.3,
+        max_tokens: int = 800,
+    ) -> str:
+        payload: Dict[str, Any] = {
+            "model": self.resolve_model(model),
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        with tracing.span("llm.total", backend=self.name, model=payload["model"], max_tokens=max_tokens):
+            return self.policy.call(lambda: self._post_once(payload))
+
+    def _post_once(self, payload: Dict[str, Any]) -> str:
+        """Одна попытка запроса; ошибки 429/5xx и сетевые помечаются как повторяемые"""
+        model = payload["model"]
+        try:
+            resp = self.session.post(self.url, json=payload, headers=self._headers(), timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            metrics.LLM_REQUESTS.labels(model=model, status=type(e).__name__).inc()
+            raise LLMError(f"Ошибка соединения с {self.name} ({self.url}): {e}", retryable=True)
+
+        # elapsed - время до получения заголовков ответа (соединение + генерация)
+        tracing.record("llm.ttfb", resp.elapsed.total_seconds(), status=resp.status_code)
+        metrics.LLM_REQUESTS.labels(model=model, status=str(resp.status_code)).inc()
+
+        if resp.status_code >= 400:
+            retryable = resp.status_code == 429 or resp.status_code >= 500
+            raise LLMError(
+                f"Ошибка HTTP при обращении к {self.name}: {resp.status_code} {resp.reason}",
+                retryable=retryable,
+                retry_after=_retry_after(resp),
+            )
+
+        try:
+            data = resp.json()
+            metrics.record_llm_usage(model, data.get("usage"))
+            return data["choices"][0]["message"]["content"]
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise LLMError(f"Неожиданный формат ответа от {self.name}: {e}")
+
+
+class PerplexityBackend(OpenAICompatibleBackend):
+    """Perplexity API (OpenAI-совместимый формат, квота по LLM_RATE_LIMIT_RPM)"""
+
+    name = "perplexity"
+
+    def __init__(self, api_key: Optional[str] = None, url: str = PPLX_API_URL, policy: Optional[LLMPolicy] = None):
+        super().__init__(
+            url,
+            api_key=api_key or PERPLEXITY_API_KEY or "",
+            default_model=PPLX_MODEL_GENERAL,
+            policy=policy or LLMPolicy(),
+            strict_model=PPLX_MODEL_STRICT,
+        )
+
+    def chat(self, messages: Messages, model: Optional[str] = None, temperature: float = 0.3, max_tokens: int = 800) -> str:
+        if not self.api_key:
+            raise ValueError(
+                "PERPLEXITY_API_KEY не установлен. "
+                "Создайте файл .env и добавьте: PERPLEXITY_API_KEY=ваш_ключ"
+            )
+        return super().chat(messages, model, temperature, max_tokens)
+
+
+class FakeBackend(LLMBackend):
+    """
+    Детерминированная заглушка без сети
+
+    Ответ зависит только от текста запроса; время ответа - задержка до
+    первого токена плюс длина ответа / скорость генерации. Подходит для
+    прогона всего пайплайна офлайн и нагрузочных тестов.
+    """
+
+    name = "fake"
+    default_model = "fake"
+
+    def __init__(self, latency_ms: float = FAKE_LLM_LATENCY_MS, tokens_per_s: float = FAKE_LLM_TOKENS_PER_S):
+        self.latency = latency_ms / 1000
+        self.tokens_per_s = tokens_per_s
+
+    @staticmethod
+    def _answer(messages: Messages) -> str:
+        question = messages[-1]["content"] if messages else ""
+        digest = hashlib.sha1(question.encode("utf-8")).hexdigest()[:8]
+        lines = [
+            "1. Проверьте температуру сопла и стола.",
+            "2. Откалибруйте первый слой.",
+            "3. Уменьшите скорость печати.",
+        ]
+        return "\n".join(lines) + f"\n(ответ заглушки {digest})"
+
+    def chat(self, messages: Messages, model: Optional[str] = None, temperature: float = 0.3, max_tokens: int = 800) -> str:
+        model = self.resolve_model(model)
+        answer = self._answer(messages)
+        prompt_tokens = sum(len(m.get("content", "")) for m in messages) // 4
+        completion_tokens = min(max_tokens, len(answer) // 4)
+        with tracing.span("llm.total", backend=self.name, model=model, max_tokens=max_tokens):
+            time.sleep(self.latency)
+            tracing.record("llm.ttfb", self.latency)
+            if self.tokens_per_s > 0:
+                time.sleep(completion_tokens / self.tokens_per_s)
+        metrics.LLM_REQUESTS.labels(model=model, status="200").inc()
+        metrics.record_llm_usage(model, {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+        return answer
+
+
+_FACTORIES = {
+    "perplexity": PerplexityBackend,
+    "openai": lambda: OpenAICompatibleBackend(
+        OPENAI_BASE_URL.rstrip("/") + "/chat/completions", api_key=OPENAI_API_KEY
+    ),
+    "fake": FakeBackend,
+}
+_backends: Dict[str, LLMBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name: Optional[str] = None) -> LLMBackend:
+    """Бэкенд по имени (по умолчанию LLM_BACKEND); создаётся один раз на процесс"""
+    name = name or LLM_BACKEND
+    with _backends_lock:
+        if name not in _backends:
+            if name not in _FACTORIES:
+                raise ValueError(f"Неизвестный LLM_BACKEND: {name} (доступны: {', '.join(_FACTORIES)})")
+            _backends[name] = _FACTORIES[name]()
+        return _backends[name]
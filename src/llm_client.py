@@ -1,10 +1,20 @@
 # src/llm_client.py
 import os
-import requests
 from typing import Optional, List, Dict
 
+try:
+    from .llm_backends import PerplexityBackend, get_backend
+except ImportError:
+    from src.llm_backends import PerplexityBackend, get_backend
+
+
 class PerplexityClient:
-    """Клиент для работы с Perplexity API"""
+    """
+    Клиент для работы с Perplexity API (обёртка над llm_backends.PerplexityBackend)
+
+    Использует общий бэкенд процесса get_backend("perplexity"): лимит
+    запросов, повторы и автомат отключения - одни с RAG-пайплайном.
+    """
     
     def __init__(self, api_key: Optional[str] = None):
         """
@@ -17,11 +27,12 @@ class PerplexityClient:
         if not self.api_key:
             raise ValueError("API ключ не найден. Укажите PERPLEXITY_API_KEY в .env")
         
-        self.base_url = "https://api.perplexity.ai"
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        shared = get_backend("perplexity")
+        if shared.api_key == self.api_key:
+            self.backend = shared
+        else:
+            # Другой ключ - свой бэкенд, но лимит, повторы и автомат отключения общие
+            self.backend = PerplexityBackend(api_key=self.api_key, policy=shared.policy)
     
     def generate(
         self,
@@ -39,40 +50,12 @@ class PerplexityClient:
             model: Модель для генерации (sonar, sonar-pro)
             max_tokens: Максимальное количество токенов
             temperature: Температура генерации (0-1)
-            stream: Потоковый режим
+            stream: Не поддерживается, ответ возвращается целиком
         
         Returns:
             Сгенерированный текст
         """
-        endpoint = f"{self.base_url}/chat/completions"
-        
-        payload = {
-            "model": model,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "stream": stream
-        }
-        
-        try:
-            response = requests.post(
-                endpoint,
-                headers=self.headers,
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
-            
-        except requests.exceptions.RequestException as e:
-            raise Exception(f"Ошибка API запроса: {str(e)}")
+        return self.chat([{"role": "user", "content": prompt}], model, max_tokens, temperature)
     
     def chat(
         self,
@@ -93,28 +76,9 @@ class PerplexityClient:
         Returns:
             Ответ модели
         """
-        endpoint = f"{self.base_url}/chat/completions"
-        
-        payload = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": max_tokens,
-            "temperature": temperature
-        }
-        
         try:
-            response = requests.post(
-                endpoint,
-                headers=self.headers,
-                json=payload,
-                timeout=60
-            )
-            response.raise_for_status()
-            
-            data = response.json()
-            return data["choices"][0]["message"]["content"]
-            
-        except requests.exceptions.RequestException as e:
+            return self.backend.chat(messages, model=model, temperature=temperature, max_tokens=max_tokens)
+        except RuntimeError as e:
             raise Exception(f"Ошибка API запроса: {str(e)}")
 
 # Тестирование
@@ -0,0 +1,348 @@
+"""
+Политики вызова LLM: повторы, ограничение частоты, автомат отключения, хеджирование
+
+Порядок для одного вызова:
+    1. автомат отключения (circuit breaker) открыт - сразу ошибка, без запроса;
+    2. токен из корзины (лимит запросов в минуту по квоте Perplexity);
+    3. запрос; если ответа нет дольше p95 недавних запросов и хеджирование
+       включено - параллельно отправляется второй, берётся первый успешный;
+    4. 429/5xx/ошибка соединения - повтор с экспоненциальной задержкой и
+       случайным разбросом, пока не исчерпан бюджет повторов (доля от
+       обычных запросов, чтобы повторы не удваивали нагрузку на
+       деградировавший сервис).
+
+Каждое решение учитывается в llm_policy_events_total{event}.
+"""
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, Optional
+
+try:
+    from .config import (
+        LLM_MAX_RETRIES,
+        LLM_RETRY_BASE_MS,
+        LLM_RETRY_MAX_MS,
+        LLM_RETRY_BUDGET_RATIO,
+        LLM_RATE_LIMIT_RPM,
+        LLM_RATE_LIMIT_BURST,
+        LLM_RATE_LIMIT_WAIT_S,
+        LLM_CIRCUIT_FAILURES,
+        LLM_CIRCUIT_RESET_S,
+        LLM_HEDGE,
+        LLM_HEDGE_DELAY_MS,
+    )
+    from . import metrics
+except ImportError:
+    from src.config import (
+        LLM_MAX_RETRIES,
+        LLM_RETRY_BASE_MS,
+        LLM_RETRY_MAX_MS,
+        LLM_RETRY_BUDGET_RATIO,
+        LLM_RATE_LIMIT_RPM,
+        LLM_RATE_LIMIT_BURST,
+        LLM_RATE_LIMIT_WAIT_S,
+        LLM_CIRCUIT_FAILURES,
+        LLM_CIRCUIT_RESET_S,
+        LLM_HEDGE,
+        LLM_HEDGE_DELAY_MS,
+    )
+    from src import metrics
+
+
+class LLMError(RuntimeError):
+    """Ошибка вызова LLM; retryable - имеет ли смысл повтор"""
+
+    def __init__(self, message: str, retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(LLMError):
+    """Автомат отключения открыт: запрос не отправлялся"""
+
+
+class RateLimitedError(LLMError):
+    """Не дождались токена в корзине лимита"""
+
+
+def _event(name: str):
+    metrics.LLM_POLICY_EVENTS.labels(event=name).inc()
+
+
+class TokenBucket:
+    """Корзина токенов: `rate` токенов в секунду, не больше `burst` накопленных"""
+
+    def __init__(self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """Взять токен; возвращает 0 или сколько секунд ждать до следующего"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout: float) -> float:
+        """Ждать токен не дольше `timeout`; возвращает время ожидания"""
+        waited = 0.0
+        while True:
+            delay = self.try_acquire()
+            if delay == 0:
+                return waited
+            if waited + delay > timeout:
+                raise RateLimitedError(f"Лимит запросов к LLM: нет токена за {timeout:.0f}s")
+            time.sleep(delay)
+            waited += delay
+
+
+class CircuitBreaker:
+    """
+    Автомат отключения
+
+    closed -> open после `failures` ошибок подряд; через `reset_timeout`
+    пропускается один пробный запрос (half-open): успех закрывает автомат,
+    ошибка снова открывает.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    _STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failures: int, reset_timeout: float, clock: Callable[[], float] = time.monotonic):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            metrics.LLM_CIRCUIT_STATE.set(self._STATE_VALUE[state])
+            _event(f"circuit_{state}")
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def cancel(self):
+        """Разрешённый запрос не был отправлен"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._probe_in_flight = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or (
+                self.failures > 0 and self._consecutive >= self.failures
+            ):
+                self._opened_at = self.clock()
+                self._set_state(self.OPEN)
+
+
+class RetryBudget:
+    """
+    Бюджет повторов: каждый запрос добавляет `ratio` токена, повтор тратит один
+
+    При массовых ошибках повторов не больше `ratio` от числа запросов;
+    `min_reserve` позволяет повторять при малом трафике.
+    """
+
+    def __init__(self, ratio: float, min_reserve: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max(min_reserve, 100 * ratio)
+        self._tokens = min_reserve
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных запросов"""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class LLMPolicy:
+    """Обёртка одного вызова LLM (`fn() -> результат`) политиками"""
+
+    def __init__(
+        self,
+        max_retries: int = LLM_MAX_RETRIES,
+        retry_base_ms: float = LLM_RETRY_BASE_MS,
+        retry_max_ms: float = LLM_RETRY_MAX_MS,
+        retry_budget_ratio: float = LLM_RETRY_BUDGET_RATIO,
+        rate_limit_rpm: float = LLM_RATE_LIMIT_RPM,
+        rate_limit_burst: int = LLM_RATE_LIMIT_BURST,
+        rate_limit_wait_s: float = LLM_RATE_LIMIT_WAIT_S,
+        circuit_failures: int = LLM_CIRCUIT_FAILURES,
+        circuit_reset_s: float = LLM_CIRCUIT_RESET_S,
+        hedge: bool = LLM_HEDGE,
+        hedge_delay_ms: float = LLM_HEDGE_DELAY_MS,
+    ):
+        self.max_retries = max_retries
+        self.retry_base = retry_base_ms / 1000
+        self.retry_max = retry_max_ms / 1000
+        self.retry_budget = RetryBudget(retry_budget_ratio)
+        self.bucket = TokenBucket(rate_limit_rpm / 60, rate_limit_burst) if rate_limit_rpm > 0 else None
+        self.rate_limit_wait = rate_limit_wait_s
+        self.breaker = CircuitBreaker(circuit_failures, circuit_reset_s)
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay_ms / 1000 if hedge_delay_ms > 0 else None
+        self.latency = LatencyTracker()
+        self._random = random.Random()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge") if hedge else None
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Задержка перед повтором: «full jitter», не меньше Retry-After"""
+        delay = self._random.uniform(0, min(self.retry_max, self.retry_base * (2 ** attempt)))
+        if retry_after:
+            delay = max(delay, min(retry_after, self.retry_max))
+        return delay
+
+    def _take_token(self):
+        if self.bucket is None:
+            return
+        waited = self.bucket.acquire(self.rate_limit_wait)
+        if waited:
+            _event("rate_limited")
+            metrics.LLM_RATE_LIMIT_WAIT.observe(waited)
+
+    def _attempt(self, fn: Callable[[], Any]) -> Any:
+        """Один запрос (возможно, с хеджированием); считает длительность"""
+        start = time.monotonic()
+        if self._hedge_pool is not None:
+            result = self._hedged(fn)
+        else:
+            result = fn()
+        self.latency.add(time.monotonic() - start)
+        return result
+
+    def _hedged(self, fn: Callable[[], Any]) -> Any:
+        delay = self.hedge_delay or self.latency.p95()
+        # Контекст (активная трасса) копируется в поток каждого запроса
+        primary = self._hedge_pool.submit(contextvars.copy_context().run, fn)
+        if delay is None:
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        # Второй запрос тоже расходует квоту: без свободного токена не хеджируем
+        if self.bucket is not None and self.bucket.try_acquire() > 0:
+            return primary.result()
+        _event("hedge_sent")
+        hedge = self._hedge_pool.submit(contextvars.copy_context().run, fn)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        _event("hedge_won")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        """
+        Выполнить fn() с политиками
+
+        fn должна бросать LLMError с retryable=True для 429/5xx и сетевых ошибок;
+        любое другое исключение считается сбоем без повтора.
+        """
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                _event("circuit_rejected")
+                raise CircuitOpenError("LLM временно недоступна (автомат отключения открыт)")
+            try:
+                self._take_token()
+            except RateLimitedError:
+                self.breaker.cancel()
+                _event("rate_limit_rejected")
+                raise
+            try:
+                result = self._attempt(fn)
+            except LLMError as e:
+                if not e.retryable:
+                    # Сервис ответил (например, 400) - он доступен
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    _event("retries_exhausted")
+                    raise
+                if not self.retry_budget.withdraw():
+                    _event("retry_budget_exhausted")
+                    raise
+                delay = self.backoff(attempt, e.retry_after)
+                _event("retry")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except Exception:
+                # Непредвиденная ошибка (не LLMError) - сбой без повтора; иначе
+                # пробный запрос half-open остался бы «в полёте» навсегда
+                self.breaker.record_failure()
+                _event("unexpected_error")
+                raise
+            self.breaker.record_success()
+            return result
@@ -0,0 +1,284 @@
+"""
+Prometheus-метрики API и Telegram-бота
+
+В src.serve воркеры пишут значения в общий каталог PROMETHEUS_MULTIPROC_DIR
+(multiprocess-режим prometheus_client), и /metrics любого воркера отдаёт
+сумму по всем. Режим выбирается по переменной окружения при импорте
+prometheus_client, поэтому мастер задаёт её до импорта этого модуля.
+У gauge указано, как объединять значения процессов (multiprocess_mode).
+"""
+import os
+from pathlib import Path
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+    start_http_server,
+)
+
+try:
+    from . import tracing
+except ImportError:
+    from src import tracing
+
+# Границы гистограмм: от быстрых этапов (мс) до ответа LLM (десятки секунд)
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0,
+)
+
+STAGE_LATENCY = Histogram(
+    "rag_stage_duration_seconds",
+    "Длительность этапов пайплайна",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_LATENCY = Histogram(
+    "rag_request_duration_seconds",
+    "Полное время обработки запроса по категориям",
+    ["category"],
+    buckets=LATENCY_BUCKETS,
+)
+ROUTE_REQUESTS = Counter(
+    "rag_route_requests_total",
+    "Запросы по маршрутам генерации (категория и сложность)",
+    ["route", "model"],
+)
+ROUTE_GENERATE_LATENCY = Histogram(
+    "rag_route_generate_seconds",
+    "Длительность генерации ответа по маршрутам",
+    ["route"],
+    buckets=LATENCY_BUCKETS,
+)
+CLASSIFIER_DECISIONS = Counter(
+    "rag_classifier_decisions_total",
+    "Решения классификатора категорий по источнику (centroid, keywords, llm, default)",
+    ["source"],
+)
+STAGE_OUTCOMES = Counter(
+    "rag_stage_outcomes_total",
+    "Этапы графа агентов по результату (ok, skipped, timeout, error)",
+    ["stage", "status"],
+)
+ANSWERS = Counter(
+    "rag_answers_total",
+    "Ответы по способу (llm, extractive, fallback) и причине (requested, llm_error, llm_timeout, no_documents, empty_context)",
+    ["mode", "reason"],
+)
+SHARD_SEARCHES = Counter(
+    "rag_shard_searches_total",
+    "Поиски по шардам индекса по исходу (ok, timeout, down, error)",
+    ["shard", "status"],
+)
+SHARD_LATENCY = Histogram(
+    "rag_shard_search_seconds",
+    "Время ответа процесса шарда (включая ответы после таймаута)",
+    ["shard"],
+    buckets=LATENCY_BUCKETS,
+)
+KB_LOADS = Counter(
+    "rag_kb_loads_total",
+    "Загрузки и выгрузки баз знаний (loaded, evicted, error)",
+    ["kb", "result"],
+)
+KB_MEMORY = Gauge(
+    "rag_kb_memory_bytes",
+    "Оценка памяти загруженной базы знаний (векторы и чанки)",
+    ["kb"],
+    multiprocess_mode="livemax",
+)
+COMPUTE_WAIT = Histogram(
+    "rag_compute_wait_seconds",
+    "Ожидание слота CPU-тяжёлого этапа (бюджет потоков, см. thread_budget.py)",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+THREAD_BUDGET = Gauge(
+    "rag_thread_budget",
+    "Бюджет потоков процесса: cores, intra_op, inter_op, slots",
+    ["setting"],
+    multiprocess_mode="livemax",
+)
+QUEUE_WAIT = Histogram(
+    "rag_queue_wait_seconds",
+    "Время ожидания слота в очереди планировщика",
+    ["source"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "rag_requests_in_flight",
+    "Запросы в обработке",
+    ["source"],
+    multiprocess_mode="livesum",
+)
+ERRORS = Counter(
+    "rag_errors_total",
+    "Ошибки по этапам и типам",
+    ["stage", "type"],
+)
+FALLBACK_SEARCH = Counter(
+    "rag_fallback_search_total",
+    "Запросы, обслуженные упрощённым текстовым поиском вместо FAISS",
+    ["reason"],
+)
+CACHE_REQUESTS = Counter(
+    "rag_cache_requests_total",
+    "Обращения к кэшам",
+    ["cache", "result"],
+)
+LLM_REQUESTS = Counter(
+    "llm_requests_total",
+    "Запросы к LLM",
+    ["model", "status"],
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Токены LLM из поля usage",
+    ["model", "kind"],
+)
+LLM_POLICY_EVENTS = Counter(
+    "llm_policy_events_total",
+    "Решения политик LLM: повторы, лимит, автомат отключения, хеджирование",
+    ["event"],
+)
+LLM_CIRCUIT_STATE = Gauge(
+    "llm_circuit_state",
+    "Состояние автомата отключения LLM (0 - закрыт, 1 - пробный запрос, 2 - открыт)",
+    multiprocess_mode="livemax",
+)
+LLM_RATE_LIMIT_WAIT = Histogram(
+    "llm_rate_limit_wait_seconds",
+    "Ожидание токена лимита запросов к LLM",
+    buckets=LATENCY_BUCKETS,
+)
+LLM_COALESCED = Counter(
+    "llm_coalesced_requests_total",
+    "Запросы к LLM, объединённые с уже выполняющимся одинаковым запросом",
+    ["result"],
+)
+INDEX_VECTORS = Gauge(
+    "rag_index_vectors",
+    "Число векторов в загруженном индексе",
+    multiprocess_mode="livemax",
+)
+INDEX_RELOADS = Counter(
+    "rag_index_reloads_total",
+    "Обновления индекса без перезапуска",
+    ["result"],
+)
+KNOWLEDGE_BASE_DOCUMENTS = Gauge(
+    "rag_knowledge_base_documents",
+    "Число документов в базе знаний",
+    multiprocess_mode="livemax",
+)
+
+
+def _observe_span(span: "tracing.Span", trace: "tracing.Trace"):
+    # Только длительность: ошибки учитывает код, который их обрабатывает
+    # (ERRORS.labels(...).inc()). Исключение проходит через все вложенные
+    # спаны - счёт ещё и здесь дал бы одну ошибку несколько раз.
+    STAGE_LATENCY.labels(stage=span.name).observe(span.duration_ms / 1000)
+
+
+tracing.add_span_listener(_observe_span)
+
+
+def record_llm_usage(model: str, usage: dict):
+    """Учесть токены из поля `usage` ответа OpenAI-совместимого API"""
+    if not usage:
+        return
+    LLM_TOKENS.labels(model=model, kind="prompt").inc(usage.get("prompt_tokens", 0) or 0)
+    LLM_TOKENS.labels(model=model, kind="completion").inc(usage.get("completion_tokens", 0) or 0)
+
+
+def cache_hit(cache: str, hit: bool):
+    """Учесть попадание/промах кэша"""
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+
+
+def _read_memory(pid: int) -> dict:
+    """RSS, PSS, USS (только своя) и разделяемая память процесса в байтах (Linux /proc)"""
+    result = {}
+    rollup = Path(f"/proc/{pid}/smaps_rollup")
+    try:
+        for line in rollup.read_text().splitlines():
+            key, _, rest = line.partition(":")
+            if key in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty"):
+                result[key] = int(rest.split()[0]) * 1024
+    except OSError:
+        return result
+    result["Shared"] = result.pop("Shared_Clean", 0) + result.pop("Shared_Dirty", 0)
+    result["Uss"] = result.pop("Private_Clean", 0) + result.pop("Private_Dirty", 0)
+    return result
+
+
+class WorkerMemoryCollector:
+    """Память всех воркеров src.serve (каждый воркер отдаёт данные по всем)"""
+
+    def __init__(self, worker_pids):
+        self.worker_pids = worker_pids
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+
+        family = GaugeMetricFamily(
+            "rag_worker_memory_bytes",
+            "Память процессов-воркеров (rss, pss, uss, shared)",
+            labels=["worker", "kind"],
+        )
+        for slot, pid in enumerate(self.worker_pids):
+            if not pid:
+                continue
+            for kind, value in _read_memory(pid).items():
+                family.add_metric([str(slot), kind.lower()], value)
+        yield family
+
+
+_worker_memory = None
+
+
+def register_workers(worker_pids):
+    """Экспортировать память воркеров (массив pid в общей памяти)"""
+    global _worker_memory
+    _worker_memory = WorkerMemoryCollector(worker_pids)
+    REGISTRY.register(_worker_memory)
+
+
+def _multiproc_dir() -> str:
+    return os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv("prometheus_multiproc_dir") or ""
+
+
+def _registry():
+    """Реестр для выдачи: в multiprocess-режиме - сумма по файлам всех процессов"""
+    if not _multiproc_dir():
+        return REGISTRY
+    from prometheus_client.multiprocess import MultiProcessCollector
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    if _worker_memory is not None:
+        registry.register(_worker_memory)
+    return registry
+
+
+def mark_process_dead(pid: int):
+    """Воркер завершился: его live-gauge больше не учитываются (счётчики остаются)"""
+    if _multiproc_dir():
+        from prometheus_client.multiprocess import mark_process_dead as _mark_dead
+        _mark_dead(pid)
+
+
+def render() -> tuple:
+    """Текст метрик в формате Prometheus и его content-type"""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def serve(port: int):
+    """Отдельный HTTP-сервер /metrics (для процессов без FastAPI, например бота)"""
+    start_http_server(port, registry=_registry())
+    print(f"📈 Метрики доступны на http://0.0.0.0:{port}/metrics")
@@ -1,70 +1,45 @@
-"""Клиент для работы с Perplexity API"""
-import os
-import requests
-from typing import List, Dict, Any
+"""Вызов LLM через настроенный бэкенд (см. llm_backends)"""
+from typing import List, Dict, Optional
 
 # Импорт конфигурации с обработкой ошибок
 try:
-    from .config import PERPLEXITY_API_KEY, PPLX_MODEL_GENERAL
+    from .llm_backends import get_backend
 except ImportError:
-    from src.config import PERPLEXITY_API_KEY, PPLX_MODEL_GENERAL
+    from src.llm_backends import get_backend
 
-PPLX_URL = "https://api.perplexity.ai/chat/completions"
 
-
-def pplx_chat(
+def chat(
     messages: List[Dict[str, str]],
-    model: str = None,
+    model: Optional[str] = None,
     temperature: float = 0.3,
     max_tokens: int = 800,
+    backend: Optional[str] = None,
 ) -> str:
     """
-    Отправить запрос к Perplexity API
+    Отправить запрос к LLM
     
     Args:
         messages: Список сообщений [{"role": "user", "content": "..."}, ...]
-        model: Название модели (по умолчанию из config)
+        model: Название модели (по умолчанию - модель бэкенда)
         temperature: Температура генерации (0.0-1.0)
         max_tokens: Максимальное количество токенов в ответе
+        backend: perplexity / openai / fake (по умолчанию LLM_BACKEND)
     
     Returns:
         Текст ответа от модели
-    """
-    if not PERPLEXITY_API_KEY:
-        raise ValueError(
-            "PERPLEXITY_API_KEY не установлен. "
-            "Создайте файл .env и добавьте: PERPLEXITY_API_KEY=ваш_ключ"
-        )
-    
-    model = model or PPLX_MODEL_GENERAL
-    
-    headers = {
-        "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-        "Content-Type": "application/json",
-    }
     
-    payload: Dict[str, Any] = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-    }
-    
-    try:
-        resp = requests.post(PPLX_URL, json=payload, headers=headers, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"]
-        
-    except requests.exceptions.HTTPError as e:
-        raise RuntimeError(f"Ошибка HTTP при обращении к Perplexity API: {e}")
-    except requests.exceptions.RequestException as e:
-        raise RuntimeError(f"Ошибка соединения с Perplexity API: {e}")
-    except (KeyError, IndexError) as e:
-        raise RuntimeError(f"Неожиданный формат ответа от Perplexity API: {e}")
+    Raises:
+        LLMError (RuntimeError): ошибка после повторов; CircuitOpenError -
+        LLM недоступна и запрос не отправлялся
+    """
+    return get_backend(backend).chat(messages, model=model, temperature=temperature, max_tokens=max_tokens)
+
+
+# Прежнее имя: вызовы идут через бэкенд по умолчанию
+pplx_chat = chat
 
 
 # Тестирование
 if __name__ == "__main__":
-    print("🧪 Тест Perplexity API")
-    print()
+    print("🧪 Тест LLM")
+    print(chat([{"role": "user", "content": "Объясни кратко, что такое 3D-печать"}], max_tokens=200))
@@ -1,11 +1,13 @@
 """
 RAG Pipeline - оптимизированная версия с FAISS и Perplexity API
 """
+import contextvars
 import os
 import sys
-import json
+import threading
 import time
-from typing import Optional, Dict, Any, List, Literal
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Optional, Dict, Any, List, Literal, Sequence, Tuple
 from pathlib import Path
 
 # Добавляем корневую директорию в путь для импортов
@@ -16,11 +18,82 @@ import numpy as np
 
 # Импорты с обработкой ошибок для прямого запуска
 try:
-    from .config import DATA_DIR, TOP_K_DOCUMENTS
-    from .models import pplx_chat
+    from .config import (
+        TOP_K_DOCUMENTS,
+        RETRIEVAL_MODE,
+        RETRIEVAL_SOCKET,
+        LLM_COALESCE,
+        ANSWER_MODE,
+        EXTRACTIVE_FALLBACK,
+        LLM_ANSWER_DEADLINE_S,
+        RAG_WORKER_THREADS,
+        SEARCH_FILTER_OVERFETCH,
+        MMR_FETCH_FACTOR,
+        PROCESSED_DATA_PATH,
+    )
+    from .models import chat as llm_chat
+    from .diversify import mmr, reconstruct, merge_adjacent
+    from .extractive import extractive_answer
+    from .context_packer import pack_context
+    from .dialog_memory import DialogMemory
+    from .retrieval_service import RemoteRetriever
+    from .index_manager import IndexSnapshot, _articles_from_jsonl
+    from .kb_registry import KBRegistry
+    from .singleflight import SingleFlight, normalize_question, make_key
+    from .thread_budget import compute_slot
+    from .routing import RoutingTable, Route
+    from .keywords import get_engine, KeywordMatches
+    from .intent_classifier import get_classifier, Classification
+    from . import tracing
+    from . import metrics
 except ImportError:
-    from src.config import DATA_DIR, TOP_K_DOCUMENTS
-    from src.models import pplx_chat
+    from src.config import (
+        TOP_K_DOCUMENTS,
+        RETRIEVAL_MODE,
+        RETRIEVAL_SOCKET,
+        LLM_COALESCE,
+        ANSWER_MODE,
+        EXTRACTIVE_FALLBACK,
+        LLM_ANSWER_DEADLINE_S,
+        RAG_WORKER_THREADS,
+        SEARCH_FILTER_OVERFETCH,
+        MMR_FETCH_FACTOR,
+        PROCESSED_DATA_PATH,
+    )
+    from src.models import chat as llm_chat
+    from src.diversify import mmr, reconstruct, merge_adjacent
+    from src.extractive import extractive_answer
+    from src.context_packer import pack_context
+    from src.dialog_memory import DialogMemory
+    from src.retrieval_service import RemoteRetriever
+    from src.index_manager import IndexSnapshot, _articles_from_jsonl
+    from src.kb_registry import KBRegistry
+    from src.singleflight import SingleFlight, normalize_question, make_key
+    from src.thread_budget import compute_slot
+    from src.routing import RoutingTable, Route
+    from src.keywords import get_engine, KeywordMatches
+    from src.intent_classifier import get_classifier, Classification
+    from src import tracing
+    from src import metrics
+
+# Версия индекса и эмбеддинги вопросов, вычисленные её моделью
+Embedded = Tuple[IndexSnapshot, np.ndarray]
+
+# Причины извлекающего ответа -> пояснение в его заголовке
+_EXTRACTIVE_REASONS = {
+    "requested": "",
+    "llm_error": "LLM недоступна",
+    "llm_timeout": "LLM не ответила вовремя",
+    "empty_context": "документы не поместились в контекст",
+}
+
+def _answer_mode(mode: str, reason: str):
+    """Учесть способ ответа в метриках и атрибутах трассы"""
+    metrics.ANSWERS.labels(mode=mode, reason=reason).inc()
+    trace = tracing.current_trace()
+    if trace is not None:
+        trace.attrs.update(answer_mode=mode, answer_reason=reason)
+
 
 # Типы категорий
 Category = Literal[
@@ -36,118 +109,346 @@ Category = Literal[
 class RAGPipeline:
     """
     Оптимизированная RAG-система с несколькими агентами:
-    1. Классификатор - определяет категорию запроса (по ключевым словам)
-    2. Поисковик - ищет релевантные документы (FAISS)
+    1. Классификатор - определяет категорию запроса (эмбеддинг вопроса и ключевые слова)
+    2. Поисковик - ищет релевантные документы (FAISS) в одной или нескольких базах знаний
     3. Консультант - формирует детальный ответ (Perplexity)
     4. Валидатор - проверяет безопасность (простая проверка слов)
     """
     
-    def __init__(self):
-        """Инициализация RAG-системы"""
-        self.knowledge_base = []
-        self.faiss_index = None
-        self.embeddings_model = None
-        self._load_knowledge_base()
-        self._load_faiss_index()
-    
-    def _load_knowledge_base(self):
-        """Загрузка базы знаний"""
-        kb_path = DATA_DIR / "processed.jsonl"
+    def __init__(self, retrieval_mode: str = RETRIEVAL_MODE):
+        """
+        Инициализация RAG-системы
         
-        if not kb_path.exists():
-            print(f"⚠️ База знаний не найдена: {kb_path}")
+        Args:
+            retrieval_mode: inprocess - модель и индекс в этом процессе,
+                remote - поиск в отдельном процессе (python -m src.retrieval_service)
+        """
+        self.index_manager = None
+        self.kbs = None
+        self.remote_retriever = None
+        self.dialog_memory = DialogMemory()
+        self.llm_flight = SingleFlight("llm") if LLM_COALESCE else None
+        self.routing = RoutingTable()
+        self.keywords = get_engine()
+        self.classifier = get_classifier()
+        # Генерация с ограничением по времени идёт в отдельном пуле: по истечении
+        # срока отвечаем без LLM, а начатый запрос завершается в фоне
+        self.llm_pool = (
+            ThreadPoolExecutor(max_workers=RAG_WORKER_THREADS, thread_name_prefix="llm-answer")
+            if LLM_ANSWER_DEADLINE_S > 0 else None
+        )
+        # Статьи для текстового поиска, если сервис поиска недоступен
+        # (загружаются при первом сбое)
+        self._fallback_kb: Optional[List[Dict[str, Any]]] = None
+        self._fallback_lock = threading.Lock()
+        if retrieval_mode == "remote":
+            self.remote_retriever = RemoteRetriever(RETRIEVAL_SOCKET)
+            print(f"✅ Поиск через сервис: {RETRIEVAL_SOCKET}")
             return
+        # Основная база загружается сразу, остальные - при первом запросе к ним
+        self.kbs = KBRegistry()
+        self.index_manager = self.kbs.manager(self.kbs.default)
+    
+    def _snapshot(self) -> Optional[IndexSnapshot]:
+        """Текущая версия индекса (берётся один раз на операцию)"""
+        return self.index_manager.current if self.index_manager is not None else None
+    
+    @property
+    def knowledge_base(self) -> List[Dict[str, Any]]:
+        snapshot = self._snapshot()
+        return snapshot.knowledge_base if snapshot else []
+    
+    @property
+    def faiss_index(self):
+        snapshot = self._snapshot()
+        return snapshot.faiss_index if snapshot else None
+    
+    @property
+    def embeddings_model(self):
+        snapshot = self._snapshot()
+        return snapshot.embeddings_model if snapshot else None
+    
+    def _kb_names(self, kbs: Optional[Sequence[str]] = None, route: Optional[Route] = None) -> Optional[List[str]]:
+        """
+        Базы знаний для поиска: из запроса, иначе из маршрута категории
         
-        try:
-            with open(kb_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    if line.strip():
-                        self.knowledge_base.append(json.loads(line))
-            print(f"✅ Загружено {len(self.knowledge_base)} документов")
-        except Exception as e:
-            print(f"❌ Ошибка загрузки базы знаний: {e}")
+        None - только основная база (обычный поиск). Неизвестная база в
+        запросе - ValueError, в маршруте - предупреждение.
+        """
+        if kbs:
+            if self.kbs is None:
+                raise ValueError("выбор базы знаний недоступен при поиске через сервис (RETRIEVAL_MODE=remote)")
+            names = self.kbs.resolve(kbs)
+        elif route is not None and route.kbs and self.kbs is not None:
+            names = self.kbs.resolve(route.kbs, strict=False)
+        else:
+            return None
+        return names if names and names != [self.kbs.default] else None
     
-    def _load_faiss_index(self):
-        """Загрузка FAISS индекса"""
-        faiss_path = DATA_DIR / "faiss_index"
-        index_file = faiss_path / "index.faiss"
-        
-        if not index_file.exists():
-            print(f"⚠️ FAISS индекс не найден: {index_file}")
-            print("Запустите: python -m src.embeddings_store_faiss")
-            return
+    def _kb_snapshots(self, names: List[str]) -> List[Tuple[str, IndexSnapshot]]:
+        """Текущие версии баз (незагруженные загружаются); база с ошибкой загрузки пропускается"""
+        snapshots = []
+        for name in names:
+            try:
+                snapshots.append((name, self.kbs.snapshot(name)))
+            except Exception as e:
+                print(f"⚠️ База знаний {name} недоступна: {e}")
+                metrics.ERRORS.labels(stage="kb.load", type=type(e).__name__).inc()
+                trace = tracing.current_trace()
+                if trace is not None:
+                    trace.attrs.setdefault("missing_kbs", []).append(name)
+        return snapshots
+    
+    def _classify_query(
+        self,
+        user_query: str,
+        matches: Optional[KeywordMatches] = None,
+        embedded: Optional[Embedded] = None
+    ) -> Classification:
+        """
+        Классификация по эмбеддингу вопроса (центроиды категорий), затем по ключевым словам
+        
+        LLM спрашивается, только если центроиды есть, но не уверены, а
+        ключевых слов категорий в вопросе нет.
+        """
+        if embedded is None:
+            return self.classifier.classify(user_query, matches=matches, use_llm=False)
+        snapshot, vectors = embedded
+        return self.classifier.classify(user_query, vectors[0], snapshot.model_name, matches)
+    
+    def _embed_queries(self, queries: List[str], snapshot: Optional[IndexSnapshot] = None) -> Optional[Embedded]:
+        """Эмбеддинги вопросов моделью версии `snapshot` (по умолчанию - текущей основной базы)"""
+        # Индекс, чанки и модель берутся из одной версии, даже если её подменят во время поиска
+        snapshot = snapshot or self._snapshot()
+        if snapshot is None or snapshot.faiss_index is None or snapshot.embeddings_model is None:
+            return None
+        with tracing.span("embed", batch=len(queries)), compute_slot("embed"):
+            return snapshot, np.asarray(snapshot.embeddings_model.encode(queries), dtype=np.float32)
+    
+    def _search_documents(self, query: str, top_k: int = 3, embedded: Optional[Embedded] = None) -> List[Dict[str, Any]]:
+        """Поиск релевантных документов через FAISS"""
+        if self.remote_retriever is not None:
+            return self._search_remote([query], top_k)[0]
+        return self._search_documents_batch([query], top_k, embedded)[0]
+    
+    def _search_documents_batch(
+        self,
+        queries: List[str],
+        top_k: int = 3,
+        embedded: Optional[Embedded] = None,
+        snapshot: Optional[IndexSnapshot] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        Пакетный поиск: одно кодирование и один проход FAISS на все вопросы
         
+        `embedded` - уже вычисленные эмбеддинги (например, при классификации);
+        поиск идёт по той же версии индекса, что и кодирование. `snapshot` -
+        версия другой базы знаний (по умолчанию - основная).
+        """
+        fallback_kb = snapshot.knowledge_base if snapshot is not None else None
         try:
-            import faiss
-            self.faiss_index = faiss.read_index(str(index_file))
-            print(f"✅ FAISS индекс загружен ({self.faiss_index.ntotal} векторов)")
+            embedded = embedded or self._embed_queries(queries, snapshot)
+            if embedded is None:
+                metrics.FALLBACK_SEARCH.labels(reason="no_index").inc(len(queries))
+                return [self._simple_text_search(q, top_k, fallback_kb) for q in queries]
+            snapshot, query_vectors = embedded
+            knowledge_base = snapshot.knowledge_base
             
-            from sentence_transformers import SentenceTransformer
-            self.embeddings_model = SentenceTransformer('intfloat/multilingual-e5-large')
-            print("✅ Модель эмбеддингов загружена")
+            with tracing.span("search", top_k=top_k, batch=len(queries)), compute_slot("search"):
+                distances, indices = snapshot.faiss_index.search(query_vectors, top_k)
+            
+            batch_results = []
+            for row_indices, row_distances in zip(indices, distances):
+                results = []
+                for idx, distance in zip(row_indices, row_distances):
+                    if 0 <= idx < len(knowledge_base):
+                        doc = knowledge_base[idx].copy()
+                        doc['score'] = 1.0 / (1.0 + float(distance))
+                        doc['vector_id'] = int(idx)
+                        results.append(doc)
+                batch_results.append(results)
+            
+            return batch_results
             
-        except ImportError:
-            print("❌ Установите: pip install faiss-cpu sentence-transformers")
         except Exception as e:
-            print(f"❌ Ошибка загрузки FAISS: {e}")
+            print(f"⚠️ Ошибка FAISS поиска: {e}")
+            metrics.ERRORS.labels(stage="search", type=type(e).__name__).inc()
+            metrics.FALLBACK_SEARCH.labels(reason="faiss_error").inc(len(queries))
+            return [self._simple_text_search(q, top_k, fallback_kb) for q in queries]
     
-    def _classify_query(self, user_query: str) -> Category:
-        """Быстрая классификация по ключевым словам (БЕЗ LLM)"""
-        query_lower = user_query.lower()
+    def _search_federated(
+        self,
+        queries: List[str],
+        top_k: int,
+        snapshots: List[Tuple[str, IndexSnapshot]],
+        vectors: Optional[Dict[str, np.ndarray]] = None
+    ) -> Tuple[List[List[Dict[str, Any]]], Optional[Embedded]]:
+        """
+        Поиск по нескольким базам знаний с объединением по score
         
-        # Диагностика дефектов
-        if any(word in query_lower for word in ["забилось", "забилась", "сопло", "экструдер", "дефект", "слои", "полосы", "трещины", "расслаивается", "не прилипает", "отклеивается"]):
-            return "диагностика_дефектов"
+        Вопросы кодируются один раз на модель эмбеддингов: `vectors` (имя
+        модели -> эмбеддинги) дополняется и переиспользуется между вызовами.
+        Оценки баз сравнимы, если базы построены одной моделью. Чанки
+        помечаются полем `kb`; эмбеддинги для MMR возвращаются, только если
+        база одна (номера векторов разных баз несопоставимы).
+        """
+        vectors = {} if vectors is None else vectors
+        merged: List[List[Dict[str, Any]]] = [[] for _ in queries]
+        embedded = None
+        for name, snapshot in snapshots:
+            embedded = None
+            if snapshot.faiss_index is not None and snapshot.embeddings_model is not None:
+                if snapshot.model_name not in vectors:
+                    try:
+                        vectors[snapshot.model_name] = self._embed_queries(queries, snapshot)[1]
+                    except Exception as e:
+                        print(f"⚠️ Ошибка кодирования вопроса ({name}): {e}")
+                        metrics.ERRORS.labels(stage="embed", type=type(e).__name__).inc()
+                if snapshot.model_name in vectors:
+                    embedded = (snapshot, vectors[snapshot.model_name])
+            with tracing.span("kb", kb=name, top_k=top_k):
+                batch = self._search_documents_batch(queries, top_k, embedded, snapshot)
+            for docs, found in zip(merged, batch):
+                for doc in found:
+                    doc['kb'] = name
+                docs.extend(found)
+        merged = [sorted(docs, key=lambda d: d.get('score', 0.0), reverse=True)[:top_k] for docs in merged]
+        return merged, embedded if len(snapshots) == 1 else None
+    
+    def _select_documents(
+        self,
+        documents: List[Dict[str, Any]],
+        embedded: Optional[Embedded],
+        top_k: int,
+        route: Route
+    ) -> List[Dict[str, Any]]:
+        """
+        Отбор top_k из кандидатов по маршруту: MMR по векторам кандидатов
+        (если есть эмбеддинг вопроса) и склейка соседних чанков статьи
+        """
+        ids = [d.get('vector_id') for d in documents]
+        if (
+            route.mmr_lambda is not None
+            and embedded is not None
+            and len(documents) > top_k
+            and None not in ids
+        ):
+            snapshot, vectors = embedded
+            with tracing.span("mmr", candidates=len(documents), mmr_lambda=route.mmr_lambda):
+                order = mmr(vectors[0], reconstruct(snapshot.faiss_index, ids), top_k, route.mmr_lambda)
+            documents = [documents[i] for i in order]
+        documents = documents[:top_k]
+        if route.merge_adjacent:
+            documents = merge_adjacent(documents)
+        return documents
+    
+    def search_page(
+        self,
+        queries: List[str],
+        offset: int = 0,
+        limit: int = 10,
+        categories: Optional[Sequence[str]] = None,
+        kbs: Optional[Sequence[str]] = None
+    ) -> Tuple[List[List[Dict[str, Any]]], List[bool], str]:
+        """
+        Страница результатов поиска без генерации ответа (для /search)
         
-        # Подбор материала
-        elif any(word in query_lower for word in ["материал", "pla", "abs", "petg", "filament", "пластик", "филамент", "tpu", "nylon"]):
-            return "подбор_материала"
+        `categories` - разделы базы знаний (поле category чанка, например
+        Fdm_Materials); с фильтром из FAISS берётся больше кандидатов, пока
+        страница не заполнится или индекс не кончится. Возвращает страницы
+        чанков (с `rank`), признаки наличия следующей страницы и версию индекса.
         
-        # Настройка принтера
-        elif any(word in query_lower for word in ["настройка", "калибровка", "температура", "скорость", "ретракт", "настроить", "откалибровать"]):
-            return "настройка_принтера"
+        `kbs` - базы знаний (kb_registry.py), результаты которых объединяются
+        по score; версия тогда составная (<база>@<версия>+...).
+        """
+        allowed = {c.lower() for c in categories} if categories else None
+        needed = offset + limit + 1
+        names = self._kb_names(kbs)
         
-        # Слайсер
-        elif any(word in query_lower for word in ["слайсер", "cura", "prusaslicer", "slicer", "нарезка"]):
-            return "слайсер"
+        # Эмбеддинги считаются один раз и переиспользуются при расширении выборки
+        embedded = None
+        vectors: Dict[str, np.ndarray] = {}
+        if names is not None:
+            snapshots = self._kb_snapshots(names)
+            version = "+".join(f"{name}@{s.version}" for name, s in snapshots) or "none"
+            total = sum(s.faiss_index.ntotal if s.faiss_index is not None else len(s.knowledge_base) for _, s in snapshots)
+        else:
+            snapshot = self._snapshot()
+            version = snapshot.version if snapshot is not None else "remote"
+            total = len(snapshot.knowledge_base) if snapshot is not None else needed * SEARCH_FILTER_OVERFETCH
+            if snapshot is not None and snapshot.faiss_index is not None:
+                total = snapshot.faiss_index.ntotal
+            if self.remote_retriever is None:
+                embedded = self._embed_queries(queries)
+                if embedded is not None:
+                    version = embedded[0].version
         
-        # Основы / выбор принтера
-        elif any(word in query_lower for word in ["начинаю", "новичок", "первый", "основы", "выбрать", "принтер", "какой принтер"]):
-            return "основы"
+        k = max(1, min(total, needed if allowed is None else needed * SEARCH_FILTER_OVERFETCH))
+        while True:
+            if self.remote_retriever is not None:
+                batch = self._search_remote(queries, k)
+            elif names is not None:
+                batch = self._search_federated(queries, k, snapshots, vectors)[0]
+            else:
+                batch = self._search_documents_batch(queries, k, embedded)
+            if allowed is not None:
+                batch = [[d for d in docs if str(d.get('category', '')).lower() in allowed] for docs in batch]
+            if k >= total or all(len(docs) >= needed for docs in batch):
+                break
+            k = min(total, k * 4)
         
-        # Остальное
-        else:
-            return "другое"
+        pages, has_more = [], []
+        for docs in batch:
+            page = docs[offset:offset + limit]
+            for rank, doc in enumerate(page, offset + 1):
+                doc['rank'] = rank
+            pages.append(page)
+            has_more.append(len(docs) > offset + limit)
+        return pages, has_more, version
     
-    def _search_documents(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
-        """Поиск релевантных документов через FAISS"""
-        if not self.faiss_index or not self.embeddings_model:
-            return self._simple_text_search(query, top_k)
-        
+    def _search_remote(self, queries: List[str], top_k: int) -> List[List[Dict[str, Any]]]:
+        """
+        Поиск через отдельный процесс retrieval_service
+
+        Если сервис недоступен или не ответил вовремя - деградация до
+        текстового поиска по статьям processed.jsonl этого процесса.
+        """
         try:
-            query_embedding = self.embeddings_model.encode([query])[0]
-            query_vector = np.array([query_embedding], dtype=np.float32)
-            
-            distances, indices = self.faiss_index.search(query_vector, top_k)
-            
-            results = []
-            for idx in indices[0]:
-                if 0 <= idx < len(self.knowledge_base):
-                    doc = self.knowledge_base[idx].copy()
-                    results.append(doc)
-            
-            return results
-            
+            with tracing.span("retrieve.remote", batch=len(queries)):
+                return self.remote_retriever.search_batch(queries, top_k)
         except Exception as e:
-            print(f"⚠️ Ошибка FAISS поиска: {e}")
-            return self._simple_text_search(query, top_k)
+            print(f"⚠️ Ошибка сервиса поиска: {e} - текстовый поиск по {PROCESSED_DATA_PATH.name}")
+            metrics.ERRORS.labels(stage="retrieve.remote", type=type(e).__name__).inc()
+        metrics.FALLBACK_SEARCH.labels(reason="remote_error").inc(len(queries))
+        trace = tracing.current_trace()
+        if trace is not None:
+            trace.attrs["retrieval"] = "degraded"
+        knowledge_base = self._fallback_knowledge_base()
+        return [self._simple_text_search(query, top_k, knowledge_base) for query in queries]
+    
+    def _fallback_knowledge_base(self) -> List[Dict[str, Any]]:
+        """Статьи processed.jsonl для текстового поиска без сервиса (загружаются один раз)"""
+        with self._fallback_lock:
+            if self._fallback_kb is None:
+                try:
+                    self._fallback_kb = _articles_from_jsonl(PROCESSED_DATA_PATH)
+                    print(f"✅ Для поиска без сервиса загружено {len(self._fallback_kb)} статей")
+                except OSError as e:
+                    print(f"⚠️ База знаний для поиска без сервиса не загружена: {e}")
+                    self._fallback_kb = []
+            return self._fallback_kb
     
-    def _simple_text_search(self, query: str, top_k: int) -> List[Dict[str, Any]]:
-        """Упрощенный текстовый поиск"""
+    def _simple_text_search(
+        self,
+        query: str,
+        top_k: int,
+        knowledge_base: Optional[List[Dict[str, Any]]] = None
+    ) -> List[Dict[str, Any]]:
+        """Упрощенный текстовый поиск (по умолчанию - по основной базе)"""
         query_lower = query.lower()
         scored_docs = []
         
-        for doc in self.knowledge_base:
+        for doc in self.knowledge_base if knowledge_base is None else knowledge_base:
             score = 0
             content = doc.get('content', '').lower()
             title = doc.get('title', '').lower()
@@ -161,33 +462,47 @@ class RAGPipeline:
                 scored_docs.append((score, doc))
         
         scored_docs.sort(reverse=True, key=lambda x: x[0])
-        return [doc for score, doc in scored_docs[:top_k]]
+        if not scored_docs:
+            return []
+        
+        max_score = scored_docs[0][0]
+        results = []
+        for score, doc in scored_docs[:top_k]:
+            doc = doc.copy()
+            doc['score'] = score / max_score
+            results.append(doc)
+        return results
     
     def _generate_answer(
         self, 
         user_query: str, 
         category: Category,
         documents: List[Dict[str, Any]],
-        dialog_context: str = ""
+        dialog_context: str = "",
+        route: Optional[Route] = None,
+        mode: str = "llm"
     ) -> str:
-        """Генерация детального ответа через Perplexity"""
+        """
+        Генерация детального ответа через LLM с параметрами маршрута
+        
+        mode=extractive - ответ из предложений документов без LLM; он же
+        отдаётся при ошибке LLM или превышении LLM_ANSWER_DEADLINE_S.
+        """
         if not documents:
+            _answer_mode("fallback", "no_documents")
             return self._generate_fallback_answer(user_query, category)
+        if mode == "extractive":
+            return self._extractive_answer(user_query, category, documents, "requested")
+        route = route or self.routing.select(category, user_query)
         
-        context_parts = []
-        for i, doc in enumerate(documents, 1):
-            title = doc.get('title', 'Без заголовка')
-            content = doc.get('content', '')[:800]
-            url = doc.get('source_url', 'N/A')
-            
-            context_parts.append(
-                f"[Документ {i}]\n"
-                f"Заголовок: {title}\n"
-                f"Источник: {url}\n"
-                f"Содержание: {content}\n"
-            )
-        
-        context_text = "\n".join(context_parts)
+        with tracing.span("pack"):
+            packed = pack_context(user_query, documents, route.context_budget)
+        print(f"📦 Контекст: {packed.used_tokens}/{packed.budget} токенов ({len(packed.documents)} из {len(documents)} док.)")
+        if not packed.documents:
+            # Документы есть, но ни один не влез в бюджет - ответ из них без LLM
+            return self._extractive_answer(user_query, category, documents, "empty_context")
+        documents = packed.documents
+        context_text = packed.text
         
         system_prompt = (
             "Ты эксперт по 3D-печати с многолетним опытом. "
@@ -207,15 +522,36 @@ class RAGPipeline:
             "Дай структурированный ответ."
         )
         
-        try:
-            answer = pplx_chat(
+        def _call_llm() -> str:
+            return llm_chat(
                 messages=[
                     {"role": "system", "content": system_prompt},
                     {"role": "user", "content": user_prompt}
                 ],
-                temperature=0.4,
-                max_tokens=1200
+                model=route.model,
+                temperature=route.temperature,
+                max_tokens=route.max_tokens,
+                backend=route.backend
             )
+        
+        def _generate() -> str:
+            with tracing.span("llm") as s:
+                if self.llm_flight is None:
+                    return _call_llm()
+                # Тот же вопрос с тем же контекстом уже генерируется - ждём его
+                key = make_key(normalize_question(user_query), route.name, dialog_context, context_text)
+                answer, shared = self.llm_flight.do(key, _call_llm)
+                if s is not None:
+                    s.attrs["coalesced"] = shared
+                return answer
+        
+        try:
+            if self.llm_pool is None:
+                answer = _generate()
+            else:
+                future = self.llm_pool.submit(contextvars.copy_context().run, _generate)
+                answer = future.result(timeout=LLM_ANSWER_DEADLINE_S)
+            _answer_mode("llm", "requested")
             
             answer += "\n\n📚 Источники:\n"
             for i, doc in enumerate(documents, 1):
@@ -225,9 +561,32 @@ class RAGPipeline:
             
             return answer
             
+        except FutureTimeout:
+            print(f"⚠️ LLM не ответила за {LLM_ANSWER_DEADLINE_S:.1f}s - ответ без LLM")
+            metrics.ERRORS.labels(stage="generate", type="Timeout").inc()
+            return self._extractive_answer(user_query, category, documents, "llm_timeout")
         except Exception as e:
             print(f"⚠️ Ошибка генерации ответа: {e}")
+            metrics.ERRORS.labels(stage="generate", type=type(e).__name__).inc()
+            return self._extractive_answer(user_query, category, documents, "llm_error")
+    
+    def _extractive_answer(
+        self,
+        user_query: str,
+        category: Category,
+        documents: List[Dict[str, Any]],
+        reason: str
+    ) -> str:
+        """Ответ без LLM из найденных документов; если он невозможен - резервный"""
+        answer = None
+        if reason == "requested" or EXTRACTIVE_FALLBACK:
+            with tracing.span("extractive", reason=reason):
+                answer = extractive_answer(user_query, documents, reason=_EXTRACTIVE_REASONS[reason])
+        if answer is None:
+            _answer_mode("fallback", reason)
             return self._generate_fallback_answer(user_query, category)
+        _answer_mode("extractive", reason)
+        return answer
     
     def _generate_fallback_answer(self, query: str, category: Category) -> str:
         """Резервный ответ"""
@@ -239,13 +598,7 @@ class RAGPipeline:
     
     def _validate_safety(self, answer: str) -> str:
         """Простая проверка опасных ключевых слов (БЕЗ LLM)"""
-        dangerous_keywords = [
-            "токсичн", "ядовит", "взрывоопасн", "взрыв", 
-            "горюч", "легковоспламеня", "пожар", "отравлен"
-        ]
-        
-        answer_lower = answer.lower()
-        has_danger = any(keyword in answer_lower for keyword in dangerous_keywords)
+        has_danger = bool(self.keywords.scan(answer, "safety").group("safety"))
         
         if has_danger:
             return "⚠️ БЕЗОПАСНОСТЬ: Соблюдайте технику безопасности при работе с материалами.\n\n" + answer
@@ -255,56 +608,140 @@ class RAGPipeline:
     def query(
         self, 
         question: str, 
-        top_k: int = 3,
+        top_k: Optional[int] = None,
         dialog_context: str = "",
-        enable_validation: bool = True
+        enable_validation: bool = True,
+        session_id: Optional[str] = None,
+        mode: Optional[str] = None,
+        kbs: Optional[List[str]] = None
     ) -> str:
-        """Полная обработка запроса с логированием времени"""
-        if not self.knowledge_base:
+        """
+        Полная обработка запроса с трассировкой этапов
+        
+        Если вызывающий код активировал трассу (tracing.activate), спаны
+        пишутся в неё, иначе создаётся и выгружается собственная трасса.
+        
+        С `session_id` используется память диалога: уточняющий вопрос
+        дополняется темой прошлого хода, история попадает в контекст, а при
+        неизменной теме повторно используются найденные ранее документы.
+        
+        Модель, max_tokens, температура, бюджет контекста и (если не задан
+        явно) `top_k` берутся из маршрута категории (см. routing.py).
+        
+        `mode` - llm или extractive (ответ из найденных документов без LLM,
+        за миллисекунды); по умолчанию ANSWER_MODE.
+        
+        `kbs` - базы знаний для поиска (иначе - из маршрута категории, а без
+        них - основная); результаты нескольких баз объединяются по score.
+        """
+        if not self.knowledge_base and self.remote_retriever is None:
             return "❌ База знаний не загружена."
         
-        # Проверка на тему 3D-печати
-        relevant_keywords = [
-            "принтер", "печат", "3d", "pla", "abs", "petg", "сопло", 
-            "экструдер", "слайсер", "филамент", "модель", "слой"
-        ]
-        if not any(kw in question.lower() for kw in relevant_keywords):
+        search_query = question
+        if session_id:
+            search_query, _ = self.dialog_memory.rewrite_query(session_id, question)
+            dialog_context = dialog_context or self.dialog_memory.context(session_id)
+        
+        # Проверка на тему 3D-печати; тот же проход даёт веса категорий
+        matches = self.keywords.scan(search_query)
+        if not matches.group("topic"):
             return (
                 "Я специализируюсь на вопросах о 3D-печати. "
                 "Пожалуйста, задайте вопрос по этой теме (например, о выборе принтера, "
                 "настройке печати, устранении дефектов)."
             )
         
+        trace = tracing.current_trace()
+        owns_trace = trace is None
+        if owns_trace:
+            trace = tracing.Trace("query")
+        started = time.perf_counter()
+        category = "unknown"
+        
         try:
-            start = time.time()
-            
-            # Классификация (БЕЗ LLM - мгновенно)
-            t1 = time.time()
-            category = self._classify_query(question)
-            print(f"⏱️ Классификация: {time.time() - t1:.2f}s (категория: {category})")
+            with tracing.activate(trace):
+                # Эмбеддинг вопроса нужен и классификатору, и поиску - кодируем один раз
+                embedded = None
+                if self.classifier.centroid is not None and self.remote_retriever is None:
+                    try:
+                        embedded = self._embed_queries([search_query])
+                    except Exception as e:
+                        print(f"⚠️ Ошибка кодирования вопроса: {e}")
+                        metrics.ERRORS.labels(stage="embed", type=type(e).__name__).inc()
+                
+                # Классификация (центроиды и ключевые слова; LLM - только при низкой уверенности)
+                with trace.span("classify") as s:
+                    classification = self._classify_query(search_query, matches, embedded)
+                    category = classification.category
+                    s.attrs.update(source=classification.source, confidence=round(classification.confidence, 3))
+                trace.attrs["category"] = category
+                # Сложность - по самому вопросу: дополненный темой прошлого хода
+                # «вопрос? (прошлый вопрос?)» выглядел бы составным
+                route = self.routing.select(category, question)
+                top_k = top_k or route.top_k
+                trace.attrs.update(route=route.name, model=route.model, max_tokens=route.max_tokens, top_k=top_k)
+                kb_names = self._kb_names(kbs, route)
+                if kb_names is not None:
+                    trace.attrs["kbs"] = kb_names
+                metrics.ROUTE_REQUESTS.labels(route=route.name, model=route.model).inc()
+                print(f"🧭 Маршрут {route.name}: модель {route.model}, max_tokens={route.max_tokens}, top_k={top_k}")
+                
+                # Поиск документов (FAISS - быстро) или результаты прошлого хода
+                with trace.span("retrieve", top_k=top_k) as s:
+                    documents = None
+                    if session_id:
+                        documents = self.dialog_memory.reusable_documents(session_id, question)
+                        metrics.cache_hit("dialog_retrieval", documents is not None)
+                        s.attrs["reused"] = documents is not None
+                    if documents is None:
+                        # Для MMR нужны эмбеддинг вопроса и больше кандидатов
+                        fetch_k = top_k
+                        if route.mmr_lambda is not None and self.remote_retriever is None:
+                            fetch_k = top_k * MMR_FETCH_FACTOR
+                            if embedded is None:
+                                try:
+                                    embedded = self._embed_queries([search_query])
+                                except Exception as e:
+                                    print(f"⚠️ Ошибка кодирования вопроса: {e}")
+                                    metrics.ERRORS.labels(stage="embed", type=type(e).__name__).inc()
+                        if kb_names is None:
+                            documents = self._search_documents(search_query, fetch_k, embedded)
+                        else:
+                            vectors = {embedded[0].model_name: embedded[1]} if embedded is not None else {}
+                            batch, embedded = self._search_federated(
+                                [search_query], fetch_k, self._kb_snapshots(kb_names), vectors
+                            )
+                            documents = batch[0]
+                        documents = self._select_documents(documents, embedded, top_k, route)
+                    s.attrs["found"] = len(documents)
+                trace.attrs["sources"] = len(documents)
+                
+                # Генерация ответа (LLM - основная задержка)
+                with trace.span("generate", route=route.name) as s:
+                    answer = self._generate_answer(
+                        question, category, documents, dialog_context, route, mode or ANSWER_MODE
+                    )
+                metrics.ROUTE_GENERATE_LATENCY.labels(route=route.name).observe(s.duration_ms / 1000)
+                
+                # Валидация безопасности (БЕЗ LLM - мгновенно)
+                if enable_validation:
+                    with trace.span("validate"):
+                        answer = self._validate_safety(answer)
             
-            # Поиск документов (FAISS - быстро)
-            t2 = time.time()
-            documents = self._search_documents(question, top_k)
-            print(f"⏱️ Поиск: {time.time() - t2:.2f}s (найдено: {len(documents)} док.)")
-            
-            # Генерация ответа (Perplexity - основная задержка)
-            t3 = time.time()
-            answer = self._generate_answer(question, category, documents, dialog_context)
-            print(f"⏱️ Генерация: {time.time() - t3:.2f}s")
-            
-            # Валидация безопасности (БЕЗ LLM - мгновенно)
-            if enable_validation:
-                t4 = time.time()
-                answer = self._validate_safety(answer)
-                print(f"⏱️ Валидация: {time.time() - t4:.2f}s")
-            
-            print(f"⏱️ ИТОГО: {time.time() - start:.2f}s")
+            if session_id:
+                self.dialog_memory.add_turn(session_id, question, answer, category, documents)
             return answer
             
         except Exception as e:
+            trace.attrs["error"] = type(e).__name__
+            metrics.ERRORS.labels(stage="query", type=type(e).__name__).inc()
             print(f"❌ Ошибка обработки запроса: {e}")
             return f"❌ Ошибка: {str(e)}"
+        
+        finally:
+            metrics.REQUEST_LATENCY.labels(category=category).observe(time.perf_counter() - started)
+            if owns_trace:
+                trace.finish()
 
 
 # Тест
@@ -0,0 +1,272 @@
+"""
+Сервис поиска в отдельном процессе: эмбеддинги + FAISS по Unix-сокету
+
+Поиск (кодирование запроса и FAISS) нагружает CPU и масштабируется иначе,
+чем ожидание ответа LLM. Сервис позволяет держать N процессов поиска и M
+воркеров API/бота на одной машине независимо друг от друга. Запросы,
+пришедшие почти одновременно, объединяются в один пакет: одна операция
+encode и один проход FAISS на весь пакет.
+
+Протокол: сообщения JSON с 4-байтным префиксом длины (big-endian).
+    запрос:  {"queries": ["..."], "top_k": 3}
+    ответ:   {"results": [[{документ}, ...], ...]} или {"error": "..."}
+
+Запуск:
+    python -m src.retrieval_service --workers 2
+    RETRIEVAL_MODE=remote uvicorn src.api:app
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Dict, Any, Callable
+
+if __name__ == "__main__":
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+try:
+    from .config import RETRIEVAL_SOCKET, RETRIEVAL_BATCH_SIZE, RETRIEVAL_BATCH_WAIT_MS
+except ImportError:
+    from src.config import RETRIEVAL_SOCKET, RETRIEVAL_BATCH_SIZE, RETRIEVAL_BATCH_WAIT_MS
+
+_HEADER = struct.Struct("!I")
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+Results = List[List[Dict[str, Any]]]
+
+
+def _encode(obj: Any) -> bytes:
+    body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    return _HEADER.pack(len(body)) + body
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Сервис поиска закрыл соединение")
+        buf += chunk
+    return bytes(buf)
+
+
+class RemoteRetriever:
+    """Клиент сервиса поиска (потокобезопасный: соединение на поток)"""
+
+    def __init__(self, socket_path: str = RETRIEVAL_SOCKET, timeout: float = 10.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _drop_connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            finally:
+                self._local.sock = None
+
+    def _call(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        sock = self._connection()
+        sock.sendall(_encode(payload))
+        (length,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+        if length > MAX_MESSAGE_BYTES:
+            raise ConnectionError(f"Слишком большой ответ сервиса поиска: {length} байт")
+        return json.loads(_recv_exact(sock, length))
+
+    def search_batch(self, queries: List[str], top_k: int = 3) -> Results:
+        """Поиск по нескольким вопросам за один запрос"""
+        payload = {"queries": queries, "top_k": top_k}
+        try:
+            response = self._call(payload)
+        except socket.timeout:
+            # Сервис занят: повтор удвоил бы задержку. Опоздавший ответ остался
+            # бы в соединении и достался следующему запросу - закрываем его
+            self._drop_connection()
+            raise
+        except (OSError, ConnectionError):
+            # Сервис мог перезапуститься - одна повторная попытка с новым соединением
+            self._drop_connection()
+            response = self._call(payload)
+        if "error" in response:
+            raise RuntimeError(f"Сервис поиска: {response['error']}")
+        return response["results"]
+
+    def search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
+        return self.search_batch([query], top_k)[0]
+
+
+class _Batcher:
+    """Объединяет одновременные запросы в пакеты для одного вызова поиска"""
+
+    def __init__(self, search_batch: Callable[[List[str], int], Results], max_batch: int, wait_s: float):
+        self.search_batch = search_batch
+        self.max_batch = max_batch
+        self.wait_s = wait_s
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # Один поток: пока идёт пакет, следующий успевает накопиться
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="retrieval")
+
+    async def submit(self, queries: List[str], top_k: int) -> Results:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((queries, top_k, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.wait_s
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            queries = [q for item in batch for q in item[0]]
+            top_k = max(item[1] for item in batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.search_batch, queries, top_k)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            offset = 0
+            for item_queries, item_top_k, future in batch:
+                chunk = results[offset:offset + len(item_queries)]
+                offset += len(item_queries)
+                if not future.done():
+                    future.set_result([r[:item_top_k] for r in chunk])
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, batcher: _Batcher):
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(_HEADER.size)
+            except asyncio.IncompleteReadError:
+                break
+            (length,) = _HEADER.unpack(header)
+            if length > MAX_MESSAGE_BYTES:
+                break
+            request = json.loads(await reader.readexactly(length))
+            try:
+                results = await batcher.submit(list(request["queries"]), int(request.get("top_k", 3)))
+                response = {"results": results}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            writer.write(_encode(response))
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+def _run_worker(sock: socket.socket, search_batch, max_batch: int, wait_s: float):
+    from src import thread_budget
+
+    # Потоки OpenMP/torch - состояние процесса: задаются заново после fork
+    thread_budget.apply(thread_budget.current())
+
+    async def main():
+        batcher = _Batcher(search_batch, max_batch, wait_s)
+        asyncio.create_task(batcher.run())
+        server = await asyncio.start_unix_server(lambda r, w: _handle(r, w, batcher), sock=sock)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+def serve(socket_path: str, workers: int, max_batch: int, wait_ms: float):
+    """Загрузить модель и индекс, открыть сокет и запустить воркеры"""
+    from src import thread_budget
+
+    # Воркер ищет по одному пакету за раз - пакету все ядра своей доли
+    thread_budget.apply(thread_budget.make_budget(processes=workers, concurrency=1))
+    from src.rag_pipeline import RAGPipeline
+
+    print("🔧 Загрузка модели и индекса для сервиса поиска...")
+    pipeline = RAGPipeline(retrieval_mode="inprocess")
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.listen(1024)
+    print(f"✅ Сервис поиска: {socket_path}, воркеров: {workers}, пакет до {max_batch} / {wait_ms} мс")
+
+    args = (sock, pipeline._search_documents_batch, max_batch, wait_ms / 1000)
+    if workers <= 1:
+        _run_worker(*args)
+        return
+
+    # Как в src.serve: модель загружена до fork и разделяется воркерами
+    gc.collect()
+    gc.freeze()
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                _run_worker(*args)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def _stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    for _ in children:
+        try:
+            os.wait()
+        except ChildProcessError:
+            break
+    os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сервис поиска (эмбеддинги + FAISS)")
+    parser.add_argument("--socket", default=RETRIEVAL_SOCKET)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=RETRIEVAL_BATCH_SIZE)
+    parser.add_argument("--batch-wait-ms", type=float, default=RETRIEVAL_BATCH_WAIT_MS)
+    args = parser.parse_args()
+    serve(args.socket, args.workers, args.batch_size, args.batch_wait_ms)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Таблица маршрутов генерации по категории вопроса
+
+Маршрут задаёт модель (уровень general/strict или имя модели), max_tokens,
+температуру, top_k поиска, бюджет контекста, отбор чанков (MMR, склейка
+соседних, см. diversify.py) и базы знаний, по которым ищется ответ
+(kb_registry.py; по умолчанию - основная). Простые вопросы («основы»)
+получают короткий ответ и меньший контекст, диагностика дефектов - строгую
+модель и больше документов. Длинные и составные вопросы идут по маршруту
+`<категория>:complex`.
+
+Таблицу можно переопределить JSON-файлом ROUTING_TABLE_PATH:
+    {"основы": {"max_tokens": 400}, "другое:complex": {"model": "strict", "mmr_lambda": null},
+     "диагностика_дефектов": {"kbs": ["wiki", "runbooks", "vendor_prusa"]}}
+Вариант `:complex` строится из переопределённой категории (модель strict,
+если модель категории не задана явно), его собственные ключи - поверх.
+Решения видны в трассе (атрибуты route, model, max_tokens, top_k) и в
+метриках rag_route_requests_total / rag_route_generate_seconds.
+"""
+import json
+import re
+from dataclasses import dataclass, replace, asdict
+from pathlib import Path
+from typing import Dict, Optional, Any, Tuple
+
+try:
+    from .config import ROUTING_TABLE_PATH, ROUTE_COMPLEX_WORDS
+except ImportError:
+    from src.config import ROUTING_TABLE_PATH, ROUTE_COMPLEX_WORDS
+
+_WORD = re.compile(r"[\w-]+", re.UNICODE)
+
+
+@dataclass(frozen=True)
+class Route:
+    """Параметры генерации для одного маршрута"""
+    name: str
+    model: str = "general"
+    backend: Optional[str] = None
+    max_tokens: int = 800
+    temperature: float = 0.3
+    top_k: int = 3
+    context_budget: int = 1200
+    # MMR при отборе чанков (None - обычный top-k) и склейка соседних чанков статьи
+    mmr_lambda: Optional[float] = None
+    merge_adjacent: bool = False
+    # Базы знаний для поиска (kb_registry.py); None - только основная
+    kbs: Optional[Tuple[str, ...]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+# Обзорным вопросам нужно больше разных источников (меньше λ), пошаговым
+# инструкциям и диагностике - связные фрагменты (склейка соседних чанков)
+DEFAULT_ROUTES: Dict[str, Route] = {
+    "основы": Route(
+        "основы", max_tokens=500, temperature=0.3, top_k=3, context_budget=900, mmr_lambda=0.5
+    ),
+    "подбор_материала": Route(
+        "подбор_материала", max_tokens=800, temperature=0.3, top_k=4, context_budget=1200, mmr_lambda=0.6
+    ),
+    "настройка_принтера": Route(
+        "настройка_принтера", max_tokens=900, temperature=0.2, top_k=4, context_budget=1500,
+        mmr_lambda=0.7, merge_adjacent=True
+    ),
+    "диагностика_дефектов": Route(
+        "диагностика_дефектов", model="strict", max_tokens=1200, temperature=0.2, top_k=6, context_budget=2000,
+        mmr_lambda=0.7, merge_adjacent=True
+    ),
+    "слайсер": Route(
+        "слайсер", max_tokens=800, temperature=0.3, top_k=4, context_budget=1200, mmr_lambda=0.7, merge_adjacent=True
+    ),
+    "другое": Route(
+        "другое", max_tokens=600, temperature=0.4, top_k=3, context_budget=1000, mmr_lambda=0.6
+    ),
+}
+
+
+def is_complex(query: str) -> bool:
+    """Длинный или составной вопрос (несколько вопросов в одном сообщении)"""
+    return len(_WORD.findall(query)) > ROUTE_COMPLEX_WORDS or query.count("?") > 1
+
+
+def _complex_variant(route: Route, keep_model: bool = False) -> Route:
+    """Маршрут для длинных и составных вопросов; keep_model - модель задана явно"""
+    return replace(
+        route,
+        name=f"{route.name}:complex",
+        model=route.model if keep_model else "strict",
+        max_tokens=min(1500, int(route.max_tokens * 1.5)),
+        top_k=route.top_k + 2,
+        context_budget=int(route.context_budget * 1.5),
+    )
+
+
+class RoutingTable:
+    """Маршруты по категориям с переопределениями из JSON"""
+
+    def __init__(self, overrides_path: str = ROUTING_TABLE_PATH):
+        self.routes: Dict[str, Route] = dict(DEFAULT_ROUTES)
+        overrides: Dict[str, Dict[str, Any]] = {}
+        if overrides_path and Path(overrides_path).exists():
+            overrides = self._read_overrides(Path(overrides_path))
+
+        # Варианты :complex строятся из уже переопределённых категорий, а их
+        # собственные переопределения применяются поверх
+        for name, params in overrides.items():
+            if not name.endswith(":complex"):
+                self._apply_override(name, params)
+        for name in [n for n in self.routes if not n.endswith(":complex")]:
+            self.routes[f"{name}:complex"] = _complex_variant(
+                self.routes[name], keep_model="model" in overrides.get(name, {})
+            )
+        for name, params in overrides.items():
+            if name.endswith(":complex"):
+                self._apply_override(name, params)
+
+    @staticmethod
+    def _read_overrides(path: Path) -> Dict[str, Dict[str, Any]]:
+        with open(path, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+        print(f"✅ Таблица маршрутов: {len(overrides)} переопределений из {path}")
+        return overrides
+
+    def _apply_override(self, name: str, params: Dict[str, Any]):
+        base = self.routes.get(name) or self.routes["другое"]
+        if params.get("kbs") is not None:
+            params = {**params, "kbs": tuple(params["kbs"])}
+        self.routes[name] = replace(base, name=name, **params)
+
+    def select(self, category: str, query: str) -> Route:
+        """Маршрут для категории с учётом сложности вопроса"""
+        name = f"{category}:complex" if is_complex(query) else category
+        return self.routes.get(name) or self.routes.get(category) or self.routes["другое"]
@@ -0,0 +1,127 @@
+"""
+Честный планировщик запросов: глобальный лимит, лимит на чат и общая очередь по кругу
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable
+
+
+class QueueFull(Exception):
+    """У чата слишком много ожидающих запросов"""
+
+
+class FairScheduler:
+    """
+    Выдаёт слоты на выполнение запросов
+
+    - одновременно выполняется не больше `max_concurrent` запросов;
+    - у одного чата не больше `per_chat_limit` запросов в работе;
+    - свободный слот получает чат, дольше всех не получавший слот, поэтому
+      активный пользователь с очередью вопросов не блокирует остальных.
+    """
+
+    def __init__(self, max_concurrent: int = 4, per_chat_limit: int = 1, max_pending_per_chat: int = 3):
+        for name, value in (
+            ("max_concurrent", max_concurrent),
+            ("per_chat_limit", per_chat_limit),
+            ("max_pending_per_chat", max_pending_per_chat),
+        ):
+            if value < 1:
+                raise ValueError(f"FairScheduler: {name} должен быть не меньше 1, получено {value}")
+        self.max_concurrent = max_concurrent
+        self.per_chat_limit = per_chat_limit
+        self.max_pending_per_chat = max_pending_per_chat
+        # Чаты с ожидающими запросами (в порядке появления)
+        self._pending: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+        self._running: Dict[Hashable, int] = {}
+        self._running_total = 0
+        # Номер последней выдачи слота чату: дольше всех ждавший чат идёт первым
+        self._last_served: Dict[Hashable, int] = {}
+        self._seq = 0
+
+    @property
+    def running(self) -> int:
+        return self._running_total
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self._pending.values())
+
+    async def acquire(self, key: Hashable) -> float:
+        """Дождаться слота; возвращает время ожидания в секундах"""
+        # Пустая очередь в _pending сломала бы _dispatch - создаём её только при постановке
+        queue = self._pending.get(key)
+        if queue is not None and len(queue) >= self.max_pending_per_chat:
+            raise QueueFull(key)
+        queue = self._pending.setdefault(key, deque())
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан - возвращаем его
+                self.release(key)
+            else:
+                self._discard(key, future)
+            raise
+        return time.monotonic() - started
+
+    def release(self, key: Hashable):
+        """Освободить слот"""
+        self._running_total -= 1
+        self._running[key] -= 1
+        if not self._running[key]:
+            del self._running[key]
+        if not self._running_total and not self._pending:
+            # Система простаивает - история выдачи больше не нужна
+            self._last_served.clear()
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable):
+        """`async with scheduler.slot(chat_id) as waited: ...`"""
+        waited = await self.acquire(key)
+        try:
+            yield waited
+        finally:
+            self.release(key)
+
+    def _discard(self, key: Hashable, future: asyncio.Future):
+        queue = self._pending.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(future)
+        except ValueError:
+            pass
+        if not queue:
+            del self._pending[key]
+
+    def _dispatch(self):
+        while self._running_total < self.max_concurrent:
+            eligible = [
+                key for key in self._pending
+                if self._running.get(key, 0) < self.per_chat_limit
+            ]
+            if not eligible:
+                return
+            chosen = min(eligible, key=lambda k: self._last_served.get(k, -1))
+
+            queue = self._pending[chosen]
+            future = queue.popleft()
+            if not queue:
+                del self._pending[chosen]
+            if future.cancelled():
+                continue
+
+            self._seq += 1
+            self._last_served[chosen] = self._seq
+            self._running_total += 1
+            self._running[chosen] = self._running.get(chosen, 0) + 1
+            future.set_result(None)
@@ -0,0 +1,190 @@
+"""
+Многопроцессный запуск API с общей (copy-on-write) моделью и индексом
+
+Мастер-процесс один раз загружает RAGPipeline (модель эмбеддингов, FAISS
+индекс, базу знаний), замораживает объекты для сборщика мусора и делает
+fork воркеров. Воркеры принимают соединения на общем сокете и читают
+модель и индекс из страниц памяти мастера, не копируя их.
+
+Предел copy-on-write: gc.freeze только исключает объекты из обхода
+сборщика мусора, счётчики ссылок при чтении объекта всё равно меняются.
+Веса модели и матрица векторов лежат в буферах torch/FAISS/numpy без
+счётчиков и остаются общими; чанки базы знаний (словари и строки Python)
+копируются в воркер постранично по мере чтения, и своя память воркера
+растёт с числом затронутых чанков вплоть до размера базы. Своя (uss) и
+общая память каждого воркера - в /metrics (rag_worker_memory_bytes).
+
+Метрики воркеров пишутся в общий каталог PROMETHEUS_MULTIPROC_DIR (если
+не задан - временный на время работы мастера), и /metrics любого воркера
+отдаёт сумму по всем процессам.
+
+Соединения между воркерами распределяет ядро, поэтому следующий вопрос
+диалога может прийти в другой воркер: история диалогов (DialogMemory)
+хранится в общем файле SQLite - DIALOG_DB_PATH, а если он не задан, во
+временном файле на время работы мастера.
+
+Запуск:
+    python -m src.serve --workers 4 --port 8000
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Временный каталог метрик, созданный мастером (удаляется при выходе)
+_metrics_tmp_dir = ""
+
+if __name__ == "__main__":
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+    # Multiprocess-режим prometheus_client выбирается при его импорте - до src.*
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        _metrics_tmp_dir = tempfile.mkdtemp(prefix="rag-metrics-")
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = _metrics_tmp_dir
+
+import uvicorn
+
+from src.config import SERVE_WORKERS, DIALOG_DB_PATH
+from src import thread_budget
+from src import metrics
+from src.dialog_memory import DialogMemory
+# src.api и src.rag_pipeline (numpy, FAISS, torch) импортируются в main()
+# после бюджета потоков: переменные BLAS/OpenMP читаются при загрузке библиотек
+
+# Воркер, упавший быстрее этого, не перезапускается (ошибка конфигурации)
+MIN_WORKER_UPTIME = 5.0
+
+
+def _share_dialogs(pipeline: "RAGPipeline", workers: int) -> str:
+    """Общая для воркеров история диалогов; возвращает временный файл (или "")"""
+    if workers <= 1 or DIALOG_DB_PATH:
+        return ""
+    fd, path = tempfile.mkstemp(prefix="rag-dialogs-", suffix=".sqlite3")
+    os.close(fd)
+    pipeline.dialog_memory = DialogMemory(db_path=path)
+    print(f"💬 История диалогов воркеров: {path}")
+    return path
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(slot: int, sock: socket.socket):
+    """Тело воркера: uvicorn на унаследованном сокете"""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Потоки OpenMP/torch - состояние процесса: задаются заново после fork
+    thread_budget.apply(thread_budget.current())
+    from src import api
+    config = uvicorn.Config(api.app, lifespan="on", log_level="warning")
+    server = uvicorn.Server(config)
+    print(f"👷 Воркер {slot} (pid {os.getpid()}) запущен")
+    server.run(sockets=[sock])
+    os._exit(0)
+
+
+def _spawn(slot: int, sock: socket.socket, worker_pids) -> int:
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _run_worker(slot, sock)
+        finally:
+            os._exit(1)
+    worker_pids[slot] = pid
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Многопроцессный запуск API")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS or os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    # Ядра делятся между воркерами: у каждого свои слоты эмбеддинга/поиска.
+    # До импорта api: иначе BLAS уже прочитал бюджет одного процесса
+    thread_budget.apply(thread_budget.make_budget(processes=args.workers))
+    from src import api
+    from src.rag_pipeline import RAGPipeline
+    print(f"🚀 Мастер-процесс {os.getpid()}: загрузка RAG-системы до fork...")
+    # Модель и индекс не используются в мастере до fork: пулы потоков
+    # OpenMP/torch, созданные до fork, в дочерних процессах не работают
+    api.rag_pipeline = RAGPipeline()
+    dialog_db = _share_dialogs(api.rag_pipeline, args.workers)
+
+    # pid воркеров в общей памяти - любой воркер отдаёт в /metrics память всех
+    worker_pids = multiprocessing.Array("i", args.workers, lock=False)
+    metrics.register_workers(worker_pids)
+
+    # Всё загруженное уходит в постоянное поколение GC: сборщик мусора в
+    # воркерах не обходит эти объекты и не трогает их страницы памяти
+    gc.collect()
+    gc.freeze()
+
+    sock = _bind(args.host, args.port)
+    print(f"✅ Слушаем http://{args.host}:{args.port}, воркеров: {args.workers}")
+
+    started = {}
+    for slot in range(args.workers):
+        started[_spawn(slot, sock, worker_pids)] = (slot, time.monotonic())
+
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(started):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    while started:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot, since = started.pop(pid, (None, 0.0))
+        if slot is None:
+            continue
+        worker_pids[slot] = 0
+        metrics.mark_process_dead(pid)
+        if stopping:
+            continue
+        uptime = time.monotonic() - since
+        print(f"⚠️ Воркер {slot} (pid {pid}) завершился со статусом {status} через {uptime:.1f}s")
+        if uptime < MIN_WORKER_UPTIME:
+            print("❌ Воркер упал сразу после старта - не перезапускаем")
+            continue
+        started[_spawn(slot, sock, worker_pids)] = (slot, time.monotonic())
+
+    if dialog_db:
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(dialog_db + suffix)
+            except FileNotFoundError:
+                pass
+    if _metrics_tmp_dir:
+        shutil.rmtree(_metrics_tmp_dir, ignore_errors=True)
+    print("👋 Все воркеры остановлены")
+
+
+if __name__ == "__main__":
+    main()
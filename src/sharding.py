@@ -0,0 +1,413 @@
+"""
+Шардированный индекс: каждый шард ищется своим процессом, координатор сливает top-k
+
+Корпус делится на шарды - каталоги data/faiss_index/shards/<имя> в формате
+обычного индекса (vectors.npy и/или index.faiss, documents.pkl, manifest.json):
+по источнику (wiki, forum) или по хешу URL статьи (wiki-0..wiki-3, см.
+build_index.py --shards). Шард перестраивается отдельно от остальных и
+виден, когда записан его манифест (он пишется последним).
+
+ShardedIndex повторяет интерфейс faiss.Index (как NumpyIndex) и подставляется
+в IndexSnapshot: номера векторов сквозные по шардам в порядке имён, база
+знаний версии - чанки шардов в том же порядке.
+
+Поиск: вопросы, закодированные координатором, отправляются всем процессам
+шардов; каждый ищет по своей матрице (memory-map - страницы в общем кэше ОС
+с координатором и между версиями), координатор сливает локальные top-k.
+Шард, не ответивший за SHARD_TIMEOUT_MS, упавший или перезапускаемый,
+пропускается: результат частичный, имена пропущенных шардов - в
+trace.attrs["missing_shards"] и в ответах API.
+
+Процессы шардов запускаются через spawn (fork после загрузки torch/OpenMP
+небезопасен, см. serve.py) и переиспользуются новыми версиями индекса, если
+шард не менялся; процесс останавливается, когда на него не ссылается ни одна
+версия (текущая или предыдущая для отката).
+"""
+import hashlib
+import itertools
+import json
+import multiprocessing
+import threading
+import time
+import weakref
+from concurrent.futures import Future, wait
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+try:
+    from .config import SHARD_TIMEOUT_MS, SHARD_START_TIMEOUT_S, VECTOR_BACKEND
+    from .vector_index import NumpyIndex, load_vector_index
+    from . import thread_budget
+    from . import tracing
+    from . import metrics
+except ImportError:
+    from src.config import SHARD_TIMEOUT_MS, SHARD_START_TIMEOUT_S, VECTOR_BACKEND
+    from src.vector_index import NumpyIndex, load_vector_index
+    from src import thread_budget
+    from src import tracing
+    from src import metrics
+
+SHARDS_DIR = "shards"
+_MANIFEST = "manifest.json"
+# Пауза перед повторным запуском процесса шарда, который не поднялся
+_RESTART_BACKOFF_S = 5.0
+
+
+def shard_dirs(index_dir: Path) -> List[Path]:
+    """Каталоги готовых шардов по имени; пусто - индекс не шардирован"""
+    root = Path(index_dir) / SHARDS_DIR
+    if not root.is_dir():
+        return []
+    return sorted(p for p in root.iterdir() if (p / _MANIFEST).exists() and (p / "documents.pkl").exists())
+
+
+def read_shard_manifest(path: Path) -> Dict[str, Any]:
+    with open(Path(path) / _MANIFEST, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def shard_version(path: Path) -> str:
+    manifest = read_shard_manifest(path)
+    if manifest.get("version"):
+        return str(manifest["version"])
+    stat = (Path(path) / _MANIFEST).stat()
+    return f"{stat.st_mtime_ns:x}"
+
+
+def shards_version(dirs: List[Path]) -> str:
+    """Версия шардированного индекса: меняется при пересборке любого шарда"""
+    digest = hashlib.sha1()
+    for path in dirs:
+        digest.update(f"{path.name}={shard_version(path)};".encode())
+    return "shards-" + digest.hexdigest()[:12]
+
+
+def _worker_main(conn, shard_dir: str, backend: str, processes: int):
+    """Тело процесса шарда: загрузить векторы и отвечать на поиски по порядку"""
+    try:
+        # Вопрос ищется всеми шардами сразу - ядра делятся между их процессами
+        thread_budget.apply(thread_budget.make_budget(processes=processes, concurrency=1))
+        index, _ = load_vector_index(Path(shard_dir), backend)
+        if index is None:
+            raise FileNotFoundError(f"нет векторов в {shard_dir}")
+        conn.send(("ready", index.ntotal, index.d))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        request_id, queries, k = message
+        try:
+            distances, labels = index.search(queries, k)
+            conn.send((request_id, distances, labels, None))
+        except Exception as e:
+            conn.send((request_id, None, None, f"{type(e).__name__}: {e}"))
+
+
+class _Connection:
+    """Процесс шарда и канал к нему; ответы разбирает отдельный поток"""
+
+    def __init__(self, name: str, path: str, backend: str, processes: int = 1):
+        ctx = multiprocessing.get_context("spawn")
+        self.name = name
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child, path, backend, processes), name=f"shard-{name}", daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.pending: Dict[int, Future] = {}
+        self.lock = threading.Lock()
+        self.alive = False
+        self.ntotal = 0
+        self.d = 0
+
+    def wait_ready(self, timeout: float):
+        try:
+            if not self.conn.poll(timeout):
+                raise TimeoutError(f"не загрузился за {timeout:.0f}s")
+            message = self.conn.recv()
+            if message[0] != "ready":
+                raise RuntimeError(message[1])
+        except Exception as e:
+            self.stop()
+            raise RuntimeError(f"Шард {self.name}: {e}") from e
+        _, self.ntotal, self.d = message
+        self.alive = True
+        threading.Thread(target=self._read, daemon=True, name=f"shard-{self.name}").start()
+
+    def send(self, request_id: int, queries: np.ndarray, k: int, future: Future) -> bool:
+        with self.lock:
+            if not self.alive:
+                return False
+            self.pending[request_id] = future
+            try:
+                self.conn.send((request_id, queries, k))
+                return True
+            except (OSError, ValueError):
+                self.pending.pop(request_id, None)
+                self.alive = False
+                return False
+
+    def _read(self):
+        while True:
+            try:
+                request_id, distances, labels, error = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is None:
+                continue
+            if error is None:
+                future.set_result((distances, labels))
+            else:
+                future.set_exception(RuntimeError(f"Шард {self.name}: {error}"))
+        with self.lock:
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError(f"Процесс шарда {self.name} завершился"))
+
+    def stop(self):
+        with self.lock:
+            self.alive = False
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        self.conn.close()
+
+
+def _restart(holder: Dict[str, Any], name: str, path: str, backend: str, processes: int, lock: threading.Lock):
+    """Перезапуск упавшего процесса (в фоне; без ссылки на ShardWorker)"""
+    try:
+        holder["connection"].stop()
+        print(f"🔄 Перезапуск процесса шарда {name}")
+        connection = _Connection(name, path, backend, processes)
+        connection.wait_ready(SHARD_START_TIMEOUT_S)
+        if holder.get("closed"):
+            connection.stop()
+            return
+        holder["connection"] = connection
+        print(f"✅ Шард {name} снова доступен")
+    except Exception as e:
+        holder["retry_at"] = time.monotonic() + _RESTART_BACKOFF_S
+        print(f"❌ {e}")
+    finally:
+        lock.release()
+
+
+def _shutdown(holder: Dict[str, Any]):
+    holder["closed"] = True
+    holder["connection"].stop()
+
+
+class ShardWorker:
+    """Шард одной версии и его процесс поиска (перезапускается при падении)"""
+
+    def __init__(self, path: Path, version: str, backend: str = VECTOR_BACKEND, processes: int = 1):
+        self.path = Path(path)
+        self.name = self.path.name
+        self.version = version
+        self.backend = backend
+        # Сколько процессов шардов делят ядра (бюджет потоков, см. thread_budget.py)
+        self.processes = processes
+        self.ntotal = 0
+        self.d = 0
+        # Состояние, общее с фоновыми потоками: они не держат ссылку на воркер,
+        # и процесс останавливается, как только воркер никому не нужен
+        self._holder: Dict[str, Any] = {"connection": _Connection(self.name, str(self.path), backend, processes), "retry_at": 0.0}
+        self._ids = itertools.count()
+        self._restart_lock = threading.Lock()
+        weakref.finalize(self, _shutdown, self._holder)
+
+    def wait_ready(self, timeout: float = SHARD_START_TIMEOUT_S):
+        connection = self._holder["connection"]
+        connection.wait_ready(timeout)
+        self.ntotal, self.d = connection.ntotal, connection.d
+
+    @property
+    def alive(self) -> bool:
+        return self._holder["connection"].alive
+
+    @property
+    def pid(self) -> int:
+        return self._holder["connection"].process.pid
+
+    def submit(self, queries: np.ndarray, k: int) -> Future:
+        """Поиск в процессе шарда; (расстояния, локальные номера) или исключение"""
+        future: Future = Future()
+        if self._holder["connection"].send(next(self._ids), queries, k, future):
+            return future
+        holder = self._holder
+        if not holder.get("closed") and time.monotonic() >= holder["retry_at"] and self._restart_lock.acquire(blocking=False):
+            threading.Thread(
+                target=_restart,
+                args=(holder, self.name, str(self.path), self.backend, self.processes, self._restart_lock),
+                daemon=True,
+            ).start()
+        future.set_exception(ConnectionError(f"Шард {self.name} недоступен"))
+        return future
+
+    def stop(self):
+        _shutdown(self._holder)
+
+
+# Запущенные процессы шардов по (каталог, версия шарда)
+_workers: "weakref.WeakValueDictionary[Tuple[str, str], ShardWorker]" = weakref.WeakValueDictionary()
+_workers_lock = threading.Lock()
+
+
+class ShardedIndex:
+    """
+    Индекс из шардов с интерфейсом faiss.Index (квадрат L2, номера сквозные)
+
+    search рассылает вопросы всем шардам и ждёт их не дольше `timeout_ms`;
+    если не ответил ни один - RuntimeError (поиск перейдёт на текстовый).
+    """
+
+    def __init__(self, workers: List[ShardWorker], timeout_ms: float = SHARD_TIMEOUT_MS):
+        if not workers:
+            raise ValueError("Нет шардов")
+        dims = {w.d for w in workers}
+        if len(dims) != 1:
+            raise ValueError(f"Разная размерность шардов: {sorted(dims)}")
+        self.workers = workers
+        self.timeout_s = timeout_ms / 1000
+        self.offsets = np.cumsum([0] + [w.ntotal for w in workers])
+        self._vectors: Dict[int, NumpyIndex] = {}
+
+    @property
+    def d(self) -> int:
+        return self.workers[0].d
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.offsets[-1])
+
+    def search(self, x: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        x = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, self.d)
+        with tracing.span("shards", shards=len(self.workers), top_k=k) as span:
+            start = time.perf_counter()
+            futures: Dict[Future, int] = {}
+            for i, worker in enumerate(self.workers):
+                future = worker.submit(x, k)
+                future.add_done_callback(
+                    lambda f, name=worker.name: metrics.SHARD_LATENCY.labels(shard=name).observe(
+                        time.perf_counter() - start
+                    )
+                )
+                futures[future] = i
+            done, _ = wait(futures, timeout=self.timeout_s)
+
+            distances, labels, missing = [], [], []
+            for future, i in futures.items():
+                name = self.workers[i].name
+                if future not in done:
+                    status = "timeout"
+                elif future.exception() is not None:
+                    status = "down" if isinstance(future.exception(), ConnectionError) else "error"
+                else:
+                    status = "ok"
+                    shard_distances, shard_labels = future.result()
+                    distances.append(shard_distances)
+                    labels.append(np.where(shard_labels >= 0, shard_labels + self.offsets[i], -1))
+                metrics.SHARD_SEARCHES.labels(shard=name, status=status).inc()
+                if status != "ok":
+                    missing.append(name)
+
+            if missing:
+                if span is not None:
+                    span.attrs["missing"] = ",".join(missing)
+                trace = tracing.current_trace()
+                if trace is not None:
+                    trace.attrs["missing_shards"] = sorted(set(trace.attrs.get("missing_shards", [])) | set(missing))
+            if not labels:
+                raise RuntimeError(f"Ни один шард не ответил: {', '.join(missing)}")
+
+        merged_distances = np.concatenate(distances, axis=1)
+        merged_labels = np.concatenate(labels, axis=1)
+        merged_distances = np.where(merged_labels >= 0, merged_distances, np.inf)
+        order = np.argsort(merged_distances, axis=1, kind="stable")[:, :k]
+        result_distances = np.full((len(x), k), np.inf, dtype=np.float32)
+        result_labels = np.full((len(x), k), -1, dtype=np.int64)
+        result_distances[:, :order.shape[1]] = np.take_along_axis(merged_distances, order, axis=1)
+        result_labels[:, :order.shape[1]] = np.take_along_axis(merged_labels, order, axis=1)
+        return result_distances, result_labels
+
+    def _shard_vectors(self, i: int) -> NumpyIndex:
+        """Векторы шарда в координаторе (memory-map, для reconstruct)"""
+        if i not in self._vectors:
+            index, _ = load_vector_index(self.workers[i].path, "numpy")
+            self._vectors[i] = index
+        return self._vectors[i]
+
+    def reconstruct_batch(self, ids) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        shards = np.searchsorted(self.offsets, ids, side="right") - 1
+        result = np.empty((len(ids), self.d), dtype=np.float32)
+        for i in np.unique(shards):
+            rows = shards == i
+            result[rows] = self._shard_vectors(int(i)).reconstruct_batch(ids[rows] - self.offsets[i])
+        return result
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return self.reconstruct_batch([i])[0]
+
+    def reconstruct_n(self, i0: int, n: int) -> np.ndarray:
+        return self.reconstruct_batch(np.arange(i0, i0 + n))
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "name": w.name,
+                "version": w.version,
+                "vectors": w.ntotal,
+                "alive": w.alive,
+                "pid": w.pid,
+            }
+            for w in self.workers
+        ]
+
+
+def open_shards(dirs: List[Path], backend: str = VECTOR_BACKEND, timeout_ms: float = SHARD_TIMEOUT_MS) -> ShardedIndex:
+    """
+    Индекс из каталогов шардов
+
+    Процессы неизменившихся шардов берутся у предыдущей версии, новые
+    запускаются параллельно и ждутся до SHARD_START_TIMEOUT_S.
+    """
+    workers, started = [], []
+    with _workers_lock:
+        for path in dirs:
+            key = (str(Path(path).resolve()), shard_version(path))
+            worker = _workers.get(key)
+            if worker is None:
+                worker = ShardWorker(path, key[1], backend, len(dirs))
+                _workers[key] = worker
+                started.append((key, worker))
+            workers.append(worker)
+    try:
+        for _, worker in started:
+            worker.wait_ready()
+    except Exception:
+        with _workers_lock:
+            for key, worker in started:
+                _workers.pop(key, None)
+                worker.stop()
+        raise
+    if started:
+        print(f"✅ Запущено процессов шардов: {len(started)} из {len(workers)}")
+    return ShardedIndex(workers, timeout_ms)
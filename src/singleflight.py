@@ -0,0 +1,92 @@
+"""
+Объединение одинаковых одновременных вызовов (single-flight)
+
+Когда ссылку на бота публикуют в канале, многие пользователи одновременно
+задают один и тот же вопрос. Первый запрос с данным ключом выполняет вызов,
+остальные ждут его результата (или исключения) вместо собственного вызова.
+Результат не кэшируется: после завершения вызова ключ освобождается.
+"""
+import hashlib
+import re
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    from . import metrics
+except ImportError:
+    from src import metrics
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCT = re.compile(r"[\s?!.…]+$")
+
+
+def normalize_question(text: str) -> str:
+    """Регистр, пробелы и концевая пунктуация не влияют на ключ"""
+    text = _SPACES.sub(" ", text.lower().replace("ё", "е")).strip()
+    return _TRAILING_PUNCT.sub("", text)
+
+
+def make_key(*parts: str) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Группа вызовов, объединяемых по ключу (потокобезопасно)"""
+
+    def __init__(self, name: str = "llm"):
+        self.name = name
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Выполнить fn() или дождаться уже идущего вызова с тем же ключом
+
+        Returns:
+            (результат, был ли он получен от чужого вызова)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+
+        if not leader:
+            metrics.LLM_COALESCED.labels(result="shared").inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.waiters:
+                metrics.LLM_COALESCED.labels(result="leader").inc()
+            call.done.set()
@@ -0,0 +1,252 @@
+"""
+Граф этапов: этапы объявляют входы, независимые выполняются параллельно
+
+Этап - функция, получающая свои входы именованными аргументами; вход -
+результат другого этапа или начальное значение прогона. Как только все
+входы этапа готовы, он отправляется в пул потоков.
+
+Необязательный этап (optional=True) не задерживает ответ: если его
+результат не получен за `budget_s` от отправки этапа в пул (или к общему
+`deadline_s` от начала прогона), зависимые этапы получают `default`, а сам
+этап отменяется (ещё не начатый) или перестаёт ожидаться (уже
+выполняющийся). Необязательные этапы выполняются в отдельном пуле: брошенные
+по бюджету вызовы занимают только его потоки, а не потоки обязательных
+этапов. Обязательные этапы ждутся всегда.
+
+Каждый прогон возвращает длительности этапов и критический путь - цепочку
+этапов, которая определила общее время.
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    from .config import STAGE_GRAPH_THREADS, STAGE_GRAPH_OPTIONAL_THREADS
+    from . import tracing
+    from . import metrics
+except ImportError:
+    from src.config import STAGE_GRAPH_THREADS, STAGE_GRAPH_OPTIONAL_THREADS
+    from src import tracing
+    from src import metrics
+
+
+@dataclass
+class Stage:
+    """Этап графа: имя результата, функция и имена входов"""
+    name: str
+    fn: Callable[..., Any]
+    inputs: Tuple[str, ...] = ()
+    optional: bool = False
+    default: Any = None
+    budget_s: Optional[float] = None
+
+
+@dataclass
+class StageTiming:
+    """Время этапа от начала прогона; status: ok / skipped / timeout / error"""
+    name: str
+    start_ms: float
+    end_ms: float
+    status: str = "ok"
+
+    @property
+    def duration_ms(self) -> float:
+        return self.end_ms - self.start_ms
+
+
+@dataclass
+class RunResult:
+    outputs: Dict[str, Any]
+    timings: Dict[str, StageTiming]
+    critical_path: List[str] = field(default_factory=list)
+    total_ms: float = 0.0
+
+    def breakdown(self) -> List[Dict[str, Any]]:
+        """Критический путь: длительность этапа и ожидание после предыдущего"""
+        rows = []
+        prev_end = 0.0
+        for name in self.critical_path:
+            t = self.timings[name]
+            rows.append({
+                "stage": name,
+                "status": t.status,
+                "wait_ms": round(max(0.0, t.start_ms - prev_end), 2),
+                "duration_ms": round(t.duration_ms, 2),
+            })
+            prev_end = t.end_ms
+        return rows
+
+    def format_breakdown(self) -> str:
+        parts = [f"{r['stage']} {r['duration_ms']:.0f}ms" + (f" ({r['status']})" if r['status'] != "ok" else "")
+                 for r in self.breakdown()]
+        return " -> ".join(parts) + f" = {self.total_ms:.0f}ms"
+
+
+class StageGraph:
+    """
+    Набор этапов с зависимостями; `run` выполняет его в пуле потоков
+
+    Без явных пулов используются общие пулы процесса; переданный `executor`
+    без `optional_executor` выполняет и необязательные этапы.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        executor: Optional[ThreadPoolExecutor] = None,
+        optional_executor: Optional[ThreadPoolExecutor] = None,
+    ):
+        self.stages = {s.name: s for s in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("Имена этапов должны быть уникальны")
+        self._check_acyclic()
+        self.executor = executor or _get_executor()
+        self.optional_executor = optional_executor or executor or _get_executor(optional=True)
+
+    def _check_acyclic(self):
+        state: Dict[str, int] = {}
+
+        def visit(name: str):
+            if state.get(name) == 1:
+                raise ValueError(f"Цикл в графе этапов через «{name}»")
+            if state.get(name) == 2 or name not in self.stages:
+                return
+            state[name] = 1
+            for dep in self.stages[name].inputs:
+                visit(dep)
+            state[name] = 2
+
+        for name in self.stages:
+            visit(name)
+
+    def _execute(self, stage: Stage, kwargs: Dict[str, Any], start: float) -> Tuple[Any, float, float]:
+        """Выполнение в потоке пула; возвращает результат и время начала/конца в мс"""
+        began = (time.perf_counter() - start) * 1000
+        with tracing.span(f"stage.{stage.name}"):
+            result = stage.fn(**kwargs)
+        return result, began, (time.perf_counter() - start) * 1000
+
+    def run(self, initial: Optional[Dict[str, Any]] = None, deadline_s: Optional[float] = None) -> RunResult:
+        """
+        Выполнить граф
+
+        `initial` - начальные значения входов, `deadline_s` - общий срок для
+        необязательных этапов (обязательные ждутся без ограничения).
+        """
+        start = time.perf_counter()
+        values: Dict[str, Any] = dict(initial or {})
+        missing = {i for s in self.stages.values() for i in s.inputs} - set(self.stages) - set(values)
+        if missing:
+            raise ValueError(f"Нет входов графа: {', '.join(sorted(missing))}")
+
+        pending = dict(self.stages)
+        running: Dict[Future, Stage] = {}
+        # Время отправки этапа в пул (с от начала прогона): от него считается budget_s
+        submitted_at: Dict[str, float] = {}
+        timings: Dict[str, StageTiming] = {}
+
+        def elapsed() -> float:
+            return time.perf_counter() - start
+
+        def expires_at(stage: Stage) -> Optional[float]:
+            if not stage.optional:
+                return None
+            limits = [deadline_s] if deadline_s is not None else []
+            if stage.budget_s is not None and stage.name in submitted_at:
+                limits.append(submitted_at[stage.name] + stage.budget_s)
+            return min(limits) if limits else None
+
+        def give_up(stage: Stage, status: str, began_ms: Optional[float] = None):
+            now_ms = elapsed() * 1000
+            values[stage.name] = stage.default
+            timings[stage.name] = StageTiming(stage.name, now_ms if began_ms is None else began_ms, now_ms, status)
+            metrics.STAGE_OUTCOMES.labels(stage=stage.name, status=status).inc()
+
+        try:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if not all(i in values for i in stage.inputs):
+                        continue
+                    del pending[name]
+                    limit = expires_at(stage)
+                    if limit is not None and elapsed() >= limit:
+                        give_up(stage, "skipped")
+                        continue
+                    kwargs = {i: values[i] for i in stage.inputs}
+                    executor = self.optional_executor if stage.optional else self.executor
+                    submitted_at[name] = elapsed()
+                    # Контекст (активная трасса) копируется в поток этапа
+                    future = executor.submit(
+                        contextvars.copy_context().run, self._execute, stage, kwargs, start
+                    )
+                    running[future] = stage
+
+                if not running:
+                    break
+
+                limits = [expires_at(s) for s in running.values()]
+                limits = [x for x in limits if x is not None]
+                timeout = max(0.0, min(limits) - elapsed()) if limits else None
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        result, began_ms, end_ms = future.result()
+                    except Exception as e:
+                        if not stage.optional:
+                            raise
+                        print(f"⚠️ Этап {stage.name} завершился ошибкой: {e}")
+                        metrics.ERRORS.labels(stage=f"stage.{stage.name}", type=type(e).__name__).inc()
+                        give_up(stage, "error", submitted_at[stage.name] * 1000)
+                        continue
+                    values[stage.name] = result
+                    timings[stage.name] = StageTiming(stage.name, began_ms, end_ms)
+                    metrics.STAGE_OUTCOMES.labels(stage=stage.name, status="ok").inc()
+
+                for future, stage in list(running.items()):
+                    limit = expires_at(stage)
+                    if limit is not None and elapsed() >= limit:
+                        running.pop(future)
+                        future.cancel()
+                        give_up(stage, "timeout", submitted_at[stage.name] * 1000)
+        finally:
+            for future in running:
+                future.cancel()
+
+        outputs = {name: values[name] for name in self.stages if name in values}
+        total_ms = elapsed() * 1000
+        return RunResult(outputs, timings, self._critical_path(timings), total_ms)
+
+    def _critical_path(self, timings: Dict[str, StageTiming]) -> List[str]:
+        """От последнего завершившегося этапа назад по входу, завершившемуся позже всех"""
+        if not timings:
+            return []
+        name = max(timings, key=lambda n: timings[n].end_ms)
+        path = [name]
+        while True:
+            deps = [i for i in self.stages[name].inputs if i in timings]
+            if not deps:
+                break
+            name = max(deps, key=lambda n: timings[n].end_ms)
+            path.append(name)
+        return path[::-1]
+
+
+# Общие пулы процесса: обязательные (False) и необязательные (True) этапы
+_executors: Dict[bool, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(optional: bool = False) -> ThreadPoolExecutor:
+    """Общий пул потоков для этапов (создаётся при первом графе)"""
+    with _executors_lock:
+        if optional not in _executors:
+            _executors[optional] = ThreadPoolExecutor(
+                max_workers=STAGE_GRAPH_OPTIONAL_THREADS if optional else STAGE_GRAPH_THREADS,
+                thread_name_prefix="stage-optional" if optional else "stage",
+            )
+        return _executors[optional]
@@ -1,6 +1,8 @@
 # src/telegram_bot.py
 import os
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
@@ -11,25 +13,47 @@ from telegram.ext import (
     ContextTypes,
 )
 
+from src import metrics
+from src.scheduler import FairScheduler, QueueFull
+
 load_dotenv()
 
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-if not BOT_TOKEN:
-    raise ValueError("TELEGRAM_BOT_TOKEN не найден в .env файле")
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9101"))
+# Параллельные RAG-запросы всего / на один чат и длина очереди чата
+BOT_MAX_CONCURRENT = int(os.getenv("BOT_MAX_CONCURRENT", "4"))
+BOT_PER_CHAT_LIMIT = int(os.getenv("BOT_PER_CHAT_LIMIT", "1"))
+BOT_MAX_PENDING_PER_CHAT = int(os.getenv("BOT_MAX_PENDING_PER_CHAT", "3"))
+# Адрес Bot API (можно направить на локальный фейковый сервер Telegram)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "https://api.telegram.org/bot")
+# Telegram гасит индикатор "печатает..." через ~5 секунд
+TYPING_REFRESH_SECONDS = 4.0
+
+# RAG-система: в режиме polling создаётся в main(), в режиме webhook
+# передаётся из API (общий пайплайн и пул потоков)
+rag = None
+handle_user_query = None
+rag_executor = None
+scheduler = FairScheduler(
+    max_concurrent=BOT_MAX_CONCURRENT,
+    per_chat_limit=BOT_PER_CHAT_LIMIT,
+    max_pending_per_chat=BOT_MAX_PENDING_PER_CHAT,
+)
 
-print("🚀 Запуск Telegram Bot...")
-print("🔧 Инициализация RAG-системы...")
 
-# Инициализация RAG системы
-try:
-    from src.rag_pipeline import RAGPipeline
-    rag = RAGPipeline()
-    print("✅ RAG-система готова!")
-except ImportError:
-    # Если класса нет, пробуем импортировать функцию
-    from src.rag_pipeline import handle_user_query
-    rag = None
-    print("✅ RAG-функция импортирована!")
+def _init_rag():
+    """Инициализация собственной RAG-системы (режим polling)"""
+    global rag, handle_user_query
+    print("🔧 Инициализация RAG-системы...")
+    try:
+        from src.rag_pipeline import RAGPipeline
+        rag = RAGPipeline()
+        print("✅ RAG-система готова!")
+    except ImportError:
+        # Если класса нет, пробуем импортировать функцию
+        from src.rag_pipeline import handle_user_query as _handle_user_query
+        handle_user_query = _handle_user_query
+        print("✅ RAG-функция импортирована!")
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -49,44 +73,71 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "ℹ️ Доступные команды:\n\n"
         "/start - Приветствие и информация\n"
-        "/help - Справка\n\n"
+        "/help - Справка\n"
+        "/reset - Начать диалог заново\n\n"
         "Просто отправь мне свой вопрос о 3D-печати, "
         "и я найду релевантную информацию!"
     )
 
 
+async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /reset - очистка истории диалога"""
+    if rag is not None and hasattr(rag, 'dialog_memory'):
+        rag.dialog_memory.reset(f"tg:{update.effective_chat.id}")
+    await update.message.reply_text("🧹 История диалога очищена.")
+
+
+def _ask_rag(user_query: str, session_id: Optional[str] = None):
+    """Синхронный запрос к RAG-системе (выполняется в пуле потоков)"""
+    if rag is not None:
+        # Используем класс RAGPipeline
+        # Пробуем разные возможные имена методов
+        if hasattr(rag, 'query'):
+            return rag.query(user_query, session_id=session_id)
+        elif hasattr(rag, 'get_answer'):
+            return rag.get_answer(user_query)
+        elif hasattr(rag, 'answer'):
+            return rag.answer(user_query)
+        elif hasattr(rag, 'handle_query'):
+            return rag.handle_query(user_query)
+        else:
+            raise AttributeError(f"Класс RAGPipeline не имеет известного метода для запросов. Доступные методы: {[m for m in dir(rag) if not m.startswith('_')]}")
+    # Используем функцию handle_user_query
+    return handle_user_query(user_query)
+
+
+async def _keep_typing(bot, chat_id: int):
+    """Обновляет индикатор "печатает..." пока запрос ждёт в очереди и выполняется"""
+    while True:
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action="typing")
+        except Exception as e:
+            print(f"⚠️ Не удалось отправить индикатор: {e}")
+        await asyncio.sleep(TYPING_REFRESH_SECONDS)
+
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
     user_query = update.message.text
     user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
     username = update.effective_user.username or "Unknown"
 
     print(f"\n📩 Получен вопрос от @{username} (ID: {user_id})")
     print(f"❓ Вопрос: {user_query}")
 
-    # Отправляем индикатор "печатает..."
-    await context.bot.send_chat_action(
-        chat_id=update.effective_chat.id, action="typing"
-    )
+    # Индикатор "печатает..." обновляется, пока не будет готов ответ
+    typing = asyncio.create_task(_keep_typing(context.bot, chat_id))
 
+    in_flight = metrics.REQUESTS_IN_FLIGHT.labels(source="telegram")
+    in_flight.inc()
     try:
-        # Получаем ответ от RAG-системы
-        if rag is not None:
-            # Используем класс RAGPipeline
-            # Пробуем разные возможные имена методов
-            if hasattr(rag, 'query'):
-                result = rag.query(user_query)
-            elif hasattr(rag, 'get_answer'):
-                result = rag.get_answer(user_query)
-            elif hasattr(rag, 'answer'):
-                result = rag.answer(user_query)
-            elif hasattr(rag, 'handle_query'):
-                result = rag.handle_query(user_query)
-            else:
-                raise AttributeError(f"Класс RAGPipeline не имеет известного метода для запросов. Доступные методы: {[m for m in dir(rag) if not m.startswith('_')]}")
-        else:
-            # Используем функцию handle_user_query
-            result = handle_user_query(user_query)
+        # Ждём свой слот и получаем ответ от RAG-системы
+        async with scheduler.slot(chat_id) as waited:
+            metrics.QUEUE_WAIT.labels(source="telegram").observe(waited)
+            print(f"⏳ Ожидание в очереди: {waited:.2f}s (в работе: {scheduler.running}, в очереди: {scheduler.queued})")
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(rag_executor, _ask_rag, user_query, f"tg:{chat_id}")
         
         # Обрабатываем результат
         if isinstance(result, dict):
@@ -106,37 +157,90 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Отправляем ответ пользователю
         await update.message.reply_text(response)
 
+    except QueueFull:
+        metrics.ERRORS.labels(stage="telegram", type="QueueFull").inc()
+        await update.message.reply_text(
+            "⏳ Я ещё отвечаю на ваши предыдущие вопросы. "
+            "Пожалуйста, дождитесь ответа и спросите снова."
+        )
+
     except Exception as e:
         error_message = (
             "❌ Извините, произошла ошибка при обработке вашего запроса. "
             "Попробуйте переформулировать вопрос."
         )
         await update.message.reply_text(error_message)
+        metrics.ERRORS.labels(stage="telegram", type=type(e).__name__).inc()
         print(f"❌ Ошибка: {e}")
         import traceback
         traceback.print_exc()
 
+    finally:
+        typing.cancel()
+        in_flight.dec()
+
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
+    metrics.ERRORS.labels(stage="telegram", type=type(context.error).__name__).inc()
     print(f"❌ Произошла ошибка: {context.error}")
 
 
-def main():
-    """Точка входа - создаёт event loop и запускает бота"""
-    print("\n✅ Telegram Bot запущен и готов к работе!")
-    print("🤖 Найдите своего бота в Telegram и начните общение\n")
+def build_application(pipeline=None, executor: Optional[ThreadPoolExecutor] = None, webhook: bool = False) -> Application:
+    """
+    Создание приложения бота с обработчиками
+    
+    Args:
+        pipeline: Готовый RAGPipeline (в режиме webhook - пайплайн API)
+        executor: Пул потоков для RAG-запросов (по умолчанию - собственный)
+        webhook: Без Updater - апдейты кладутся в update_queue извне
+    
+    Returns:
+        Application python-telegram-bot
+    """
+    global rag, rag_executor
+    if not BOT_TOKEN:
+        raise ValueError("TELEGRAM_BOT_TOKEN не найден в .env файле")
+    
+    if pipeline is not None:
+        rag = pipeline
+    # RAG-запросы блокирующие - выполняем их вне event loop
+    rag_executor = executor or ThreadPoolExecutor(max_workers=BOT_MAX_CONCURRENT, thread_name_prefix="rag")
 
-    # Создаём приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    # concurrent_updates: апдейты обрабатываются параллельно, очередность
+    # тяжёлых RAG-запросов определяет FairScheduler
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .concurrent_updates(True)
+    )
+    if webhook:
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("reset", reset_command))
     application.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
     )
     application.add_error_handler(error_handler)
+    return application
+
+
+def main():
+    """Точка входа (режим polling для локальной разработки)"""
+    print("🚀 Запуск Telegram Bot...")
+    _init_rag()
+
+    # Метрики бота на отдельном порту (0 - отключить)
+    if BOT_METRICS_PORT:
+        metrics.serve(BOT_METRICS_PORT)
+
+    # Создаём приложение
+    application = build_application()
 
     # Для Python 3.14: создаём event loop явно перед запуском
     try:
@@ -145,6 +249,9 @@ def main():
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
 
+    print("\n✅ Telegram Bot запущен и готов к работе!")
+    print("🤖 Найдите своего бота в Telegram и начните общение\n")
+
     # Запускаем polling
     application.run_polling(
         allowed_updates=Update.ALL_TYPES,
@@ -0,0 +1,192 @@
+"""
+Бюджет потоков CPU для torch, FAISS и BLAS
+
+По умолчанию каждый SentenceTransformer.encode и faiss.Index.search
+запускает пул OpenMP/torch на все ядра: при N одновременных запросах
+работает N × ядер потоков, и p99 растёт из-за переключений и кэша. Бюджет
+задаётся один раз на процесс:
+- intra_op - потоков на одну операцию (torch.set_num_threads,
+  faiss.omp_set_num_threads, OMP/MKL/OPENBLAS_NUM_THREADS);
+- inter_op - torch.set_num_interop_threads;
+- slots - сколько CPU-тяжёлых этапов (эмбеддинг, векторный поиск) идёт
+  одновременно, остальные ждут в compute_slot().
+
+Пресеты: serving - много одновременных запросов (поток на операцию, слотов
+по числу ядер), build - одна большая операция на все ядра (build_index.py).
+Ядра - CPU_THREADS или доступные процессу, делённые между процессами
+(воркеры src.serve, сервиса поиска, процессы шардов).
+
+Переменные BLAS/OpenMP читаются библиотеками при загрузке, поэтому apply()
+вызывается в точках входа до импорта numpy/torch; уже загруженный BLAS
+перенастраивается только через threadpoolctl (если установлен).
+"""
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional
+
+try:
+    from .config import THREAD_PRESET, CPU_THREADS, INTRA_OP_THREADS, COMPUTE_SLOTS
+    from . import metrics
+except ImportError:
+    from src.config import THREAD_PRESET, CPU_THREADS, INTRA_OP_THREADS, COMPUTE_SLOTS
+    from src import metrics
+
+PRESETS = ("serving", "build")
+BLAS_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+@dataclass(frozen=True)
+class ThreadBudget:
+    """Потоки процесса: на операцию (intra_op/inter_op) и одновременных операций (slots)"""
+    preset: str
+    cores: int
+    intra_op: int
+    inter_op: int
+    slots: int
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def available_cores() -> int:
+    """Ядра, доступные процессу (с учётом taskset/cpuset)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def make_budget(
+    preset: str = THREAD_PRESET,
+    processes: int = 1,
+    concurrency: int = 0,
+    cores: int = CPU_THREADS,
+    intra_op: int = INTRA_OP_THREADS,
+    slots: int = COMPUTE_SLOTS
+) -> ThreadBudget:
+    """
+    Бюджет процесса по пресету
+
+    Args:
+        processes: сколько процессов делят ядра (воркеры, шарды)
+        concurrency: сколько CPU-тяжёлых операций процесс выполняет
+            одновременно; 0 - по пресету (serving - по числу ядер, build - одна)
+        cores: ядер на всё приложение (0 - доступные процессу)
+        intra_op: потоков на операцию (0 - ядра / concurrency)
+        slots: одновременных операций (0 - ядра / intra_op)
+    """
+    if preset not in PRESETS:
+        raise ValueError(f"Неизвестный THREAD_PRESET: {preset} (доступны: {', '.join(PRESETS)})")
+    cores = max(1, (cores or available_cores()) // max(1, processes))
+    if concurrency <= 0:
+        concurrency = cores if preset == "serving" else 1
+    intra = min(cores, intra_op or max(1, cores // concurrency))
+    slots = slots or max(1, cores // intra)
+    return ThreadBudget(preset=preset, cores=cores, intra_op=intra, inter_op=1, slots=slots)
+
+
+class _Slots:
+    """
+    Слоты с выдачей в порядке очереди
+
+    threading.Semaphore не гарантирует порядок: поток, только что
+    освободивший слот, захватывает его снова раньше разбуженного, и часть
+    запросов ждёт десятки секунд (см. benchmarks/bench_threads.py).
+    Освобождённый слот передаётся первому ожидающему напрямую.
+    """
+
+    def __init__(self, count: int):
+        self._free = count
+        self._waiters: "deque[threading.Event]" = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._free += 1
+
+
+_budget = make_budget()
+_slots = _Slots(_budget.slots)
+
+
+def current() -> ThreadBudget:
+    return _budget
+
+
+def configure_torch(budget: Optional[ThreadBudget] = None):
+    """Потоки torch, если он загружен (вызывается и после загрузки модели)"""
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return
+    budget = budget or _budget
+    torch.set_num_threads(budget.intra_op)
+    try:
+        torch.set_num_interop_threads(budget.inter_op)
+    except RuntimeError:
+        # Задаётся только до первой параллельной операции torch
+        pass
+
+
+def apply(budget: Optional[ThreadBudget] = None) -> ThreadBudget:
+    """
+    Применить бюджет к процессу (по умолчанию - из THREAD_PRESET)
+
+    Переменные BLAS/OpenMP перезаписываются: бюджет - единственная точка
+    настройки (переопределения - CPU_THREADS и INTRA_OP_THREADS); их
+    наследуют и дочерние процессы.
+    """
+    global _budget, _slots
+    budget = budget or make_budget()
+    for name in BLAS_ENV:
+        os.environ[name] = str(budget.intra_op)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=budget.intra_op)
+    except ImportError:
+        pass
+    try:
+        import faiss
+        faiss.omp_set_num_threads(budget.intra_op)
+    except ImportError:
+        pass
+    configure_torch(budget)
+
+    _budget = budget
+    _slots = _Slots(budget.slots)
+    for setting in ("cores", "intra_op", "inter_op", "slots"):
+        metrics.THREAD_BUDGET.labels(setting=setting).set(getattr(budget, setting))
+    print(
+        f"🧵 Бюджет потоков {budget.preset}: ядер {budget.cores}, на операцию {budget.intra_op}, "
+        f"одновременных операций {budget.slots}"
+    )
+    return budget
+
+
+@contextmanager
+def compute_slot(stage: str):
+    """Слот CPU-тяжёлого этапа (embed, search); ожидание - в rag_compute_wait_seconds"""
+    slots = _slots
+    started = time.perf_counter()
+    slots.acquire()
+    metrics.COMPUTE_WAIT.labels(stage=stage).observe(time.perf_counter() - started)
+    try:
+        yield
+    finally:
+        slots.release()
@@ -0,0 +1,209 @@
+"""
+Трассировка запросов: спаны по этапам пайплайна на монотонных часах
+"""
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Callable
+
+try:
+    from .config import TRACE_LOG, OTEL_EXPORTER_OTLP_ENDPOINT
+except ImportError:
+    from src.config import TRACE_LOG, OTEL_EXPORTER_OTLP_ENDPOINT
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+# Подписчики на завершённые спаны (например, метрики)
+_span_listeners: List[Callable[["Span", "Trace"], None]] = []
+
+
+@dataclass
+class Span:
+    """Один этап обработки запроса"""
+    name: str
+    start_ns: int
+    end_ns: int = 0
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+
+class Trace:
+    """Набор спанов одного запроса"""
+
+    def __init__(self, name: str = "query"):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.attrs: Dict[str, Any] = {}
+        self.spans: List[Span] = []
+        self._start_ns = time.perf_counter_ns()
+        self._wall_start_ns = time.time_ns()
+        self._end_ns = 0
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Замер этапа: `with trace.span("search", top_k=3) as s: ...`"""
+        span = Span(name=name, start_ns=time.perf_counter_ns(), attrs=attrs)
+        try:
+            yield span
+        except Exception as e:
+            span.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span.end_ns = time.perf_counter_ns()
+            self._add(span)
+
+    def record(self, name: str, duration_s: float, **attrs):
+        """Добавить этап, длительность которого измерена снаружи (например, TTFB)"""
+        end_ns = time.perf_counter_ns()
+        self._add(Span(name=name, start_ns=end_ns - int(duration_s * 1e9), end_ns=end_ns, attrs=attrs))
+
+    def _add(self, span: Span):
+        self.spans.append(span)
+        for listener in _span_listeners:
+            try:
+                listener(span, self)
+            except Exception as e:
+                print(f"⚠️ Ошибка обработчика спана: {e}")
+
+    @property
+    def total_ms(self) -> float:
+        end_ns = self._end_ns or time.perf_counter_ns()
+        return (end_ns - self._start_ns) / 1e6
+
+    def timings(self) -> Dict[str, float]:
+        """Длительность этапов в мс (повторяющиеся этапы суммируются)"""
+        result: Dict[str, float] = {}
+        for span in self.spans:
+            result[span.name] = round(result.get(span.name, 0.0) + span.duration_ms, 2)
+        result["total"] = round(self.total_ms, 2)
+        return result
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing"""
+        return ", ".join(
+            f"{name.replace('.', '_')};dur={ms}" for name, ms in self.timings().items()
+        )
+
+    def finish(self):
+        """Завершить трассу и выгрузить её в лог и (опционально) в OpenTelemetry"""
+        if self._end_ns:
+            return
+        self._end_ns = time.perf_counter_ns()
+        if TRACE_LOG:
+            print(json.dumps({
+                "event": "trace",
+                "trace_id": self.trace_id,
+                "name": self.name,
+                "attrs": self.attrs,
+                "timings_ms": self.timings(),
+                "spans": [
+                    {
+                        "name": s.name,
+                        "offset_ms": round((s.start_ns - self._start_ns) / 1e6, 2),
+                        "duration_ms": round(s.duration_ms, 2),
+                        **({"attrs": s.attrs} if s.attrs else {}),
+                    }
+                    for s in self.spans
+                ],
+            }, ensure_ascii=False, default=str))
+        _export_otel(self)
+
+    def _wall_ns(self, perf_ns: int) -> int:
+        return self._wall_start_ns + (perf_ns - self._start_ns)
+
+
+def current_trace() -> Optional[Trace]:
+    """Активная трасса текущего контекста (или None)"""
+    return _current_trace.get()
+
+
+@contextmanager
+def activate(trace: Trace):
+    """Сделать трассу активной для вложенных вызовов"""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Спан в активной трассе; без трассы - ничего не делает"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attrs) as s:
+        yield s
+
+
+def record(name: str, duration_s: float, **attrs):
+    """Внешне измеренный этап в активной трассе"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(name, duration_s, **attrs)
+
+
+def add_span_listener(listener: Callable[[Span, Trace], None]):
+    """Подписаться на завершённые спаны"""
+    _span_listeners.append(listener)
+
+
+# OpenTelemetry (необязательно): экспорт в локальный коллектор по OTLP
+_otel_tracer = None
+_otel_checked = False
+
+
+def _get_otel_tracer():
+    global _otel_tracer, _otel_checked
+    if _otel_checked:
+        return _otel_tracer
+    _otel_checked = True
+    if not OTEL_EXPORTER_OTLP_ENDPOINT:
+        return None
+    try:
+        from opentelemetry import trace as otel_trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        provider = TracerProvider(resource=Resource.create({"service.name": "3d-print-assistant"}))
+        provider.add_span_processor(BatchSpanProcessor(
+            OTLPSpanExporter(endpoint=f"{OTEL_EXPORTER_OTLP_ENDPOINT.rstrip('/')}/v1/traces")
+        ))
+        otel_trace.set_tracer_provider(provider)
+        _otel_tracer = otel_trace.get_tracer("3d-print-assistant")
+        print(f"✅ OpenTelemetry экспорт: {OTEL_EXPORTER_OTLP_ENDPOINT}")
+    except ImportError:
+        print("⚠️ Установите: pip install opentelemetry-sdk opentelemetry-exporter-otlp-proto-http")
+    return _otel_tracer
+
+
+def _export_otel(trace: Trace):
+    tracer = _get_otel_tracer()
+    if tracer is None:
+        return
+    try:
+        from opentelemetry import trace as otel_trace
+
+        root = tracer.start_span(trace.name, start_time=trace._wall_start_ns, attributes={
+            "trace_id": trace.trace_id, **{k: str(v) for k, v in trace.attrs.items()}
+        })
+        ctx = otel_trace.set_span_in_context(root)
+        for s in trace.spans:
+            child = tracer.start_span(
+                s.name, context=ctx, start_time=trace._wall_ns(s.start_ns),
+                attributes={k: str(v) for k, v in s.attrs.items()},
+            )
+            child.end(end_time=trace._wall_ns(s.end_ns))
+        root.end(end_time=trace._wall_ns(trace._end_ns))
+    except Exception as e:
+        print(f"⚠️ Ошибка экспорта OpenTelemetry: {e}")
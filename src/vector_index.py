@@ -0,0 +1,231 @@
+"""
+Векторный поиск без FAISS: матрица эмбеддингов в NumPy (memory-map)
+
+NumpyIndex повторяет ту часть интерфейса faiss.IndexFlatL2, которой
+пользуется проект (d, ntotal, add, search, reconstruct*), поэтому
+подставляется в IndexSnapshot вместо FAISS без изменений в поиске.
+
+Матрица хранится в vectors.npy (float16 или float32) и открывается через
+memory-map: страницы файла общие для всех процессов-воркеров и после
+подмены файла (os.replace) старая версия дочитывается по своему inode.
+Поиск - умножение пакета вопросов на блок матрицы (NUMPY_SEARCH_BLOCK
+строк, float16 приводится к float32 поблочно) и argpartition для top-k.
+
+Без vectors.npy читается сам index.faiss: у IndexFlat это заголовок и
+сырые float32, которые тоже отображаются в память без копирования.
+"""
+import os
+import struct
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+import numpy as np
+
+try:
+    from .config import VECTOR_BACKEND, VECTOR_DTYPE, NUMPY_SEARCH_BLOCK
+except ImportError:
+    from src.config import VECTOR_BACKEND, VECTOR_DTYPE, NUMPY_SEARCH_BLOCK
+
+FAISS_FILE = "index.faiss"
+VECTORS_FILE = "vectors.npy"
+
+METRIC_L2 = "l2"
+METRIC_IP = "ip"
+
+# Сигнатуры IndexFlat в формате faiss.write_index и их метрики
+_FAISS_FLAT = {b"IxF2": METRIC_L2, b"IxFI": METRIC_IP}
+_FAISS_METRICS = {0: METRIC_IP, 1: METRIC_L2}
+
+
+class NumpyIndex:
+    """
+    Точный поиск (как IndexFlatL2/IndexFlatIP) по матрице NumPy
+
+    search возвращает (расстояния, номера) в формате FAISS: квадрат L2
+    по возрастанию (для ip - скалярное произведение по убыванию), при
+    k > ntotal лишние номера равны -1.
+    """
+
+    def __init__(self, vectors: np.ndarray, metric: str = METRIC_L2, block: int = NUMPY_SEARCH_BLOCK):
+        if vectors.ndim != 2:
+            raise ValueError(f"Ожидается матрица векторов, получено измерений: {vectors.ndim}")
+        if metric not in (METRIC_L2, METRIC_IP):
+            raise ValueError(f"Неизвестная метрика: {metric}")
+        self.vectors = vectors
+        self.metric = metric
+        self.block = max(1, block)
+        self._norms: Optional[np.ndarray] = None
+
+    @classmethod
+    def empty(cls, dimension: int, dtype: str = "float32", metric: str = METRIC_L2) -> "NumpyIndex":
+        return cls(np.zeros((0, dimension), dtype=dtype), metric)
+
+    @property
+    def d(self) -> int:
+        return int(self.vectors.shape[1])
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.vectors.shape[0])
+
+    @property
+    def dtype(self) -> str:
+        return str(self.vectors.dtype)
+
+    def _blocks(self):
+        """Блоки строк в float32; float16 приводится в один буфер на весь проход"""
+        buffer = None
+        if self.vectors.dtype != np.float32:
+            buffer = np.empty((min(self.block, self.ntotal), self.d), dtype=np.float32)
+        for start in range(0, self.ntotal, self.block):
+            end = min(start + self.block, self.ntotal)
+            if buffer is None:
+                yield start, np.asarray(self.vectors[start:end])
+            else:
+                rows = buffer[:end - start]
+                rows[...] = self.vectors[start:end]
+                yield start, rows
+
+    def _row_norms(self) -> np.ndarray:
+        """Квадраты норм строк (float32), считаются при первом поиске"""
+        if self._norms is None:
+            norms = np.empty(self.ntotal, dtype=np.float32)
+            for start, rows in self._blocks():
+                norms[start:start + len(rows)] = np.einsum("ij,ij->i", rows, rows)
+            self._norms = norms
+        return self._norms
+
+    def add(self, x: np.ndarray):
+        """Добавить векторы (в памяти; для сохранения - save)"""
+        x = np.asarray(x, dtype=self.vectors.dtype).reshape(-1, self.d)
+        self.vectors = np.concatenate([np.asarray(self.vectors), x])
+        self._norms = None
+
+    def search(self, x: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        x = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, self.d)
+        nq = len(x)
+        distances = np.full((nq, k), np.inf if self.metric == METRIC_L2 else -np.inf, dtype=np.float32)
+        labels = np.full((nq, k), -1, dtype=np.int64)
+        keep = min(k, self.ntotal)
+        if nq == 0 or keep == 0:
+            return distances, labels
+
+        # Ранжирование по «чем меньше, тем лучше»: L2 без ||x||² (одинаков для строки) или -ip
+        best_cost = np.empty((nq, 0), dtype=np.float32)
+        best_ids = np.empty((nq, 0), dtype=np.int64)
+        norms = self._row_norms() if self.metric == METRIC_L2 else None
+        for start, rows in self._blocks():
+            product = x @ rows.T
+            if self.metric == METRIC_L2:
+                cost = norms[start:start + len(rows)] - 2 * product
+            else:
+                cost = -product
+            ids = np.broadcast_to(np.arange(start, start + len(rows), dtype=np.int64), cost.shape)
+            cost = np.concatenate([best_cost, cost], axis=1)
+            ids = np.concatenate([best_ids, ids], axis=1)
+            if cost.shape[1] > keep:
+                part = np.argpartition(cost, keep - 1, axis=1)[:, :keep]
+                cost = np.take_along_axis(cost, part, axis=1)
+                ids = np.take_along_axis(ids, part, axis=1)
+            best_cost, best_ids = cost, ids
+
+        order = np.argsort(best_cost, axis=1, kind="stable")
+        best_cost = np.take_along_axis(best_cost, order, axis=1)
+        labels[:, :keep] = np.take_along_axis(best_ids, order, axis=1)
+        if self.metric == METRIC_L2:
+            squared = np.einsum("ij,ij->i", x, x)[:, None]
+            distances[:, :keep] = np.maximum(best_cost + squared, 0)
+        else:
+            distances[:, :keep] = -best_cost
+        return distances, labels
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return np.asarray(self.vectors[int(i)], dtype=np.float32)
+
+    def reconstruct_batch(self, ids) -> np.ndarray:
+        return np.asarray(self.vectors[np.asarray(ids, dtype=np.int64)], dtype=np.float32)
+
+    def reconstruct_n(self, i0: int, n: int) -> np.ndarray:
+        return np.asarray(self.vectors[i0:i0 + n], dtype=np.float32)
+
+    def save(self, path: Path, dtype: Optional[str] = None):
+        """Записать матрицу в .npy (через временный файл и os.replace)"""
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.asarray(self.vectors, dtype=dtype or self.vectors.dtype))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True, metric: str = METRIC_L2) -> "NumpyIndex":
+        return cls(np.load(path, mmap_mode="r" if mmap else None), metric)
+
+    @classmethod
+    def from_faiss(cls, index: Any, dtype: str = "float32") -> "NumpyIndex":
+        """Копия векторов индекса FAISS (любого, поддерживающего reconstruct_n)"""
+        metric = _FAISS_METRICS.get(int(getattr(index, "metric_type", 1)), METRIC_L2)
+        return cls(index.reconstruct_n(0, index.ntotal).astype(dtype), metric)
+
+
+def read_faiss_flat(path: Path) -> NumpyIndex:
+    """
+    IndexFlatL2/IndexFlatIP из файла faiss.write_index без установленного FAISS
+
+    Формат: сигнатура, d (int32), ntotal, два служебных int64, is_trained
+    (uint8), metric_type (int32), размер вектора данных (uint64) и сами
+    float32 построчно. Другие типы индексов (IVF, HNSW) не поддерживаются.
+    """
+    path = Path(path)
+    with open(path, "rb") as f:
+        head = f.read(45)
+    if len(head) < 45 or head[:4] not in _FAISS_FLAT:
+        raise ValueError(f"{path.name}: не IndexFlat (сигнатура {head[:4]!r}), нужен FAISS")
+    d, ntotal = struct.unpack_from("<iq", head, 4)
+    metric_type, size = struct.unpack_from("<iQ", head, 33)
+    # Новые версии FAISS пишут размер в байтах, старые - в числах float
+    if size not in (ntotal * d * 4, ntotal * d):
+        raise ValueError(f"{path.name}: размер данных {size} не соответствует {ntotal}×{d}")
+    vectors = np.memmap(path, dtype="<f4", mode="r", offset=45, shape=(ntotal, d))
+    return NumpyIndex(vectors, _FAISS_METRICS.get(metric_type, _FAISS_FLAT[head[:4]]))
+
+
+def load_vector_index(index_dir: Path, backend: str = VECTOR_BACKEND) -> Tuple[Any, str]:
+    """
+    Индекс версии из каталога и имя бэкенда ("faiss" / "numpy")
+
+    auto - FAISS, если он установлен и есть index.faiss, иначе NumPy;
+    numpy - vectors.npy, а без него index.faiss (IndexFlat). (None, "") -
+    векторов в каталоге нет.
+    """
+    index_dir = Path(index_dir)
+    faiss_file = index_dir / FAISS_FILE
+    vectors_file = index_dir / VECTORS_FILE
+    if backend not in ("auto", "faiss", "numpy"):
+        raise ValueError(f"Неизвестный VECTOR_BACKEND: {backend}")
+
+    if backend != "numpy" and faiss_file.exists():
+        try:
+            import faiss
+            return faiss.read_index(str(faiss_file)), "faiss"
+        except ImportError:
+            if backend == "faiss":
+                raise
+            print("⚠️ FAISS не установлен - векторный поиск через NumPy")
+
+    if vectors_file.exists():
+        return NumpyIndex.load(vectors_file), "numpy"
+    if faiss_file.exists():
+        return read_faiss_flat(faiss_file), "numpy"
+    return None, ""
+
+
+def new_index(dimension: int, backend: str = VECTOR_BACKEND) -> Any:
+    """Пустой индекс для построения: faiss.IndexFlatL2 или NumpyIndex"""
+    if backend != "numpy":
+        try:
+            import faiss
+            return faiss.IndexFlatL2(dimension)
+        except ImportError:
+            if backend == "faiss":
+                raise
+    return NumpyIndex.empty(dimension, VECTOR_DTYPE)
@@ -0,0 +1,1074 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.common import percentile, summarize, compare
+
+
+def test_percentile_interpolates():
+    values = [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert percentile(values, 50) == 3.0
+    assert percentile(values, 100) == 5.0
+    assert percentile(values, 95) == 4.8
+    assert percentile([], 99) == 0.0
+
+
+def test_summarize_reports_throughput():
+    result = summarize([0.1, 0.2, 0.3, 0.4], wall_s=2.0)
+    assert result["n"] == 4
+    assert result["p50_ms"] == 250.0
+    assert result["throughput_rps"] == 2.0
+
+
+def test_compare_flags_only_regressions():
+    baseline = {"search": {"p95_ms": 10.0, "throughput_rps": 100.0, "n": 50}}
+    assert compare({"search": {"p95_ms": 11.0, "throughput_rps": 95.0, "n": 10}}, baseline, 0.25) == []
+
+    regressions = compare({"search": {"p95_ms": 20.0, "throughput_rps": 50.0}}, baseline, 0.25)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("search.p95_ms")
+
+
+def test_load_test_counts_connection_errors_and_continues():
+    import socket
+    from benchmarks.load_test import run_load
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    result = run_load(f"http://127.0.0.1:{port}", n_requests=5, concurrency=3, top_k=3)
+    assert result["errors"] == 5 and result["n"] == 0
+
+
+def test_eval_retrieval_metrics_on_hand_made_ranking(monkeypatch):
+    import math
+    import pytest
+    from benchmarks import eval_retrieval
+    from benchmarks.eval_retrieval import score_ranking
+
+    ranked, relevant = ["a", "b", "c", "d"], {"b", "d", "x"}
+    idcg = 1 + 1 / math.log2(3) + 1 / math.log2(4)
+    assert score_ranking(ranked, relevant, 1) == {"recall": 0.0, "rr": 0.0, "ndcg": 0.0}
+    at3 = score_ranking(ranked, relevant, 3)
+    assert at3["recall"] == pytest.approx(1 / 3) and at3["rr"] == 0.5
+    assert at3["ndcg"] == pytest.approx((1 / math.log2(3)) / idcg)
+    at5 = score_ranking(ranked, relevant, 5)
+    assert at5["recall"] == pytest.approx(2 / 3) and at5["rr"] == 0.5
+    assert at5["ndcg"] == pytest.approx((1 / math.log2(3) + 1 / math.log2(5)) / idcg)
+    assert score_ranking(["b", "d", "x"], relevant, 3) == pytest.approx({"recall": 1.0, "rr": 1.0, "ndcg": 1.0})
+    assert score_ranking(ranked, set(), 3) == {"recall": 0.0, "rr": 0.0, "ndcg": 0.0}
+
+    # Чанки одной статьи дают один URL; качество усредняется по вопросам
+    rankings = {"q1": ["a", "a", "b"], "q2": ["c"]}
+    monkeypatch.setitem(eval_retrieval.RETRIEVERS, "fake", lambda: lambda q, k: rankings[q])
+    items = [{"question": "q1", "relevant": ["b"]}, {"question": "q2", "relevant": ["c"]}]
+    result = eval_retrieval.evaluate("fake", items, [1, 2])
+    assert result["quality"] == {
+        "recall@1": 0.5, "ndcg@1": 0.5,
+        "recall@2": 1.0, "ndcg@2": round((1 / math.log2(3) + 1) / 2, 4),
+        "mrr": 0.75,
+    }
+    assert result["latency"]["n"] == 2
+
+
+def test_fair_scheduler_interleaves_chats():
+    import asyncio
+    import pytest
+    from src.scheduler import FairScheduler, QueueFull
+
+    order = []
+
+    async def job(scheduler, chat, i):
+        async with scheduler.slot(chat):
+            order.append((chat, i))
+            await asyncio.sleep(0.001)
+
+    async def run():
+        scheduler = FairScheduler(max_concurrent=1, per_chat_limit=1, max_pending_per_chat=3)
+        tasks = [asyncio.create_task(job(scheduler, "A", i)) for i in range(4)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(job(scheduler, "B", i)) for i in range(2)]
+        await asyncio.sleep(0)
+        try:
+            await scheduler.acquire("A")
+        except QueueFull:
+            pass
+        else:
+            raise AssertionError("очередь чата A должна быть заполнена")
+        await asyncio.gather(*tasks)
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert order == [("A", 0), ("B", 0), ("A", 1), ("B", 1), ("A", 2), ("A", 3)]
+    assert scheduler.running == 0 and scheduler.queued == 0
+
+    with pytest.raises(ValueError):
+        FairScheduler(max_pending_per_chat=0)
+
+
+def test_dialog_memory_followups_and_eviction():
+    from src.dialog_memory import DialogMemory
+
+    memory = DialogMemory(max_sessions=2, max_turns=2, memory_mb=1, summary_tokens=50)
+    docs = [{"title": "PLA", "content": "Температура печати PLA 200°C", "score": 1.0}]
+    memory.add_turn("a", "Какая температура стола для печати PLA?", "Около 60°C.", "подбор_материала", docs)
+
+    query, followup = memory.rewrite_query("a", "а для PETG?")
+    assert followup and "PLA" in query
+    assert memory.rewrite_query("a", "Как откалибровать стол принтера перед печатью большой модели?")[1] is False
+    assert memory.reusable_documents("a", "а почему?") == docs
+    assert memory.reusable_documents("a", "а для PETG?") is None
+    # Короткий, но самостоятельный вопрос - новая тема; отсылка - продолжение
+    assert memory.rewrite_query("a", "Как откалибровать стол принтера?")[1] is False
+    assert memory.rewrite_query("a", "Почему это происходит?")[1] is True
+
+    # Цепочка уточнений дополняется первым вопросом темы, без вложенных скобок
+    memory.add_turn("a", "а для PETG?", "Около 80°C.", "подбор_материала", docs)
+    query, followup = memory.rewrite_query("a", "а для ABS?")
+    assert followup and query == "а для ABS? (Какая температура стола для печати PLA?)"
+    assert memory.context("a").count("Вопрос:") == 2 and "(" not in memory.context("a")
+
+    for i in range(3):
+        memory.add_turn("a", f"вопрос {i}", "ответ", "другое")
+    assert len(memory._sessions["a"].turns) == 2
+    assert memory._sessions["a"].summary
+
+    memory.add_turn("b", "вопрос", "ответ", "другое")
+    memory.add_turn("c", "вопрос", "ответ", "другое")
+    assert len(memory) == 2 and "a" not in memory._sessions
+
+
+def test_singleflight_shares_one_call():
+    import threading
+    import time
+    from src.singleflight import SingleFlight, normalize_question
+
+    assert normalize_question("  Как сушить  PETG?? ") == normalize_question("как сушить petg")
+
+    flight = SingleFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return "ответ"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert all(answer == "ответ" for answer, _ in results)
+    assert flight.in_flight() == 0
+
+    def broken():
+        raise RuntimeError("upstream")
+
+    try:
+        flight.do("k", broken)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("исключение должно пробрасываться")
+    assert flight.do("k", lambda: "снова")[0] == "снова"
+
+
+def test_llm_policy_retries_and_circuit_breaker():
+    import pytest
+    from benchmarks.pplx_stub import start_stub
+    from src.llm_backends import OpenAICompatibleBackend
+    from src.llm_policy import LLMPolicy, LLMError, CircuitOpenError
+
+    messages = [{"role": "user", "content": "PLA"}]
+
+    flaky = start_stub(0, latency=0.01, fail_first=2)
+    backend = OpenAICompatibleBackend(
+        f"http://127.0.0.1:{flaky.server_port}/chat/completions",
+        policy=LLMPolicy(max_retries=3, retry_base_ms=1, rate_limit_rpm=0, circuit_failures=10),
+    )
+    assert "температуру" in backend.chat(messages)
+    assert flaky.requests == 3
+    flaky.shutdown()
+
+    down = start_stub(0, latency=0.01, error_rate=1.0)
+    backend = OpenAICompatibleBackend(
+        f"http://127.0.0.1:{down.server_port}/chat/completions",
+        policy=LLMPolicy(max_retries=0, rate_limit_rpm=0, circuit_failures=2, circuit_reset_s=60),
+    )
+    for _ in range(2):
+        with pytest.raises(LLMError):
+            backend.chat(messages)
+    with pytest.raises(CircuitOpenError):
+        backend.chat(messages)
+    assert down.requests == 2
+    down.shutdown()
+
+    # Не LLMError (например, TypeError разбора ответа) - сбой без повтора,
+    # пробный запрос half-open освобождается
+    policy = LLMPolicy(max_retries=3, rate_limit_rpm=0, circuit_failures=1, circuit_reset_s=0)
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise TypeError("'NoneType' object is not subscriptable")
+
+    for _ in range(2):
+        with pytest.raises(TypeError):
+            policy.call(broken)
+    assert len(calls) == 2 and policy.breaker.state == policy.breaker.OPEN
+    assert policy.call(lambda: "ok") == "ok" and policy.breaker.state == policy.breaker.CLOSED
+
+
+def test_fake_backend_is_deterministic():
+    from src.llm_backends import FakeBackend, get_backend
+
+    fake = FakeBackend(latency_ms=0, tokens_per_s=0)
+    first = fake.chat([{"role": "user", "content": "Как сушить PETG?"}])
+    assert first == fake.chat([{"role": "user", "content": "Как сушить PETG?"}])
+    assert first != fake.chat([{"role": "user", "content": "Как сушить PLA?"}])
+    assert get_backend("fake") is get_backend("fake")
+
+
+def test_llm_client_shares_backend_policy(monkeypatch):
+    import pytest
+    from src.llm_backends import LLMBackend, get_backend
+    from src.llm_client import PerplexityClient
+
+    with pytest.raises(TypeError):
+        LLMBackend()
+
+    shared = get_backend("perplexity")
+    monkeypatch.setattr(shared, "api_key", "pplx-test")
+    assert PerplexityClient(api_key="pplx-test").backend is shared
+    other = PerplexityClient(api_key="pplx-other").backend
+    assert other is not shared and other.policy is shared.policy
+
+
+def test_token_bucket_limits_rate():
+    import pytest
+    from src.llm_policy import TokenBucket, RateLimitedError
+
+    now = [0.0]
+    bucket = TokenBucket(rate=1.0, burst=2, clock=lambda: now[0])
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(1.0)
+    now[0] = 0.5
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    with pytest.raises(RateLimitedError):
+        bucket.acquire(timeout=0.1)
+    now[0] = 1.0
+    assert bucket.try_acquire() == 0
+
+
+def test_routing_table_by_category_and_complexity(tmp_path):
+    import json
+    from src.routing import RoutingTable
+
+    overrides = tmp_path / "routing.json"
+    overrides.write_text(json.dumps({"основы": {"max_tokens": 300}}), encoding="utf-8")
+    table = RoutingTable(str(overrides))
+
+    simple = table.select("основы", "Что такое 3D-печать?")
+    assert simple.name == "основы" and simple.max_tokens == 300
+
+    defects = table.select("диагностика_дефектов", "Почему слои расслаиваются?")
+    assert defects.model == "strict" and defects.top_k > simple.top_k
+
+    compound = table.select("слайсер", "Как настроить поддержки в Cura? А в PrusaSlicer?")
+    assert compound.name == "слайсер:complex" and compound.max_tokens > table.select("слайсер", "Cura").max_tokens
+    assert table.select("неизвестная", "вопрос").name == "другое"
+
+    # Переопределение категории доходит до её варианта :complex, явное :complex - поверх
+    overrides.write_text(json.dumps({
+        "слайсер": {"model": "sonar-pro", "max_tokens": 600, "kbs": ["wiki"]},
+        "основы:complex": {"top_k": 9},
+        "основы": {"max_tokens": 400},
+        "печать": {"top_k": 2},
+    }), encoding="utf-8")
+    table = RoutingTable(str(overrides))
+    compound = table.select("слайсер", "Как настроить поддержки в Cura? А в PrusaSlicer?")
+    assert (compound.name, compound.model, compound.max_tokens, compound.kbs) == (
+        "слайсер:complex", "sonar-pro", 900, ("wiki",)
+    )
+    basics = table.routes["основы:complex"]
+    assert (basics.top_k, basics.max_tokens, basics.model) == (9, 600, "strict")
+    assert table.routes["печать:complex"].top_k == 4
+
+
+def test_keyword_engine_single_pass_and_stream():
+    from src.keywords import KeywordEngine
+
+    engine = KeywordEngine()
+    matches = engine.scan("Почему слои расслаиваются при печати PLA на принтере?")
+    assert matches.group("category")["диагностика_дефектов"] == 2
+    assert "подбор_материала" in matches.group("category")
+    assert engine.best(matches, "category", "другое") == "диагностика_дефектов"
+    assert matches.group("topic")
+    # Основа совпадает только с началом слова: «негорючий» не опасен
+    assert not engine.scan("Негорючий пластик для корпуса").group("safety")
+    assert engine.best(engine.scan("Какая погода?"), "category", "другое") == "другое"
+
+    answer = "ABS при нагреве выделяет токсичные пары, а пыль легковоспламеняющаяся."
+    scanner = engine.scanner("safety")
+    found = []
+    for i in range(0, len(answer), 7):
+        found += scanner.feed(answer[i:i + 7])
+    found += scanner.finish()
+    assert sorted(found) == ["пожар", "токсичность"]
+    assert sorted(found) == sorted(engine.scan(answer).group("safety"))
+
+
+def test_centroid_classifier_confidence_and_fallback(tmp_path):
+    import numpy as np
+    from src.intent_classifier import CentroidClassifier, QueryClassifier
+
+    rng = np.random.default_rng(0)
+    axes = {"слайсер": 0, "подбор_материала": 1, "основы": 2}
+    vectors, labels = [], []
+    for label, axis in axes.items():
+        for _ in range(5):
+            v = rng.normal(0, 0.1, 8)
+            v[axis] += 1.0
+            vectors.append(v)
+            labels.append(label)
+    path = tmp_path / "centroids.npz"
+    CentroidClassifier.fit(np.array(vectors), labels, "test-model", temperature=0.05).save(path)
+    model = CentroidClassifier.load(path)
+    assert model.categories == ["основы", "подбор_материала", "слайсер"] and model.model_name == "test-model"
+
+    classifier = QueryClassifier(str(path), min_confidence=0.8, llm_fallback=False)
+    confident = classifier.classify("любой текст", np.eye(8)[0], "test-model")
+    assert (confident.category, confident.source) == ("слайсер", "centroid") and confident.confidence > 0.8
+
+    # Между двумя центроидами уверенности нет - решают ключевые слова
+    ambiguous = np.eye(8)[0] + np.eye(8)[1]
+    by_keywords = classifier.classify("Какой пластик выбрать?", ambiguous, "test-model")
+    assert (by_keywords.category, by_keywords.source) == ("подбор_материала", "keywords")
+    # Другая модель эмбеддингов - центроиды не используются
+    assert classifier.classify("Что-то", np.eye(8)[0], "other-model").source == "default"
+
+
+def test_tracing_spans_nest_across_activate_and_threads(monkeypatch):
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor
+    from types import SimpleNamespace
+    import pytest
+    from src import tracing
+
+    # Каждый вызов часов - плюс 1 мс: длительности известны заранее
+    ticks = iter(range(0, 10 ** 9, 1_000_000))
+    monkeypatch.setattr(tracing, "time", SimpleNamespace(perf_counter_ns=lambda: next(ticks), time_ns=lambda: 0))
+    monkeypatch.setattr(tracing, "TRACE_LOG", False)
+
+    trace = tracing.Trace()                                # 0
+    # Без активной трассы спаны ничего не делают
+    with tracing.span("ignored") as s:
+        assert s is None
+    with tracing.activate(trace):
+        with tracing.span("retrieve"):                     # 1 .. 6
+            with tracing.span("embed", batch=2):           # 2 .. 3
+                pass
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                # Новый поток не видит трассу, пока контекст не скопирован
+                assert pool.submit(tracing.current_trace).result() is None
+
+                def in_thread():
+                    with tracing.span("embed", thread=True):   # 4 .. 5
+                        return tracing.current_trace()
+
+                assert pool.submit(contextvars.copy_context().run, in_thread).result() is trace
+        other = tracing.Trace("other")                     # 7
+        with tracing.activate(other):
+            with tracing.span("classify"):                 # 8 .. 9
+                assert tracing.current_trace() is other
+        # Вложенная activate возвращает прежнюю трассу
+        assert tracing.current_trace() is trace
+        with pytest.raises(ValueError):
+            with tracing.span("generate"):                 # 10 .. 11
+                raise ValueError("boom")
+        tracing.record("llm.ttfb", 0.004)                  # 8 .. 12
+    assert tracing.current_trace() is None
+    trace.finish()                                         # 13
+
+    assert [s.name for s in trace.spans] == ["embed", "embed", "retrieve", "generate", "llm.ttfb"]
+    assert [s.name for s in other.spans] == ["classify"]
+    assert trace.spans[0].attrs == {"batch": 2} and trace.spans[1].attrs == {"thread": True}
+    assert trace.spans[3].attrs == {"error": "ValueError"}
+    # Повторяющиеся этапы суммируются; total - от создания до finish
+    assert trace.timings() == {"embed": 2.0, "retrieve": 5.0, "generate": 1.0, "llm.ttfb": 4.0, "total": 13.0}
+    assert trace.server_timing() == (
+        "embed;dur=2.0, retrieve;dur=5.0, generate;dur=1.0, llm_ttfb;dur=4.0, total;dur=13.0"
+    )
+    # Повторный finish не сдвигает конец трассы
+    trace.finish()
+    assert trace.total_ms == 13.0
+
+
+def test_stage_graph_runs_independent_stages_concurrently():
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from src.stage_graph import Stage, StageGraph
+
+    def slow(value, delay):
+        time.sleep(delay)
+        return value
+
+    graph = StageGraph([
+        Stage("a", lambda query: slow(query + "a", 0.1), ("query",)),
+        Stage("b", lambda query: slow(query + "b", 0.1), ("query",)),
+        Stage("late", lambda query: slow("late", 0.5), ("query",), optional=True, default="skip", budget_s=0.15),
+        Stage("out", lambda a, b, late: f"{a}{b}{late}", ("a", "b", "late")),
+    ])
+    result = graph.run({"query": "q"})
+    assert result.outputs["out"] == "qaqbskip"
+    assert result.timings["late"].status == "timeout"
+    # a и b идут параллельно, optional-этап ограничен бюджетом
+    assert result.total_ms < 300
+    assert result.critical_path[0] == "late" and result.critical_path[-1] == "out"
+    assert [row["stage"] for row in result.breakdown()] == result.critical_path
+
+    # Бюджет необязательного этапа отсчитывается от его отправки, а не от начала прогона
+    graph = StageGraph([
+        Stage("embedding", lambda query: slow(query, 0.2), ("query",)),
+        Stage("category", lambda embedding: slow("cat", 0.05), ("embedding",), optional=True, budget_s=0.15),
+    ])
+    result = graph.run({"query": "q"})
+    assert result.outputs["category"] == "cat" and result.timings["category"].status == "ok"
+
+    # Брошенный по бюджету этап держит поток только пула необязательных этапов
+    release = threading.Event()
+    mandatory, optional = ThreadPoolExecutor(max_workers=1), ThreadPoolExecutor(max_workers=1)
+    try:
+        graph = StageGraph([
+            Stage("hang", lambda query: release.wait(5), ("query",), optional=True, default=False, budget_s=0.05),
+            Stage("answer", lambda query: slow(query, 0.01), ("query",)),
+        ], executor=mandatory, optional_executor=optional)
+        for _ in range(3):
+            started = time.perf_counter()
+            result = graph.run({"query": "q"})
+            assert result.outputs == {"hang": False, "answer": "q"}
+            assert time.perf_counter() - started < 0.5
+    finally:
+        release.set()
+        mandatory.shutdown()
+        optional.shutdown()
+
+
+def test_extractive_answer_ranks_sentences_and_extracts_parameters():
+    from src.extractive import extractive_answer, extract_parameters
+
+    params = extract_parameters("Температура сопла 190-220 °C, стола 60°С, скорость 40–60 мм/с.")
+    assert [(p.kind, p.value) for p in params] == [
+        ("температура", "190–220"), ("температура", "60"), ("скорость", "40–60"),
+    ]
+    assert extract_parameters("Ретракт 0,8 мм на директе, 5 мм на боудене.")[0].value == "0.8"
+    # Без слов о ретракте или слое миллиметры не считаются параметром
+    assert not extract_parameters("Диаметр нити 1.75 мм.")
+
+    documents = [
+        {"title": "PLA", "source_url": "https://x/pla", "score": 0.9,
+         "content": "PLA печатают при температуре 190-220 °C. Стол можно не греть. Материал биоразлагаемый."},
+        {"title": "PLA", "source_url": "https://x/pla", "score": 0.5,
+         "content": "Оптимальная температура печати PLA подбирается по башне температур."},
+        {"title": "ABS", "source_url": "https://x/abs", "score": 0.4,
+         "content": "ABS даёт усадку и требует закрытого корпуса."},
+    ]
+    answer = extractive_answer("Какая температура печати PLA?", documents, reason="LLM недоступна")
+    assert answer.startswith("📋 Краткий ответ по базе знаний (без LLM: LLM недоступна)")
+    assert "- Температура: 190–220 °C [1]" in answer
+    # Чанки одной статьи - один источник; ABS не попал в ответ
+    assert answer.count("https://x/pla") == 1 and "https://x/abs" not in answer
+    assert extractive_answer("Как настроить Cura?", documents) is None
+
+
+def test_pack_context_budget_doc_cap_and_overlap_dedup():
+    from src.context_packer import pack_context
+
+    long_doc = {"title": "PLA", "source_url": "u1", "score": 0.9,
+                "content": " ".join(f"Слой PLA номер {i} печатают медленно." for i in range(20))}
+    # Бюджет не превышается, даже если документ мог бы занять больше
+    packed = pack_context("PLA", [long_doc], token_budget=40)
+    assert packed.documents == [long_doc]
+    assert packed.used_tokens <= 40 and 0 < packed.text.count("Слой") < 20
+
+    # Один документ занимает не больше трети бюджета - остальным остаётся место
+    others = [
+        {"title": "Стол", "source_url": "u2", "score": 0.5, "content": "Стол для PLA греют до 60 °C."},
+        {"title": "Сопло", "source_url": "u3", "score": 0.4, "content": "Сопло для PLA греют до 210 °C."},
+    ]
+    packed = pack_context("PLA", [long_doc] + others, token_budget=120)
+    assert packed.documents == [long_doc] + others
+    assert packed.used_tokens <= 120
+    assert packed.text.count("Слой") == pack_context("PLA", [long_doc], token_budget=40).text.count("Слой")
+
+    # Перекрывающиеся чанки: начало второго - обрывок предложения из первого
+    first = {"title": "PLA", "source_url": "u1", "score": 0.9,
+             "content": "Сопло для PLA греют до 210 °C. Стол для PLA греют до 60 °C, обдув включают на втором слое."}
+    second = {"title": "PLA", "source_url": "u1", "score": 0.8,
+              "content": "PLA греют до 60 °C, обдув включают на втором слое. Усадка PLA почти незаметна."}
+    packed = pack_context("Как греть PLA?", [first, second])
+    assert packed.text.count("обдув включают") == 1
+    assert "Усадка PLA почти незаметна." in packed.text
+    # Короткие самостоятельные фразы не считаются обрывками
+    packed = pack_context("PLA", [
+        {"title": "A", "source_url": "u1", "score": 0.9, "content": "PLA не греют выше 230 °C."},
+        {"title": "B", "source_url": "u2", "score": 0.8, "content": "PLA."},
+    ])
+    assert len(packed.documents) == 2
+
+
+def test_search_page_filters_and_paginates():
+    from types import SimpleNamespace
+    from src.index_manager import IndexSnapshot
+    from src.rag_pipeline import RAGPipeline
+
+    chunks = [
+        {"id": f"c{i}", "chunk_id": i, "title": f"t{i}", "content": "печать PLA " * (10 - i),
+         "source_url": f"https://x/{i}", "category": "Pla_Plastic" if i % 2 else "Cura"}
+        for i in range(8)
+    ]
+    rag = RAGPipeline.__new__(RAGPipeline)
+    rag.remote_retriever = None
+    rag.index_manager = SimpleNamespace(current=IndexSnapshot(version="v1", knowledge_base=chunks))
+
+    pages, more, version = rag.search_page(["печать PLA"], offset=0, limit=3)
+    assert version == "v1" and more == [True]
+    assert [d["id"] for d in pages[0]] == ["c0", "c1", "c2"] and pages[0][-1]["rank"] == 3
+
+    pages, more, _ = rag.search_page(["печать PLA"], offset=2, limit=3, categories=["pla_plastic"])
+    assert [d["id"] for d in pages[0]] == ["c5", "c7"] and more == [False]
+    assert pages[0][0]["rank"] == 3
+
+
+def test_mmr_prefers_diverse_chunks_and_merges_neighbours():
+    import numpy as np
+    from src.diversify import mmr, merge_adjacent
+
+    query = np.array([1.0, 0.0, 0.0])
+    candidates = np.array([
+        [0.95, 0.31, 0.0],   # лучший
+        [0.94, 0.34, 0.0],   # почти копия лучшего
+        [0.80, 0.0, 0.60],   # другая сторона вопроса
+    ])
+    assert mmr(query, candidates, 2, lambda_mult=1.0) == [0, 1]
+    assert mmr(query, candidates, 2, lambda_mult=0.5) == [0, 2]
+
+    docs = [
+        {"source_url": "a", "chunk_id": 5, "content": "Первый кусок. Общий хвост", "score": 0.9},
+        {"source_url": "b", "chunk_id": 9, "content": "Другая статья", "score": 0.8},
+        {"source_url": "a", "chunk_id": 6, "content": "Общий хвост и продолжение.", "score": 0.7},
+    ]
+    merged = merge_adjacent(docs)
+    assert [d["source_url"] for d in merged] == ["a", "b"]
+    assert merged[0]["content"] == "Первый кусок. Общий хвост и продолжение."
+    assert merged[0]["chunk_ids"] == [5, 6] and merged[0]["score"] == 0.9
+
+
+def test_numpy_index_matches_faiss_flat_and_reads_its_file(tmp_path):
+    import numpy as np
+    import pytest
+    from src.vector_index import NumpyIndex, read_faiss_flat, load_vector_index
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(200, 16)).astype(np.float32)
+    queries = vectors[:5] + rng.normal(0, 0.01, (5, 16)).astype(np.float32)
+
+    exact = NumpyIndex(vectors)
+    distances, labels = NumpyIndex(vectors, block=7).search(queries, 4)
+    assert (labels[:, 0] == np.arange(5)).all()
+    assert (labels == exact.search(queries, 4)[1]).all()
+    expected = ((vectors[labels[0]] - queries[0]) ** 2).sum(axis=1)
+    assert np.allclose(distances[0], expected, rtol=1e-4, atol=1e-4)
+    assert (NumpyIndex(vectors[:3]).search(queries[:1], 5)[1][0, 3:] == -1).all()
+
+    exact.save(tmp_path / "vectors.npy", "float16")
+    index, backend = load_vector_index(tmp_path, backend="numpy")
+    assert backend == "numpy" and index.dtype == "float16" and index.ntotal == 200
+    assert (index.search(queries, 1)[1][:, 0] == np.arange(5)).all()
+
+    faiss = pytest.importorskip("faiss")
+    flat = faiss.IndexFlatL2(16)
+    flat.add(vectors)
+    faiss.write_index(flat, str(tmp_path / "index.faiss"))
+    parsed = read_faiss_flat(tmp_path / "index.faiss")
+    assert np.array_equal(parsed.reconstruct_n(0, 200), vectors)
+    assert (parsed.search(queries, 4)[1] == flat.search(queries, 4)[1]).all()
+
+
+def test_sharded_index_merges_shards_and_returns_partial_results(tmp_path):
+    import json
+    import pickle
+    import numpy as np
+    from src import tracing
+    from src.index_manager import index_version
+    from src.sharding import open_shards, shard_dirs
+    from src.vector_index import NumpyIndex
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(60, 8)).astype(np.float32)
+    for i, rows in enumerate((slice(0, 25), slice(25, 60))):
+        path = tmp_path / "shards" / f"wiki-{i}"
+        path.mkdir(parents=True)
+        NumpyIndex(vectors[rows]).save(path / "vectors.npy")
+        with open(path / "documents.pkl", "wb") as f:
+            pickle.dump(([f"t{i}"] * len(vectors[rows]), [{"url": f"u{i}"}] * len(vectors[rows])), f)
+        with open(path / "manifest.json", "w") as f:
+            json.dump({"version": f"v{i}", "model": "m"}, f)
+
+    dirs = shard_dirs(tmp_path)
+    version = index_version(tmp_path)
+    index = open_shards(dirs, timeout_ms=5000)
+    queries = vectors[[3, 40]] + 0.01
+    distances, labels = index.search(queries, 5)
+    expected_distances, expected_labels = NumpyIndex(vectors).search(queries, 5)
+    assert index.ntotal == 60 and (labels == expected_labels).all()
+    assert np.allclose(distances, expected_distances, atol=1e-4)
+    assert np.array_equal(index.reconstruct_batch([3, 40]), vectors[[3, 40]])
+
+    index.workers[1].stop()
+    trace = tracing.Trace("test")
+    with tracing.activate(trace):
+        _, labels = index.search(queries, 5)
+    assert trace.attrs["missing_shards"] == ["wiki-1"]
+    assert labels[0, 0] == 3 and (labels[(labels >= 0)] < 25).all()
+    index.workers[0].stop()
+
+    with open(dirs[1] / "manifest.json", "w") as f:
+        json.dump({"version": "v1-rebuilt", "model": "m"}, f)
+    assert index_version(tmp_path) != version
+
+
+def test_kb_registry_lazy_load_lru_and_federated_search(tmp_path):
+    import json
+    import pickle
+    import pytest
+    from src.kb_registry import KBRegistry
+    from src.rag_pipeline import RAGPipeline
+
+    def make_kb(path, texts):
+        path.mkdir(parents=True)
+        with open(path / "documents.pkl", "wb") as f:
+            pickle.dump((texts, [{"url": f"https://{path.name}/{i}", "title": path.name} for i in range(len(texts))]), f)
+        with open(path / "manifest.json", "w") as f:
+            json.dump({"version": f"{path.name}-1"}, f)
+
+    make_kb(tmp_path / "wiki", ["печать PLA на 200 °C", "калибровка стола"])
+    make_kb(tmp_path / "kbs" / "vendor_prusa", ["Prusa MK4: печать PLA PLA с обдувом"])
+    make_kb(tmp_path / "kbs" / "runbooks", ["перезапуск сервиса печати"])
+    # Бюджет меньше любой базы: загруженной остаётся только основная и последняя
+    registry = KBRegistry(tmp_path / "kbs", tmp_path / "wiki", tmp_path / "none.jsonl", budget_mb=1e-6)
+
+    assert registry.names() == ["wiki", "runbooks", "vendor_prusa"]
+    assert not any(kb["loaded"] for kb in registry.status()["kbs"])
+    with pytest.raises(ValueError):
+        registry.resolve(["vendor_bambu"])
+    assert registry.resolve(["vendor_prusa", "wiki", "vendor_prusa"]) == ["vendor_prusa", "wiki"]
+
+    rag = RAGPipeline.__new__(RAGPipeline)
+    rag.remote_retriever = None
+    rag.kbs = registry
+    rag.index_manager = registry.manager("wiki")
+
+    pages, _, version = rag.search_page(["печать PLA"], limit=3, kbs=["wiki", "vendor_prusa"])
+    assert version == "wiki@wiki-1+vendor_prusa@vendor_prusa-1"
+    assert {d["kb"] for d in pages[0]} == {"wiki", "vendor_prusa"}
+    assert all("kb" not in d for d in rag.search_page(["печать PLA"], kbs=["wiki"])[0][0])
+
+    registry.snapshot("runbooks")
+    loaded = {kb["name"]: kb for kb in registry.status()["kbs"]}
+    assert loaded["wiki"]["loaded"] and loaded["runbooks"]["loaded"]
+    assert not loaded["vendor_prusa"]["loaded"]
+    assert loaded["runbooks"]["memory_bytes"] > 0
+
+
+def test_thread_budget_presets_and_compute_slots(monkeypatch):
+    import threading
+    import time
+    import pytest
+    from src import thread_budget
+
+    serving = thread_budget.make_budget("serving", cores=8)
+    assert (serving.intra_op, serving.slots) == (1, 8)
+    build = thread_budget.make_budget("build", cores=8)
+    assert (build.intra_op, build.slots) == (8, 1)
+    # 4 процесса сервиса поиска, по пакету за раз: по 2 ядра на пакет
+    worker = thread_budget.make_budget("serving", processes=4, concurrency=1, cores=8)
+    assert (worker.cores, worker.intra_op, worker.slots) == (2, 2, 1)
+    assert thread_budget.make_budget("serving", cores=8, intra_op=3).slots == 2
+    with pytest.raises(ValueError):
+        thread_budget.make_budget("turbo")
+
+    monkeypatch.setattr(thread_budget, "_slots", thread_budget._Slots(2))
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def stage():
+        with thread_budget.compute_slot("search"):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+    threads = [threading.Thread(target=stage) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak[0] == 2
+
+
+def test_index_manager_reload_rejection_rollback_and_watch(tmp_path, monkeypatch):
+    import json
+    import pickle
+    import time
+    import numpy as np
+    from src import index_manager
+    from src.index_manager import IndexManager
+    from src.vector_index import NumpyIndex
+
+    class FakeModel:
+        def get_sentence_embedding_dimension(self):
+            return 4
+
+        def encode(self, texts):
+            return np.ones((len(texts), 4), dtype=np.float32)
+
+    monkeypatch.setattr(index_manager, "_load_model", lambda name: FakeModel())
+
+    def publish(version, chunks, vectors=None):
+        with open(tmp_path / "documents.pkl", "wb") as f:
+            pickle.dump(([f"чанк {i}" for i in range(chunks)], [{"url": f"u{i}"} for i in range(chunks)]), f)
+        NumpyIndex(np.ones((vectors or chunks, 4), dtype=np.float32)).save(tmp_path / "vectors.npy")
+        with open(tmp_path / "manifest.json", "w") as f:
+            json.dump({"version": version, "model": "fake"}, f)
+
+    loads = []
+    real_load = index_manager.load_snapshot
+    monkeypatch.setattr(index_manager, "load_snapshot", lambda *a: loads.append(1) or real_load(*a))
+
+    publish("v1", 2)
+    manager = IndexManager(tmp_path, tmp_path / "none.jsonl", primary=False)
+    manager.load_initial()
+    assert manager.current.version == "v1" and manager.current.backend == "numpy"
+    assert not manager.reload()
+
+    publish("v2", 3)
+    snapshot = manager.current
+    assert manager.reload()
+    assert (manager.current.version, manager.previous.version) == ("v2", "v1")
+    assert snapshot.version == "v1" and len(snapshot.knowledge_base) == 2
+
+    # Векторов меньше, чем чанков: версия отклоняется один раз
+    publish("v3", 3, vectors=2)
+    assert not manager.reload()
+    assert manager.current.version == "v2" and manager.skipped_version == "v3"
+    assert "v3" in manager.last_error
+    loads.clear()
+    assert not manager.reload()
+    assert not loads
+
+    # Откат с v2 на v1 не перезагружает v3, которая осталась на диске
+    assert manager.rollback()
+    assert manager.current.version == "v1" and manager.skipped_version == "v3"
+    manager.watch(0.01)
+    time.sleep(0.1)
+    assert manager.current.version == "v1" and not loads
+
+    publish("v4", 1)
+    deadline = time.time() + 5
+    while manager.current.version != "v4" and time.time() < deadline:
+        time.sleep(0.01)
+    manager.stop()
+    assert manager.current.version == "v4" and manager.skipped_version == ""
+    assert manager.status()["previous"]["version"] == "v1"
+
+
+def test_followup_in_session_keeps_simple_route():
+    from src import tracing
+    from src.dialog_memory import DialogMemory
+    from src.index_manager import IndexManager, IndexSnapshot
+    from src.intent_classifier import get_classifier
+    from src.keywords import get_engine
+    from src.rag_pipeline import RAGPipeline
+    from src.routing import RoutingTable
+
+    rag = RAGPipeline.__new__(RAGPipeline)
+    rag.remote_retriever = None
+    rag.kbs = None
+    rag.index_manager = IndexManager("none", "none.jsonl", primary=False)
+    rag.index_manager.current = IndexSnapshot(version="v1", knowledge_base=[
+        {"title": "PLA", "content": "Температура стола для PLA 60 °C, для PETG 80 °C.", "source_url": "u1"},
+    ])
+    rag.dialog_memory = DialogMemory(db_path="")
+    rag.routing = RoutingTable()
+    rag.keywords = get_engine()
+    rag.classifier = get_classifier()
+    rag.llm_flight = None
+    rag.llm_pool = None
+
+    routes = []
+    for question in ("Какая температура стола для PLA?", "а для PETG?"):
+        trace = tracing.Trace("query")
+        with tracing.activate(trace):
+            rag.query(question, session_id="s", mode="extractive")
+        routes.append(trace.attrs["route"])
+    assert not any(r.endswith(":complex") for r in routes)
+
+
+def test_answer_mode_when_documents_do_not_fit_context():
+    from src import tracing
+    from src.rag_pipeline import RAGPipeline
+    from src.routing import Route
+
+    rag = RAGPipeline.__new__(RAGPipeline)
+    documents = [{"title": "PLA", "source_url": "u1", "score": 0.9,
+                  "content": "PLA печатают при температуре 190-220 °C. Стол можно не греть."}]
+    # Бюджет меньше заголовка документа - в контекст не попадает ничего
+    trace = tracing.Trace("query")
+    with tracing.activate(trace):
+        answer = rag._generate_answer("Какая температура печати PLA?", "подбор_материала", documents,
+                                      route=Route(name="tiny", context_budget=1))
+    assert (trace.attrs["answer_mode"], trace.attrs["answer_reason"]) == ("extractive", "empty_context")
+    assert "190–220 °C" in answer
+
+
+def test_dialog_memory_shared_between_processes(tmp_path):
+    import os
+    import numpy as np
+    from src.dialog_memory import DialogMemory
+
+    db = str(tmp_path / "dialogs.sqlite3")
+    first, second = DialogMemory(db_path=db), DialogMemory(db_path=db)
+    docs = [{"title": "PLA", "content": "Стол для PLA греют до 60°C", "source_url": "u1",
+             "score": np.float32(0.5), "embedding": [0.1, 0.2]}]
+    first.add_turn("s", "Какая температура стола для PLA?", "Около 60°C.", "подбор_материала", docs)
+    assert second.rewrite_query("s", "а для PETG?")[0] == "а для PETG? (Какая температура стола для PLA?)"
+    # Найденные документы переживают перезагрузку сессии из базы
+    expected = [{"title": "PLA", "content": "Стол для PLA греют до 60°C", "source_url": "u1", "score": 0.5}]
+    assert second.reusable_documents("s", "а почему?") == expected
+    assert DialogMemory(db_path=db).reusable_documents("s", "а почему?") == expected
+
+    # Сессия в кэше второго процесса устарела - перечитывается из базы
+    first.add_turn("s", "Как откалибровать стол принтера?", "Винтами.", "настройка_принтера")
+    assert second.rewrite_query("s", "а почему?")[0] == "а почему? (Как откалибровать стол принтера?)"
+
+    # После fork у воркера своё соединение SQLite
+    pid = os.fork()
+    if pid == 0:
+        try:
+            first.add_turn("s", "Чем клеить PETG к столу?", "Клей-карандаш.", "подбор_материала")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert "Чем клеить PETG" in second.context("s") and "Чем клеить PETG" in first.context("s")
+
+
+def test_serve_applies_thread_budget_before_numpy_import():
+    import os
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    code = "\n".join([
+        "import os, sys",
+        "from src import serve, thread_budget",
+        "assert 'numpy' not in sys.modules",
+        "budget = thread_budget.apply(thread_budget.make_budget('build', processes=2, cores=8))",
+        "from src import api",
+        "assert 'numpy' in sys.modules and thread_budget.current() == budget",
+        "print(os.environ['OMP_NUM_THREADS'])",
+    ])
+    env = {k: v for k, v in os.environ.items() if k not in ("OMP_NUM_THREADS", "INTRA_OP_THREADS", "CPU_THREADS")}
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=Path(__file__).parent.parent, env=env,
+        capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stderr
+    # Импорт api не сбрасывает бюджет мастера к бюджету одного процесса
+    assert result.stdout.strip().splitlines()[-1] == "4"
+
+
+def test_serve_prefork_workers_share_pipeline(tmp_path):
+    import json
+    import os
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import time
+    import urllib.request
+    from pathlib import Path
+    from prometheus_client.parser import text_string_to_metric_families
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, LLM_BACKEND="fake", TRACE_LOG="0", INDEX_WATCH_INTERVAL="0", TMPDIR=str(tmp_path))
+    env.pop("DIALOG_DB_PATH", None)
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "src.serve", "--workers", "2", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=Path(__file__).parent.parent, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+
+    def post(question):
+        body = json.dumps({"question": question, "session_id": "s", "mode": "extractive"}).encode()
+        request = urllib.request.Request(base + "/query", body, {"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=30) as r:
+            return json.load(r)
+
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                urllib.request.urlopen(base + "/health", timeout=1).close()
+                break
+            except OSError:
+                assert server.poll() is None and time.time() < deadline
+                time.sleep(0.2)
+        assert len(list(tmp_path.glob("rag-dialogs-*.sqlite3"))) == 1
+        questions = ["Какая температура стола для PLA?", "а для PETG?", "а почему?"] * 4
+        for question in questions:
+            assert post(question)["answer"]
+        # Каждое соединение принимает любой воркер, а счётчики - сумма по всем
+        for _ in range(4):
+            with urllib.request.urlopen(base + "/metrics", timeout=10) as r:
+                text = r.read().decode()
+            answers = sum(
+                sample.value for family in text_string_to_metric_families(text) for sample in family.samples
+                if sample.name == "rag_answers_total"
+            )
+            assert answers == len(questions)
+        for worker in ("0", "1"):
+            assert f'rag_worker_memory_bytes{{kind="uss",worker="{worker}"}}' in text
+        assert len(list(tmp_path.glob("rag-metrics-*"))) == 1
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+    assert not list(tmp_path.glob("rag-dialogs-*")) and not list(tmp_path.glob("rag-metrics-*"))
+
+
+def test_remote_retriever_round_trip_timeout_and_local_fallback(tmp_path, monkeypatch):
+    import json
+    import socket
+    import socketserver
+    import threading
+    import time
+    import pytest
+    from src import metrics, rag_pipeline, tracing
+    from src.rag_pipeline import RAGPipeline
+    from src.retrieval_service import RemoteRetriever, _HEADER, _encode, _recv_exact
+
+    requests, delay = [], [0.0]
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            try:
+                while True:
+                    (length,) = _HEADER.unpack(_recv_exact(self.request, _HEADER.size))
+                    payload = json.loads(_recv_exact(self.request, length))
+                    requests.append(payload)
+                    time.sleep(delay[0])
+                    results = [[{"title": q, "top_k": payload["top_k"]}] for q in payload["queries"]]
+                    self.request.sendall(_encode({"results": results}))
+            except (ConnectionError, OSError):
+                pass
+
+    path = str(tmp_path / "retrieval.sock")
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        retriever = RemoteRetriever(path, timeout=0.2)
+        assert retriever.search_batch(["PLA", "PETG"], 2) == [[{"title": "PLA", "top_k": 2}], [{"title": "PETG", "top_k": 2}]]
+
+        # Таймаут не повторяется; опоздавший ответ не достаётся следующему запросу
+        delay[0] = 0.5
+        with pytest.raises(socket.timeout):
+            retriever.search("ABS")
+        assert len(requests) == 2
+        delay[0] = 0.0
+        assert retriever.search("TPU") == [{"title": "TPU", "top_k": 3}]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Сервис недоступен - текстовый поиск по локальному processed.jsonl
+    articles = tmp_path / "processed.jsonl"
+    articles.write_text("\n".join(json.dumps(a, ensure_ascii=False) for a in [
+        {"title": "Температура PLA", "content": "Печать PLA при 200 °C", "source_url": "u1"},
+        {"title": "Калибровка", "content": "Калибровка стола", "source_url": "u2"},
+    ]), encoding="utf-8")
+    monkeypatch.setattr(rag_pipeline, "PROCESSED_DATA_PATH", articles)
+    rag = RAGPipeline(retrieval_mode="remote")
+    rag.remote_retriever = RemoteRetriever(str(tmp_path / "missing.sock"), timeout=0.2)
+    errors = lambda: sum(
+        metric.value for family in metrics.ERRORS.collect() for metric in family.samples
+        if metric.name == "rag_errors_total" and metric.labels["stage"] == "retrieve.remote"
+    )
+    before = errors()
+    with tracing.activate(tracing.Trace()):
+        documents = rag._search_documents("температура PLA", 2)
+    assert [d["source_url"] for d in documents] == ["u1"]
+    # Ошибка внутри спана учитывается один раз
+    assert errors() - before == 1
+
+
+def test_telegram_webhook_checks_secret_and_answers(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    import pytest
+    from fastapi.testclient import TestClient
+    from benchmarks.fake_telegram import start_fake_telegram, make_update
+    from src import api, telegram_bot
+
+    class Pipeline:
+        kbs = None
+
+        def query(self, question, session_id=None):
+            return f"ответ на «{question}» ({session_id})"
+
+    telegram = start_fake_telegram()
+    monkeypatch.setattr(telegram_bot, "BOT_TOKEN", "1:fake")
+    monkeypatch.setattr(telegram_bot, "TELEGRAM_API_BASE_URL", f"http://127.0.0.1:{telegram.server_port}/bot")
+    monkeypatch.setattr(telegram_bot, "rag", None)
+    monkeypatch.setattr(telegram_bot, "rag_executor", None)
+    monkeypatch.setattr(api, "TELEGRAM_MODE", "webhook")
+    monkeypatch.setattr(api, "TELEGRAM_WEBHOOK_URL", "")
+    monkeypatch.setattr(api, "TELEGRAM_WEBHOOK_SECRET", "s3cret")
+    monkeypatch.setattr(api, "rag_pipeline", Pipeline())
+    monkeypatch.setattr(api, "rag_executor", ThreadPoolExecutor(max_workers=2))
+    monkeypatch.setattr(api, "telegram_app", None)
+    try:
+        with TestClient(api.app) as client:
+            wrong = {"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+            assert client.post(api.WEBHOOK_PATH, json=make_update("Как сушить PETG?"), headers=wrong).status_code == 403
+            assert client.post(api.WEBHOOK_PATH, json=make_update("Как сушить PETG?")).status_code == 403
+
+            secret = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+            response = client.post(api.WEBHOOK_PATH, json=make_update("Как сушить PLA?", chat_id=7), headers=secret)
+            assert response.status_code == 200 and response.json() == {"ok": True}
+            sent = telegram.wait_messages(1, timeout=10)
+        assert len(sent) == 1
+        assert str(sent[0]["chat_id"]) == "7" and sent[0]["text"] == "ответ на «Как сушить PLA?» (tg:7)"
+
+        # Без секрета webhook не запускается
+        monkeypatch.setattr(api, "TELEGRAM_WEBHOOK_SECRET", "")
+        monkeypatch.setattr(api, "telegram_app", None)
+        with pytest.raises(ValueError, match="TELEGRAM_WEBHOOK_SECRET"):
+            with TestClient(api.app):
+                pass
+        assert api.telegram_app is None
+    finally:
+        telegram.shutdown()
@@ -0,0 +1,193 @@
+"""
+Обучение и оценка классификатора категорий по эмбеддингу вопроса
+
+Центроиды категорий строятся из размеченных вопросов
+data/classifier_examples.json; с --from-index к ним добавляются векторы
+чанков индекса с метками по разделу вики (раздел статьи -> категория).
+Вопросы кодируются той же моделью, что и индекс (manifest.json или
+EMBEDDING_MODEL).
+
+Оценка - k-fold по размеченным вопросам: точность центроидов и ключевых
+слов, а для порогов уверенности - доля вопросов, решённых без LLM, и
+точность на них. По таблице выбирается CLASSIFIER_MIN_CONFIDENCE.
+
+Запуск:
+    python train_classifier.py
+    python train_classifier.py --from-index --folds 5
+    python train_classifier.py --eval-only
+"""
+import argparse
+import json
+import pickle
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, '.')
+
+from src.config import CLASSIFIER_PATH, CLASSIFIER_TEMPERATURE, EMBEDDING_MODEL, FAISS_INDEX_DIR, DATA_DIR
+from src.index_manager import read_manifest
+from src.intent_classifier import CentroidClassifier, DEFAULT_CATEGORY
+from src.keywords import get_engine
+from src.vector_index import load_vector_index
+
+EXAMPLES_PATH = DATA_DIR / "classifier_examples.json"
+THRESHOLDS = [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+# Раздел вики 3dtoday (metadata["category"] чанка) -> категория вопроса;
+# разделы, которых здесь нет, в обучение не попадают
+WIKI_CATEGORIES: Dict[str, str] = {
+    "3Dprinter": "основы",
+    "3D_Print_Technology": "основы",
+    "3Dprint_Basics": "основы",
+    "Questions": "основы",
+    "Make_3Dprinter": "основы",
+    "Fdm_Printers": "основы",
+    "Fotopolymer": "основы",
+    "3Dprint_Metal": "основы",
+    "3D_Pens": "основы",
+    "Price": "основы",
+    "Func": "основы",
+    "Fdm_Materials": "подбор_материала",
+    "Foto_Smola": "подбор_материала",
+    "High_Filament": "подбор_материала",
+    "Made_Filament": "подбор_материала",
+    "Neylon": "подбор_материала",
+    "Polystyrol": "подбор_материала",
+    "Polycarbonate": "подбор_материала",
+    "Ninjaflex": "подбор_материала",
+    "Laybrick": "подбор_материала",
+    "Laywoo_D3": "подбор_материала",
+    "Deformation": "диагностика_дефектов",
+    "Soplo": "диагностика_дефектов",
+    "Rescue": "диагностика_дефектов",
+    "Cura": "слайсер",
+    "Processing_Models": "другое",
+    "Modeling_Photoshop": "другое",
+}
+
+
+def wiki_category(section: str) -> str:
+    """Категория раздела; технологии печати (*_Print), пластики и смолы - по суффиксу/префиксу"""
+    if section in WIKI_CATEGORIES:
+        return WIKI_CATEGORIES[section]
+    if section.endswith("_Print"):
+        return "основы"
+    if section.endswith("_Plastic") or section.startswith("Smola_"):
+        return "подбор_материала"
+    return ""
+
+
+def load_examples(path: Path) -> Tuple[List[str], List[str]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    questions, labels = [], []
+    for category, items in data.items():
+        questions.extend(items)
+        labels.extend([category] * len(items))
+    return questions, labels
+
+
+def index_examples(index_dir: Path) -> Tuple[np.ndarray, List[str]]:
+    """Векторы чанков индекса с метками по разделу вики (слабая разметка)"""
+    index, _ = load_vector_index(index_dir)
+    if index is None:
+        raise SystemExit(f"❌ Индекс не найден в {index_dir}, запустите python build_index.py")
+    with open(index_dir / "documents.pkl", 'rb') as f:
+        _, metadatas = pickle.load(f)
+    vectors = index.reconstruct_n(0, index.ntotal)
+    labels = [wiki_category(m.get('category', '')) for m in metadatas[:index.ntotal]]
+    keep = [i for i, label in enumerate(labels) if label]
+    print(f"✅ Чанков с меткой раздела: {len(keep)} из {index.ntotal}")
+    return vectors[keep], [labels[i] for i in keep]
+
+
+def cross_validate(
+    vectors: np.ndarray,
+    labels: List[str],
+    folds: int,
+    temperature: float,
+    extra: Optional[Tuple[np.ndarray, List[str]]] = None,
+) -> Tuple[List[str], np.ndarray]:
+    """Предсказания и уверенность для каждого вопроса по модели без его фолда"""
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(labels))
+    predictions = [""] * len(labels)
+    confidences = np.zeros(len(labels))
+    labels_arr = np.asarray(labels)
+    for fold in range(folds):
+        test = order[fold::folds]
+        train = np.setdiff1d(order, test)
+        train_vectors, train_labels = vectors[train], list(labels_arr[train])
+        if extra is not None:
+            train_vectors = np.vstack([train_vectors, extra[0]])
+            train_labels += extra[1]
+        model = CentroidClassifier.fit(train_vectors, train_labels, temperature=temperature)
+        proba = model.predict_proba(vectors[test])
+        for row, i in zip(proba, test):
+            predictions[i] = model.categories[int(row.argmax())]
+            confidences[i] = row.max()
+    return predictions, confidences
+
+
+def report(questions: List[str], labels: List[str], predictions: List[str], confidences: np.ndarray):
+    engine = get_engine()
+    keyword_predictions = [engine.best(engine.scan(q), "category", DEFAULT_CATEGORY) for q in questions]
+    correct = np.asarray(predictions) == np.asarray(labels)
+    keyword_correct = np.asarray(keyword_predictions) == np.asarray(labels)
+    print(f"\n📊 Вопросов: {len(labels)}")
+    print(f"   центроиды:       точность {correct.mean():.1%}")
+    print(f"   ключевые слова:  точность {keyword_correct.mean():.1%}")
+
+    print("\n   порог  без LLM  точность без LLM")
+    for threshold in THRESHOLDS:
+        confident = confidences >= threshold
+        accuracy = correct[confident].mean() if confident.any() else float('nan')
+        print(f"   {threshold:5.2f}  {confident.mean():7.1%}  {accuracy:16.1%}")
+
+    errors = [(q, l, p) for q, l, p, ok in zip(questions, labels, predictions, correct) if not ok]
+    if errors:
+        print("\n   Ошибки центроидов:")
+        for question, label, prediction in errors:
+            print(f"   - {question} ({label} -> {prediction})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обучение классификатора категорий по эмбеддингам")
+    parser.add_argument("--examples", type=Path, default=EXAMPLES_PATH)
+    parser.add_argument("--from-index", action="store_true", help="добавить чанки индекса с метками разделов")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--temperature", type=float, default=CLASSIFIER_TEMPERATURE)
+    parser.add_argument("--output", type=Path, default=Path(CLASSIFIER_PATH))
+    parser.add_argument("--eval-only", action="store_true", help="только оценка, без сохранения")
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+
+    index_dir = Path(FAISS_INDEX_DIR)
+    model_name = read_manifest(index_dir).get("model") or EMBEDDING_MODEL
+    model = SentenceTransformer(model_name)
+    print(f"✅ Модель эмбеддингов: {model_name}")
+
+    questions, labels = load_examples(args.examples)
+    vectors = np.asarray(model.encode(questions), dtype=np.float32)
+    extra = index_examples(index_dir) if args.from_index else None
+
+    predictions, confidences = cross_validate(vectors, labels, args.folds, args.temperature, extra)
+    report(questions, labels, predictions, confidences)
+
+    if args.eval_only:
+        return
+    if extra is not None:
+        vectors = np.vstack([vectors, extra[0]])
+        labels = labels + extra[1]
+    classifier = CentroidClassifier.fit(vectors, labels, model_name, args.temperature)
+    classifier.save(args.output)
+    print(f"\n✅ Центроиды ({len(classifier.categories)} категорий) сохранены: {args.output}")
+    print("🔄 API подхватит их при следующем запуске")
+
+
+if __name__ == "__main__":
+    main()